@@ -13,8 +13,10 @@ import fcntl
 import uuid
 import zlib
 import copy
+import mmap
 
 import pld_nr_buildconf
+import pld_nr_iso
 
 logger = logging.getLogger("fix_gpt")
 
@@ -65,18 +67,21 @@ class Partition(object):
         return cls(type_uuid, part_uuid, first_lba, last_lba, flags, name)
 
 class GPT(object):
-    def __init__(self, image_f, image_size, lba_size, header=None, address=1,
+    """GUID Partition Table in `image` (a mmap or other buffer)."""
+    def __init__(self, image, image_size, lba_size, header=None, address=1,
                     is_backup=False):
-        self.image_f = image_f
+        self.image = image
         self.image_size = image_size
         self.lba_size = lba_size
         self.address = address
         self.is_backup = is_backup
         self.something_wrong = False
+        self.header_crc_ok = None
+        self.part_array_crc_ok = None
         if not header:
-            image_f.seek(lba_size * address)
-            header = bytearray(lba_size)
-            if image_f.readinto(header) != lba_size:
+            header = bytearray(image[lba_size * address
+                                     :lba_size * (address + 1)])
+            if len(header) != lba_size:
                 raise GPTError("Short read at LBA #{}".format(address))
             if header[:8] != b"EFI PART":
                 raise GPTError("Data at LBA #{} does not look like GPT header"
@@ -143,8 +148,8 @@ class GPT(object):
                 ) = struct.unpack("<8sHHLLLQQQQ16sQLLL", self.header[:92])
         self.revision = (rev1, rev2)
         if self.revision != (1, 0):
-            logger.warning("Unknown GPT revision: {}"
-                                                .format(".".join(revision)))
+            logger.warning("Unknown GPT revision: {}.{}"
+                                                .format(*self.revision))
         if self.reserved1:
             logger.warning("Non zero value of the reserved field: {:08x}"
                                                 .format(self.reserved1))
@@ -158,7 +163,8 @@ class GPT(object):
                 self.something_wrong = True
         self.disk_uuid = uuid.UUID(bytes_le=disk_uuid)
         crc = self.compute_header_crc(self.header, self.header_size)
-        if crc != self.header_crc:
+        self.header_crc_ok = crc == self.header_crc
+        if not self.header_crc_ok:
             logger.warning("Bad GPT header CRC")
             self.something_wrong = True
         last_lba = (self.image_size // self.lba_size) - 1
@@ -197,14 +203,15 @@ class GPT(object):
     
     def load_partitions(self):
         logger.debug("Loading partitions:")
-        self.image_f.seek(self.lba_size * self.part_array_start)
+        start = self.lba_size * self.part_array_start
         size = self.part_array_size * self.part_entry_size
-        buf = bytearray(size)
-        if self.image_f.readinto(buf) != size:
+        buf = self.image[start:start + size]
+        if len(buf) != size:
             raise GPTError("Short read of partition array")
         crc = zlib.crc32(buf) & 0xffffffff
         logger.debug("Computed CRC32 of the array: 0x{:08x}".format(crc))
-        if crc != self.part_array_crc:
+        self.part_array_crc_ok = crc == self.part_array_crc
+        if not self.part_array_crc_ok:
             logger.warning("Bad GPT partition array CRC")
             self.something_wrong = True
         self.partitions = [None] * self.part_array_size
@@ -218,7 +225,7 @@ class GPT(object):
             self.partitions[num] = partition
 
     def load_backup(self):
-        return GPT(self.image_f,
+        return GPT(self.image,
                      image_size=self.image_size,
                      lba_size=self.lba_size,
                      address=self.backup_lba,
@@ -244,7 +251,7 @@ class GPT(object):
             self.partitions = self.partitions[:self.part_array_size]
             if len(self.partitions) < self.part_array_size:
                 self.partitions += [None] * (self.part_array_size
-                                                        - en(self.partitions))
+                                                    - len(self.partitions))
         else:
             self.partitions = [None] * self.part_array_size
         return True
@@ -308,15 +315,150 @@ class GPT(object):
         self.header_crc = crc
 
         logger.debug("Writting GPT header at LBA#{}".format(self.current_lba))
-        self.image_f.seek(self.lba_size * self.current_lba)
-        self.image_f.write(self.header)
+        offset = self.lba_size * self.current_lba
+        self.image[offset:offset + len(self.header)] = self.header
 
         logger.debug("Writting partition array at LBA#{}"
                                             .format(self.part_array_start))
-        self.image_f.seek(self.lba_size * self.part_array_start)
-        self.image_f.write(partarray)
+        offset = self.lba_size * self.part_array_start
+        self.image[offset:offset + len(partarray)] = partarray
         self.address = self.current_lba
 
+def get_image_size(image_f, name):
+    """Return size of an image file or block device."""
+    image_st = os.fstat(image_f.fileno())
+    if stat.S_ISBLK(image_st.st_mode):
+        logger.debug("{} is a block device, reading its properties"
+                                                            .format(name))
+        uint64_buf = ctypes.c_uint64()
+        if fcntl.ioctl(image_f.fileno(), BLKGETSIZE64, uint64_buf) < 0:
+            raise IOError("ioctl BLKGETSIZE64 failed")
+        image_size = uint64_buf.value
+        logger.debug("  device size: {}".format(image_size))
+        int_buf = ctypes.c_size_t()
+        if fcntl.ioctl(image_f.fileno(), BLKSSZGET, int_buf) < 0:
+            raise IOError("ioctl BLKSSZGET failed")
+        logger.debug("  block size: {}".format(int_buf.value))
+        if int_buf.value != 512:
+            logger.warning("{} block size is {}, but this utility"
+                    " currently works on 512-bytes blocks only."
+                                    .format(name, int_buf.value))
+    elif stat.S_ISREG(image_st.st_mode):
+        image_size = image_st.st_size
+        logger.debug("image size: {}".format(image_size))
+    else:
+        raise GPTError("{} not a block device nor a regular file"
+                                                            .format(name))
+    if image_size & 0x1ff:
+        raise GPTError("Image size not a multiply of 512!")
+    return image_size
+
+def map_image(image_f, image_size, write=False):
+    """Memory-map the whole image."""
+    if write:
+        access = mmap.ACCESS_WRITE
+    else:
+        access = mmap.ACCESS_READ
+    image = mmap.mmap(image_f.fileno(), image_size, access=access)
+    if hasattr(image, "madvise"):
+        image.madvise(mmap.MADV_SEQUENTIAL)
+    return image
+
+def fix_gpt(image, image_size, dry_run=False, confirm=None):
+    """Fix GPT in `image` (mmap), return True if anything was changed.
+
+    `confirm`, when given, is called to ask before writing."""
+    try:
+        primary_gpt = GPT(image,
+                          image_size=image_size,
+                          lba_size=512)
+    except GPTError as err:
+        raise GPTError("Could not read GPT at the second 512-bytes sector:"
+                        " {}. Other sector sizes not supported yet."
+                        .format(err))
+
+    backup_gpt = None
+    try:
+        backup_gpt = primary_gpt.load_backup()
+    except GPTError as err:
+        logger.warning(err)
+
+    if (primary_gpt.something_wrong or not backup_gpt
+                                        or backup_gpt.something_wrong):
+        logger.info("Problems found, will fix that.")
+    elif primary_gpt.part_array_size != 128:
+        logger.info("Strange partition array size ({}), will fix that."
+                                        .format(primary_gpt.part_array_size))
+    else:
+        logger.info("Everything seems OK. Nothing to do.")
+        return False
+
+    primary_gpt.trim_partition_array()
+    backup_gpt = primary_gpt.make_backup()
+
+    logger.debug("New primary GPT:\n{}".format(primary_gpt))
+    logger.debug("New backup GPT:\n{}".format(backup_gpt))
+
+    if dry_run:
+        logger.info("Skipping write.")
+        return False
+
+    if confirm and not confirm():
+        return False
+
+    primary_gpt.write()
+    backup_gpt.write()
+    return True
+
+def verify_image(image, image_size, prefix=None):
+    """Check GPT CRCs and module checksums in one pass over the image.
+
+    Regions are read in the order they are placed in the image: primary
+    GPT, ISO 9660 directories, module archives, backup GPT.
+    Return list of problems found."""
+    errors = []
+    try:
+        primary_gpt = GPT(image, image_size=image_size, lba_size=512)
+    except GPTError as err:
+        primary_gpt = None
+        errors.append("primary GPT: {}".format(err))
+    else:
+        if not primary_gpt.header_crc_ok:
+            errors.append("primary GPT: bad header CRC")
+        if not primary_gpt.part_array_crc_ok:
+            errors.append("primary GPT: bad partition array CRC")
+
+    try:
+        iso = pld_nr_iso.ISO9660(image)
+    except pld_nr_iso.ISOError as err:
+        errors.append("ISO 9660: {}".format(err))
+    else:
+        if prefix is None:
+            prefixes = [e.name for e in iso.listdir(iso.root)
+                        if e.is_dir and e.name.startswith("pld-nr-")]
+        else:
+            prefixes = [prefix]
+        if not prefixes:
+            errors.append("no pld-nr-* directory in the image")
+        for prefix in prefixes:
+            try:
+                errors += ["{}/{}".format(prefix, e) for e
+                                in pld_nr_iso.verify_manifest(iso, prefix)]
+            except pld_nr_iso.ISOError as err:
+                errors.append("{}: {}".format(prefix, err))
+
+    if primary_gpt:
+        try:
+            backup_gpt = primary_gpt.load_backup()
+        except GPTError as err:
+            errors.append("backup GPT: {}".format(err))
+        else:
+            if not backup_gpt.header_crc_ok:
+                errors.append("backup GPT: bad header CRC")
+            if not backup_gpt.part_array_crc_ok:
+                errors.append("backup GPT: bad partition array CRC")
+    return errors
+
 def main():
     log_parser = pld_nr_buildconf.get_logging_args_parser()
     parser = argparse.ArgumentParser(
@@ -328,83 +470,42 @@ def main():
                         help="Write changes without asking")
     parser.add_argument("--dry-run", action="store_true",
                         help="Do not change anything")
+    parser.add_argument("--verify", action="store_true",
+                        help="Only check GPT CRCs and module checksums")
     args = parser.parse_args()
     pld_nr_buildconf.setup_logging(args)
 
-    if args.dry_run:
+    if args.dry_run or args.verify:
         mode = "rb"
     else:
         mode = "r+b"
-    
-    with open(args.image, mode) as image_f:
-        image_st = os.fstat(image_f.fileno())
-        if stat.S_ISBLK(image_st.st_mode):
-            logger.debug("{} is a block device, reading its properties"
-                                                        .format(args.image))
-            uint64_buf = ctypes.c_uint64()
-            if fcntl.ioctl(image_f.fileno(), BLKGETSIZE64, uint64_buf) < 0:
-                raise IOError("ioctl BLKGETSIZE64 failed")
-            image_size = uint64_buf.value
-            logger.debug("  device size: {}".format(image_size))
-            int_buf = ctypes.c_size_t()
-            if fcntl.ioctl(image_f.fileno(), BLKSSZGET, int_buf) < 0:
-                raise IOError("ioctl BLKSSZGET failed")
-            logger.debug("  block size: {}".format(int_buf.value))
-            if int_buf.value != 512:
-                logger.warning("{} block size is {}, but this utility"
-                        " currently works on 512-bytes blocks only."
-                                        .format(args.image, int_buf.value))
-        elif stat.S_ISREG(image_st.st_mode):
-            image_size = os.fstat(image_f.fileno()).st_size
-            logger.debug("image size: {}".format(image_size))
-        else:
-            logger.error("{} not a block device nor a regular file"
-                                                        .format(args.image))
-            sys.exit(1)
-        if image_size & 0x1ff:
-            logger.error("Image size not a multiply of 512!")
-            sys.exit(1)
-        try:
-            primary_gpt = GPT(image_f,
-                              image_size=image_size,
-                              lba_size=512)
-        except GPTError as err:
-            logger.error("Could not read GPT at the second 512-bytes sector:"
-                            " {}. Other sector sizes not supported yet."
-                            .format(err))
-            sys.exit(1)
 
+    with open(args.image, mode) as image_f:
+        image_size = get_image_size(image_f, args.image)
+        image = map_image(image_f, image_size, mode == "r+b")
         try:
-            backup_gpt = primary_gpt.load_backup()
-        except GPTError as err:
-            logger.warning(err)
-
-        if (primary_gpt.something_wrong or not backup_gpt
-                                            or backup_gpt.something_wrong):
-            logger.info("Problems found, will fix that.")
-        elif primary_gpt.part_array_size != 128:
-            logger.info("Strange partition array size ({}), will fix that.")
-        else:
-            logger.info("Everything seems OK. Nothing to do.")
-            return
-
-        primary_gpt.trim_partition_array()
-        backup_gpt = primary_gpt.make_backup()
-        
-        logger.debug("New primary GPT:\n{}".format(primary_gpt))
-        logger.debug("New backup GPT:\n{}".format(backup_gpt))
-
-        if args.dry_run:
-            logger.info("Skipping write.")
-            return
-
-        if not args.write:
-            ans = input("Modify the image [y/N]?")
-            if ans.lower() not in ("y", "yes"):
+            if args.verify:
+                errors = verify_image(image, image_size)
+                for error in errors:
+                    logger.error(error)
+                if errors:
+                    sys.exit(1)
+                logger.info("{}: OK".format(args.image))
                 return
-        
-        primary_gpt.write()
-        backup_gpt.write()
+            if args.write:
+                confirm = None
+            else:
+                def confirm():
+                    ans = input("Modify the image [y/N]?")
+                    return ans.lower() in ("y", "yes")
+            if fix_gpt(image, image_size, args.dry_run, confirm):
+                image.flush()
+        finally:
+            image.close()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except GPTError as err:
+        logger.error(str(err))
+        sys.exit(1)
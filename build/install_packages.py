@@ -5,12 +5,40 @@ import sys
 import os
 import subprocess
 import shutil
+import stat
+import time
 import logging
 
+from collections import OrderedDict
+
 import pld_nr_buildconf
 
 logger = logging.getLogger("install_packages")
 
+# not included in any module
+PRUNE_PATHS = ["dev", "proc", "sys", "tmp", "var/tmp"]
+
+FIND_PRUNE_ARGS = ["-ignore_readdir_race", "("]
+for _path in PRUNE_PATHS:
+    FIND_PRUNE_ARGS += ["-path", "./" + _path, "-o"]
+FIND_PRUNE_ARGS = FIND_PRUNE_ARGS[:-1] + [")", "-prune", "-o"]
+
+FIND_ARGS_CHUNK = 1000
+RPM_ARGS_CHUNK = 200
+
+# RPMFILE_STATE_NORMAL and RPMFILE_STATE_REPLACED
+RPM_FILE_STATES_PRESENT = (0, 1)
+
+RPMFILE_GHOST = 1 << 6
+
+STAMP_MARGIN = 2
+
+def _is_pruned(path):
+    for prune in PRUNE_PATHS:
+        if path == prune or path.startswith(prune + "/"):
+            return True
+    return False
+
 class PackageInstaller(object):
     def __init__(self, config):
         self.config = config
@@ -34,7 +62,7 @@ class PackageInstaller(object):
             os.makedirs(self.dst_dir)
         packages_db = os.path.join(self.dst_dir, "var/lib/rpm/Packages")
         if not os.path.exists(packages_db):
-            subprocess.check_call(self.config.c_sudo + 
+            pld_nr_buildconf.traced_check_call(self.config.c_sudo + 
                                     ["rpm", "--initdb", "--root", self.dst_dir])
     def poldek(self, *args, ignore_errors=False):
         try:
@@ -45,67 +73,41 @@ class PackageInstaller(object):
                                 "-O", "rpmdef=_netsharedpath ''" ] \
                                 + self.langs_opts + list(args)
             logger.debug("Running: {0}".format(cmd))
-            subprocess.check_call(cmd)
+            pld_nr_buildconf.traced_check_call(cmd)
         except subprocess.CalledProcessError as err:
             if not ignore_errors:
                 raise
     def setup_chroot(self):
         dev_dir = os.path.join(self.dst_dir, "dev")
-        subprocess.check_call(self.config.c_sudo + [
+        pld_nr_buildconf.traced_check_call(self.config.c_sudo + [
                                         "mount", "--bind", "/dev", dev_dir])
         dev_pts_dir = os.path.join(dev_dir, "pts")
         if not os.path.isdir(dev_pts_dir):
             os.makedirs(dev_pts_dir)
-        subprocess.check_call(self.config.c_sudo + [
+        pld_nr_buildconf.traced_check_call(self.config.c_sudo + [
                                     "mount", "-t", "devpts", 
                                     "-o", "gid=5,mode=620",
                                     "none", dev_pts_dir])
         proc_dir = os.path.join(self.dst_dir, "proc")
-        subprocess.check_call(self.config.c_sudo + [
+        pld_nr_buildconf.traced_check_call(self.config.c_sudo + [
                                 "mount", "-t", "proc", "none", proc_dir])
         sys_dir = os.path.join(self.dst_dir, "sys")
-        subprocess.check_call(self.config.c_sudo + [
+        pld_nr_buildconf.traced_check_call(self.config.c_sudo + [
                                 "mount", "-t", "sysfs", "none", sys_dir])
 
-    def get_file_list(self):
-        result = []
-        old_dir = os.getcwd()
-        os.chdir(self.dst_dir)
-        try:
-            paths = subprocess.check_output(
-                                        self.config.c_sudo + [
-                                            "find", ".",
-                                            "-ignore_readdir_race",
-                                            "-path", "./dev",
-                                            "-o", "-path", "./proc",
-                                            "-o", "-path", "./sys",
-                                            "-o", "-path", "./tmp",
-                                            "-o", "-path", "./var/tmp",
-                                            "-prune", "-o", "-print0"])
-            for path in paths.split(b"\000"):
-                path = path[2:] # strip "./"
-                if not path:
-                    continue
-                result.append(path.decode("utf-8"))
-        finally:
-            os.chdir(old_dir)
-        return result
-
-    def get_installed_pkg_list(self):
+    def get_installed_pkg_nevrs(self):
         cmd = self.config.c_sudo + ["rpm", "--root", self.dst_dir, "-qa",
-                                                "--queryformat", "%{name}\n"]
-        pkg_list = subprocess.check_output(cmd)
-        pkg_list = pkg_list.decode("utf-8").strip().split("\n")
-        logger.debug("Installed packages: {!r}".format(pkg_list))
-        return pkg_list
+                            "--queryformat", "%{name}-%{version}-%{release}\n"]
+        pkg_list = pld_nr_buildconf.traced_check_output(cmd)
+        return [p for p in pkg_list.decode("utf-8").split("\n") if p]
 
     def get_installed_pkg_info(self):
         cmd = self.config.c_sudo + ["rpm", "--root", self.dst_dir, "-qa",
             "--queryformat", "%{name}\t%{version}-%{release}\t%{summary}\n"]
         result = []
-        rpm_p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        for line in rpm_p.stdout:
-            line = line.decode("utf-8").strip()
+        output = pld_nr_buildconf.traced_check_output(cmd)
+        for line in output.decode("utf-8").split("\n"):
+            line = line.strip()
             if not line:
                 continue
             pkg, version, summary = line.split("\t", 2)
@@ -117,17 +119,273 @@ class PackageInstaller(object):
         dev_pts_dir = os.path.join(dev_dir, "pts")
         proc_dir = os.path.join(self.dst_dir, "proc")
         sys_dir = os.path.join(self.dst_dir, "sys")
-        subprocess.call(self.config.c_sudo + ["umount", sys_dir])
-        subprocess.call(self.config.c_sudo + ["umount", proc_dir])
-        subprocess.call(self.config.c_sudo + ["umount", dev_pts_dir])
-        subprocess.call(self.config.c_sudo + ["umount", dev_dir])
+        for mnt_dir in (sys_dir, proc_dir, dev_pts_dir, dev_dir):
+            pld_nr_buildconf.traced_call(self.config.c_sudo + ["umount",
+                                                               mnt_dir])
         if total and os.path.isdir(self.dst_dir):
             if self.config.c_sudo:
-                subprocess.call(self.config.c_sudo + [
+                pld_nr_buildconf.traced_call(self.config.c_sudo + [
                                         "rm", "-rf", self.dst_dir])
             else:
                 shutil.rmtree(self.dst_dir)
 
+class PackageFiles(object):
+    """Information about an installed package needed for attribution."""
+    def __init__(self, nevra, name):
+        self.nevra = nevra
+        self.name = name
+        self.provides = []
+        self.requires = []
+        self.files = []
+        self.dirs = set()
+
+class FileAttributor(object):
+    """Find out which files were added to the chroot by each module.
+
+    Files of the newly installed packages are taken from the RPM database.
+    Anything else (created by scriptlets or module scripts) is found by
+    listing only the directories modified since the last `mark`. Only
+    `start` walks the whole tree."""
+    def __init__(self, installer):
+        self.installer = installer
+        self.config = installer.config
+        self.dst_dir = installer.dst_dir
+        self.stamp_fn = os.path.abspath("install.stamp")
+        self.known = set()
+        self.known_dirs = set()
+        self.packages = set()
+        self.pending_paths = set()
+        self.pending_packages = []
+
+    def start(self):
+        """Index the current tree.
+
+        Anything already there will be attributed to the first module
+        collected, unless registered with `add_existing`."""
+        logger.debug("Scanning the whole tree")
+        found = self._find(["."] + FIND_PRUNE_ARGS
+                                    + ["-printf", "%y\\t%p\\0"])
+        self.known_dirs = set(p for t, p in found if t == "d")
+        self._add_found(found, self.pending_paths)
+        self.mark()
+        self.pending_packages = sorted(n.rsplit("-", 2)[0]
+                                                    for n in self.packages)
+
+    def mark(self):
+        """Remember current state, so later changes can be found."""
+        self.packages = set(self.installer.get_installed_pkg_nevrs())
+        with open(self.stamp_fn, "w"):
+            pass
+        # file system timestamps are coarse, rather scan some directories
+        # twice than miss changes made just before the mark
+        stamp_time = time.time() - STAMP_MARGIN
+        os.utime(self.stamp_fn, (stamp_time, stamp_time))
+
+    def add_existing(self, paths):
+        """Register paths attributed in a previous run."""
+        self.known.update(paths)
+        self.pending_paths.difference_update(paths)
+
+    def exists(self, path):
+        """Check if `path` exists in the chroot. Paths that cannot be
+        checked (unreadable directories) are assumed to exist."""
+        try:
+            os.lstat(os.path.join(self.dst_dir, path))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _find(self, args):
+        """Run find in the chroot and return list of (type, path)."""
+        result = []
+        cmd = self.config.c_sudo + ["find"] + args
+        logger.debug("Running: find {} ...".format(" ".join(args[:3])))
+        output = pld_nr_buildconf.traced_check_output(cmd, ok_codes=(0, 1),
+                                                cwd=self.dst_dir,
+                                                stderr=subprocess.DEVNULL)
+        for item in output.split(b"\000"):
+            if not item:
+                continue
+            path_type, path = item.decode("utf-8").split("\t", 1)
+            if path.startswith("./"):
+                path = path[2:]
+            elif path == ".":
+                path = ""
+            result.append((path_type, path))
+        return result
+
+    def _find_chunked(self, paths, args):
+        result = []
+        paths = ["./" + p if p else "." for p in sorted(paths)]
+        for i in range(0, len(paths), FIND_ARGS_CHUNK):
+            result += self._find(paths[i:i + FIND_ARGS_CHUNK] + args)
+        return result
+
+    def _add_found(self, found, new_paths):
+        for path_type, path in found:
+            if not path or path in self.known or _is_pruned(path):
+                continue
+            self.known.add(path)
+            new_paths.add(path)
+            if path_type == "d":
+                self.known_dirs.add(path)
+
+    def scan_changes(self):
+        """Return set of paths added since the last mark not yet known."""
+        new_paths = set()
+        logger.debug("Checking {} directories for changes"
+                                            .format(len(self.known_dirs)))
+        changed = self._find_chunked(self.known_dirs,
+                                     ["-maxdepth", "0", "-type", "d",
+                                      "-newer", self.stamp_fn,
+                                      "-printf", "%y\\t%p\\0"])
+        changed = [p for t, p in changed]
+        logger.debug("Listing {} changed directories".format(len(changed)))
+        found = self._find_chunked(changed,
+                                   ["-mindepth", "1", "-maxdepth", "1",
+                                    "-printf", "%y\\t%p\\0"])
+        new_dirs = [p for t, p in found
+                        if t == "d" and p not in self.known_dirs
+                                            and not _is_pruned(p)]
+        self._add_found(found, new_paths)
+        if new_dirs:
+            logger.debug("Scanning {} new directories".format(len(new_dirs)))
+            found = self._find_chunked(new_dirs,
+                                       ["-mindepth", "1"] + FIND_PRUNE_ARGS
+                                            + ["-printf", "%y\\t%p\\0"])
+            self._add_found(found, new_paths)
+        return new_paths
+
+    def query_packages(self, nevrs):
+        """Query RPM database for files and dependencies of packages.
+
+        Return OrderedDict of PackageFiles keyed by name-version-release.arch,
+        as multilib packages share the name."""
+        result = OrderedDict()
+        query_format = ("@%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\t%{NAME}\\n"
+                        "[P\\t%{PROVIDENAME}\\n]"
+                        "[R\\t%{REQUIRENAME}\\n]"
+                        "[F\\t%{FILESTATES}\\t%{FILEFLAGS}\\t%{FILEMODES}"
+                                                    "\\t%{FILENAMES}\\n]")
+        nevrs = sorted(nevrs)
+        for i in range(0, len(nevrs), RPM_ARGS_CHUNK):
+            cmd = self.config.c_sudo + ["rpm", "--root", self.dst_dir, "-q",
+                                        "--queryformat", query_format]
+            cmd += nevrs[i:i + RPM_ARGS_CHUNK]
+            output = pld_nr_buildconf.traced_check_output(cmd).decode("utf-8")
+            package = None
+            for line in output.split("\n"):
+                if line.startswith("@"):
+                    package = PackageFiles(*line[1:].split("\t", 1))
+                    result[package.nevra] = package
+                elif line.startswith("P\t"):
+                    package.provides.append(line[2:])
+                elif line.startswith("R\t"):
+                    package.requires.append(line[2:])
+                elif line.startswith("F\t"):
+                    state, flags, mode, path = line[2:].split("\t", 3)
+                    if int(state) not in RPM_FILE_STATES_PRESENT:
+                        continue
+                    if int(flags) & RPMFILE_GHOST:
+                        continue
+                    path = path.lstrip("/")
+                    package.files.append(path)
+                    if stat.S_ISDIR(int(mode)):
+                        package.dirs.add(path)
+        return result
+
+    def _assign_packages(self, packages, modules):
+        """Split `packages` between `modules` (list of (name, roots)).
+
+        Each module gets the packages it asked for and their dependencies
+        not claimed by the previous modules. Anything left (e.g. packages
+        installed before the first mark) goes to the first module.
+        Return OrderedDict mapping module names to lists of `packages`
+        keys."""
+        providers = {}
+        by_name = {}
+        for nevra, pkg in packages.items():
+            by_name.setdefault(pkg.name, []).append(nevra)
+            for cap in [pkg.name] + pkg.provides:
+                providers.setdefault(cap, set()).add(nevra)
+            for path in pkg.files:
+                providers.setdefault("/" + path, set()).add(nevra)
+        result = OrderedDict((module, []) for module, roots in modules)
+        assigned = set()
+        for module, roots in modules:
+            queue = [n for r in roots for n in by_name.get(r, ())]
+            while queue:
+                nevra = queue.pop(0)
+                if nevra in assigned:
+                    continue
+                assigned.add(nevra)
+                result[module].append(nevra)
+                for cap in packages[nevra].requires:
+                    for provider in providers.get(cap, ()):
+                        if provider not in assigned:
+                            queue.append(provider)
+        left = [n for n in packages if n not in assigned]
+        if left:
+            logger.debug("Packages not required by any module: {!r}"
+                                                            .format(left))
+            result[modules[0][0]] += left
+        return result
+
+    def collect(self, modules):
+        """Attribute changes since the last mark to modules.
+
+        `modules` is a list of (module name, requested package names)
+        pairs. Return OrderedDict mapping module names to
+        (set of paths, list of package names) and set a new mark.
+
+        Files not coming from packages go to the module owning the
+        package directory they were created in, or to the first one."""
+        result = OrderedDict((m, (set(), [])) for m, roots in modules)
+        packages = set(self.installer.get_installed_pkg_nevrs())
+        added = packages - self.packages
+        first_module = modules[0][0]
+        result[first_module][0].update(self.pending_paths)
+        result[first_module][1].extend(self.pending_packages)
+        self.pending_paths = set()
+        self.pending_packages = []
+        dir_modules = {}
+        if added:
+            pkg_info = self.query_packages(added)
+            assignment = self._assign_packages(pkg_info, modules)
+            for module, nevras in assignment.items():
+                paths, pkg_names = result[module]
+                for nevra in nevras:
+                    pkg = pkg_info[nevra]
+                    pkg_names.append(pkg.name)
+                    for path in pkg.dirs:
+                        dir_modules.setdefault(path, module)
+                    for path in pkg.files:
+                        if path in self.known or _is_pruned(path):
+                            continue
+                        if not self.exists(path):
+                            # removed by a scriptlet
+                            continue
+                        self.known.add(path)
+                        paths.add(path)
+                        if path in pkg.dirs:
+                            self.known_dirs.add(path)
+                        dir_path = os.path.dirname(path)
+                        while dir_path and dir_path not in self.known:
+                            self.known.add(dir_path)
+                            self.known_dirs.add(dir_path)
+                            paths.add(dir_path)
+                            dir_path = os.path.dirname(dir_path)
+        # files created by scriptlets and scripts
+        for path in self.scan_changes():
+            dir_path = os.path.dirname(path)
+            while dir_path and dir_path not in dir_modules:
+                dir_path = os.path.dirname(dir_path)
+            result[dir_modules.get(dir_path, first_module)][0].add(path)
+        self.mark()
+        return result
+
 def write_package_list(filename, installer, modules, package_modules):
     packages_info = installer.get_installed_pkg_info()
     name_width = max(len(p[0]) for p in packages_info)
@@ -153,6 +411,100 @@ def write_package_list(filename, installer, modules, package_modules):
                                 module, module_width,
                                 pkg_sum), file=pkg_lst_file)
 
+def read_pset(pset_fn):
+    """Return package names listed in a pset file."""
+    result = []
+    with open(pset_fn, "rt") as pset_f:
+        for line in pset_f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                result.append(line.split()[0].lstrip("~!@"))
+    return result
+
+def get_lst_fn(module):
+    if module == "base":
+        return "base.full-lst"
+    else:
+        return "{0}.lst".format(module)
+
+def install_modules(config, installer, attributor, modules, package_modules):
+    """Install packages of `modules` in a single poldek transaction
+    and write their .lst files."""
+    logger.info("Installing packages for: {}".format(", ".join(modules)))
+    with pld_nr_buildconf.trace_phase("install " + " ".join(modules)):
+        _install_modules(config, installer, attributor, modules,
+                                                        package_modules)
+
+def _install_modules(config, installer, attributor, modules,
+                                                        package_modules):
+    for module in modules:
+        script_fn = "../modules/{0}/pre-install.sh".format(module)
+        if os.path.exists(script_fn):
+            config.run_script(script_fn, sudo=True)
+    for module in modules:
+        pset_fn = "../modules/{0}/deps_workaround.pset".format(module)
+        if os.path.exists(pset_fn):
+            logger.debug("Installing deps_workaround packages for {0}"
+                                .format(module))
+            installer.poldek("--install", "--pset", pset_fn,
+                        "--nofollow", "--nodeps", "--pmopt", "noscripts")
+    requested = []
+    pset_fns = []
+    for module in modules:
+        pset_fn = "../modules/{0}/packages.pset".format(module)
+        if os.path.exists(pset_fn):
+            pset_fns.append(pset_fn)
+            requested.append((module, read_pset(pset_fn)))
+        else:
+            requested.append((module, []))
+    if len(pset_fns) > 1:
+        batch_pset_fn = "batch.pset"
+        with open(batch_pset_fn, "wt") as batch_f:
+            for pset_fn in pset_fns:
+                with open(pset_fn, "rt") as pset_f:
+                    batch_f.write(pset_f.read() + "\n")
+        pset_fns = [batch_pset_fn]
+    if pset_fns:
+        logger.debug("Installing packages from {!r}".format(pset_fns[0]))
+        installer.poldek("--install", "--pset", pset_fns[0])
+
+    module_files = OrderedDict((m, set()) for m in modules)
+    def collect(requested):
+        logger.debug("Attributing installed files")
+        with pld_nr_buildconf.trace_phase("attribute_files"):
+            collected = attributor.collect(requested)
+        for module, (paths, pkgs) in collected.items():
+            module_files[module].update(paths)
+            for pkg in pkgs:
+                if pkg not in package_modules:
+                    package_modules[pkg] = module
+
+    if len(modules) > 1:
+        collect(requested)
+    for module in modules:
+        script_fn = "../modules/{0}/post-install.sh".format(module)
+        if os.path.exists(script_fn):
+            logger.debug("Running the 'post-install' script of {}"
+                                                            .format(module))
+            config.run_script(script_fn, sudo=True)
+            if len(modules) > 1:
+                collect([(module, [])])
+    if len(modules) == 1:
+        collect(requested)
+    else:
+        # drop files the post-install scripts removed after the first
+        # collect, as the single module install does not see them
+        for paths in module_files.values():
+            paths.difference_update([p for p in paths
+                                        if not attributor.exists(p)])
+
+    for module, paths in module_files.items():
+        lst_fn = get_lst_fn(module)
+        logger.debug("Writing {0!r}".format(lst_fn))
+        with open(lst_fn, "wt") as lst_f:
+            for path in sorted(paths):
+                print(path, file=lst_f)
+
 def main():
     log_parser = pld_nr_buildconf.get_logging_args_parser()
     parser = argparse.ArgumentParser(description="Install packages",
@@ -170,54 +522,36 @@ def main():
     try:
         installer.init_rpm_db()
         installer.poldek("--upa", ignore_errors=True)
-        prev_files = set()
+        attributor = FileAttributor(installer)
+        attributor.start()
         installer.poldek("--install", "filesystem")
         installer.setup_chroot()
         # packages needed early, before main rpm transaction
         installer.poldek("--install", "mksh")
         package_modules = {}
+        pending = []
         for module in config.modules:
-            if module == "base":
-                lst_fn = "base.full-lst"
-            else:
-                lst_fn = "{0}.lst".format(module)
+            lst_fn = get_lst_fn(module)
             lst_files.append(lst_fn)
             logger.debug("Checking if {0!r} already exists".format(lst_fn))
             if os.path.exists(lst_fn):
+                if pending:
+                    install_modules(config, installer, attributor, pending,
+                                                            package_modules)
+                    pending = []
                 files = [l.strip() for l in open(lst_fn, "rt").readlines()]
-                prev_files.update(files)
+                attributor.add_existing(files)
                 logger.info("'{0}' packages already installed".format(module))
                 open(lst_fn, "a").close() # update mtime
                 continue
-            script_fn = "../modules/{0}/pre-install.sh".format(module)
-            if os.path.exists(script_fn):
-                config.run_script(script_fn, sudo=True)
-            pset_fn = "../modules/{0}/deps_workaround.pset".format(module)
-            if os.path.exists(pset_fn):
-                logger.debug("Installing deps_workaround packages for {0}"
-                                    .format(module))
-                installer.poldek("--install", "--pset", pset_fn,
-                            "--nofollow", "--nodeps", "--pmopt", "noscripts")
-            pset_fn = "../modules/{0}/packages.pset".format(module)
-            if os.path.exists(pset_fn):
-                logger.debug("Installing packages for {0}".format(module))
-                installer.poldek("--install", "--pset", pset_fn)
-            script_fn = "../modules/{0}/post-install.sh".format(module)
-            if os.path.exists(script_fn):
-                logger.debug("Running the 'post-install' script")
-                config.run_script(script_fn, sudo=True)
-            logger.debug("Getting list of installed files")
-            files = set(installer.get_file_list())
-            module_files = files - prev_files
-            prev_files = files
-            logger.debug("Writing {0!r}".format(lst_fn))
-            with open(lst_fn, "wt") as lst_f:
-                for path in sorted(module_files):
-                    print(path, file=lst_f)
-            module_pkgs = installer.get_installed_pkg_list()
-            for pkg in module_pkgs:
-                if pkg not in package_modules:
-                    package_modules[pkg] = module
+            pending.append(module)
+            if not config.batch_install:
+                install_modules(config, installer, attributor, pending,
+                                                        package_modules)
+                pending = []
+        if pending:
+            install_modules(config, installer, attributor, pending,
+                                                        package_modules)
         write_package_list("../pld-nr-{}.packages".format(config.bits),
                             installer, config.modules, package_modules)
     except:
@@ -4,19 +4,14 @@ import argparse
 import sys
 import os
 import subprocess
-import shutil
-import re
-import stat
 import logging
 
-from hashlib import md5
-
 import pld_nr_buildconf
+import pld_nr_cache
+import pld_nr_fat
 
 logger = logging.getLogger("make_efi_img")
 
-DU_OUTPUT_RE = re.compile("^(\d+)\s+total", re.MULTILINE)
-
 def main():
     log_parser = pld_nr_buildconf.get_logging_args_parser()
     parser = argparse.ArgumentParser(description="Make EFI partition image",
@@ -32,7 +27,6 @@ def main():
 
     efi_img_fn = os.path.abspath(args.destination)
     efi_templ_dir = os.path.abspath("../efi_templ")
-    efi_mnt_dir = os.path.abspath("efi_mnt")
 
     grub_files = {}
     for plat in config.grub_platforms:
@@ -46,58 +40,54 @@ def main():
         else:
             logger.warning("Unuspported GRUB EFI platform: {}".format(plat))
 
-    logger.info("Computing required image size")
-    extra_files = list(grub_files)
-
     if config.efi_shell:
         efi_shell_path = "/lib/efi/{}/Shell.efi".format(config.efi_arch)
-        extra_files.append(efi_shell_path)
 
-    safe_env = dict(os.environ)
-    safe_env["LC_ALL"] = "C"
-    du_output = subprocess.check_output(["du", "-sbcD",
-                                            "../efi_templ",
-                                            ] + extra_files,
-                                            env=safe_env)
-    match = DU_OUTPUT_RE.search(du_output.decode("utf-8"))
-    bytes_needed = int(int(match.group(1)) * 1.2)
-    logger.debug("bytes needed: {0!r}".format(bytes_needed))
-    blocks_needed = max(bytes_needed // 1024, 256)
+    if config.deterministic:
+        timestamp = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+    else:
+        timestamp = None
 
-    if blocks_needed & 0x0f:
-        # so mtools doesn't complain that:
-        # Total number of sectors not a multiple of sectors per track (32)!
-        blocks_needed = (blocks_needed & 0xfffffff0) + 0x10
+    cache = pld_nr_cache.get_cache(config)
+    if cache:
+        key = pld_nr_cache.CacheKey("efi")
+        key.add_values(config.efi_vol_id, config.efi_arch, config.efi_shell,
+                       timestamp)
+        key.add_dir(efi_templ_dir, config)
+        for source in sorted(grub_files):
+            key.add_file(source, grub_files[source])
+        if config.efi_shell:
+            key.add_file(efi_shell_path)
+        # the image writer itself
+        key.add_file(pld_nr_fat.__file__, "pld_nr_fat")
+        if cache.fetch(key, [efi_img_fn]):
+            return
+
+    logger.info("Installing PLD NR EFI files")
+    image = pld_nr_fat.FATImage(pld_nr_fat.parse_volume_id(config.efi_vol_id),
+                                timestamp=timestamp)
+    image.add_dir("EFI/BOOT")
+    if config.efi_shell:
+        image.add_file("EFI/SHELL{}.EFI".format(config.efi_arch.upper()),
+                       source=efi_shell_path)
+    config.copy_template_dir_to_fat(efi_templ_dir, image)
+    for source, efi_arch in grub_files.items():
+        image.add_file("EFI/BOOT/BOOT{}.EFI".format(efi_arch), source=source)
 
     logger.info("Creating the image")
-    subprocess.check_call(["dd", "if=/dev/zero", "of=" + efi_img_fn,
-                            "bs=1024", "count={0}".format(blocks_needed)])
     try:
-        subprocess.check_call(["mkdosfs", "-I",
-                                "-i", config.efi_vol_id.replace("-", ""),
-                                efi_img_fn])
-        if not os.path.exists(efi_mnt_dir):
-            os.makedirs(efi_mnt_dir)
-        logger.info("Installing PLD NR EFI files")
-        subprocess.check_call(["mmd", "-i", efi_img_fn,
-                                                "::/EFI", "::/EFI/BOOT"])
-        if config.efi_shell:
-            subprocess.check_call(["mcopy", "-i", efi_img_fn,
-                                    efi_shell_path,
-                                    "::/EFI/SHELL{}.EFI".format(
-                                                    config.efi_arch.upper())])
-        config.mcopy_template_dir(efi_templ_dir, "::/", image=efi_img_fn)
-        for source, efi_arch in grub_files.items():
-            dst = "::/EFI/BOOT/BOOT{}.EFI".format(efi_arch)
-            subprocess.check_call(["mcopy", "-i", efi_img_fn, source, dst])
+        image.write(efi_img_fn)
     except:
-        os.unlink(efi_img_fn)
+        if os.path.exists(efi_img_fn):
+            os.unlink(efi_img_fn)
         raise
+    if cache:
+        cache.store(key, [efi_img_fn])
 
 if __name__ == "__main__":
     try:
         main()
-    except subprocess.CalledProcessError as err:
+    except (subprocess.CalledProcessError, pld_nr_fat.FATError) as err:
         logger.error(str(err))
         sys.exit(1)
 
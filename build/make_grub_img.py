@@ -8,6 +8,7 @@ import logging
 import tempfile
 
 import pld_nr_buildconf
+import pld_nr_cache
 
 logger = logging.getLogger("make_grub_img")
 
@@ -75,15 +76,26 @@ echo "using prefix: $prefix efi_part: $efi_part $efi_suffix"
             grub_core_modules += ["iso9660", "search", "search_label",
                                     "fat", "part_gpt", "iso9660"]
             prefix = "/boot/grub"
+        cache = pld_nr_cache.get_cache(config)
+        if cache:
+            key = pld_nr_cache.CacheKey("grub")
+            key.add_values(platform, prefix, *grub_core_modules)
+            key.add_file(grub_early.name, "grub_early")
+            key.add_tool("grub-mkimage")
+            key.add_dir(os.path.join("/lib/grub", args.platform))
+            if cache.fetch(key, [args.destination]):
+                return
         logger.debug("Making {} grub image for {} with modules: {!r}"
                         .format(args.destination, args.platform,
                                                     grub_core_modules))
-        subprocess.check_call(["grub-mkimage",
+        pld_nr_buildconf.traced_check_call(["grub-mkimage",
                                 "--output", args.destination,
                                 "--format", platform,
                                 "--prefix", prefix,
                                 "--config", grub_early.name,
                                 ] + grub_core_modules)
+        if cache:
+            cache.store(key, [args.destination])
 
 if __name__ == "__main__":
     try:
@@ -10,10 +10,14 @@ import re
 import stat
 import errno
 import logging
+import time
 
 from glob import glob
 
 import pld_nr_buildconf
+import pld_nr_elfdeps
+import pld_nr_cache
+import pld_nr_compress
 
 logger = logging.getLogger("make_initramfs")
 
@@ -24,6 +28,9 @@ LD_LIST_RE = re.compile("^\s*\S+\s*=>\s*(\S+)\s*\(.*")
 
 modules_dep = {}
 
+# executables for which the ELF resolver and ld.so disagree ("check" mode)
+deps_mismatches = []
+
 def load_modules_dep(kernel_ver):
     if kernel_ver in modules_dep:
         return modules_dep[kernel_ver]
@@ -46,26 +53,17 @@ def find_kernel_mod_deps(kernel_ver, mod_path):
         result.append("lib/modules/{0}/{1}".format(kernel_ver, path))
     return result
 
-def find_executable_deps(config, path, root_dir, bits):
-    logger.debug("find_executable_deps({0!r})".format(path))
+def find_executable_deps_ld_so(config, path, root_dir, bits):
+    """Find executable dependencies by calling the dynamic loader
+    in the chroot."""
     if bits == 64:
         lib = "lib64"
         ld_linux = "/lib64/ld-linux-x86-64.so.2"
     else:
         lib = "lib"
         ld_linux = "/lib/ld-linux.so.2"
-    if path.startswith("lib/ld-") or path.startswith("lib64/ld-"):
-        logger.debug("Returning empty list for dynamic loader")
-        return []
-    with open(path, "rb") as exec_f:
-        header = exec_f.read(1024)
-    if header[:2] == b"#!":
-        line = header.split(b"\n")[0].decode("utf-8")
-        interpreter = line[2:].split()[0]
-        return [interpreter.lstrip("/")]
-
     try:
-        output = subprocess.check_output(config.c_sudo + [
+        output = pld_nr_buildconf.traced_check_output(config.c_sudo + [
                         "chroot", root_dir, ld_linux, "--list", "/" + path])
     except subprocess.CalledProcessError as err:
         logger.error(err)
@@ -99,7 +97,51 @@ def find_executable_deps(config, path, root_dir, bits):
                 result.append(os.path.abspath(target).lstrip("/"))
     return result
 
-def find_deps(config, files, all_files, root_dir):
+def find_executable_deps(config, path, root_dir, bits, resolver=None,
+                                                        mode="elf"):
+    """Find files needed to run the executable at `path`.
+
+    `mode` selects the method: "elf" uses the in-process `resolver`,
+    "ld.so" calls the dynamic loader in the chroot and "check" runs both
+    and reports any difference (returning the ld.so result)."""
+    logger.debug("find_executable_deps({0!r})".format(path))
+    if path.startswith("lib/ld-") or path.startswith("lib64/ld-"):
+        logger.debug("Returning empty list for dynamic loader")
+        return []
+    with open(path, "rb") as exec_f:
+        header = exec_f.read(1024)
+    if header[:2] == b"#!":
+        line = header.split(b"\n")[0].decode("utf-8")
+        interpreter = line[2:].split()[0]
+        return [interpreter.lstrip("/")]
+
+    if mode == "ld.so":
+        return find_executable_deps_ld_so(config, path, root_dir, bits)
+
+    try:
+        result = resolver.get_deps(path)
+    except (pld_nr_elfdeps.ELFError, OSError) as err:
+        logger.warning("{}, falling back to ld.so".format(err))
+        return find_executable_deps_ld_so(config, path, root_dir, bits)
+
+    if mode == "check":
+        ld_so_result = find_executable_deps_ld_so(config, path,
+                                                  root_dir, bits)
+        if set(result) != set(ld_so_result):
+            logger.error("Dependency mismatch for {!r}:"
+                        " only in ELF resolver: {!r},"
+                        " only in ld.so: {!r}"
+                        .format(path,
+                                sorted(set(result) - set(ld_so_result)),
+                                sorted(set(ld_so_result) - set(result))))
+            deps_mismatches.append(path)
+        return ld_so_result
+    return result
+
+def find_deps(config, files, all_files, root_dir, resolver=None,
+                                                        mode="elf"):
+    if resolver is None and mode != "ld.so":
+        resolver = pld_nr_elfdeps.LibraryResolver(root_dir, config.bits)
     present = set(all_files)
     unprocessed = list(files)
     while unprocessed:
@@ -133,7 +175,8 @@ def find_deps(config, files, all_files, root_dir):
             if match:
                 deps = find_kernel_mod_deps(match.group(1), match.group(2))
             elif (stat.S_IMODE(path_stat.st_mode) & (stat.S_IXOTH|stat.S_IXGRP|stat.S_IXUSR)):
-                deps = find_executable_deps(config, path, root_dir, config.bits)
+                deps = find_executable_deps(config, path, root_dir,
+                                            config.bits, resolver, mode)
             else:
                 continue
         else:
@@ -180,22 +223,259 @@ def expand_globs(config, globs):
     for pattern in globs:
         pattern = os.path.abspath("/" + pattern).lstrip("/")
         search_paths += glob(pattern)
-    paths = subprocess.check_output(config.c_sudo + [
+    paths = pld_nr_buildconf.traced_check_output(config.c_sudo + [
                                     "find"] + search_paths + ["-print"])
     paths = [p.decode("utf-8") for p in paths.split(b"\n") if p]
     return paths
 
-def cpio_append(cpio_fn, paths):
-    cpio_p = subprocess.Popen(["cpio", "-o", "--append", "-H", "newc",
-                                "-F", cpio_fn],
-                              stdin=subprocess.PIPE)
+CPIO_NEWC_MAGIC = b"070701"
+CPIO_TRAILER = "TRAILER!!!"
+CPIO_FIRST_INO = 721 # the same as gen_init_cpio uses
+CPIO_BLOCK_SIZE = 512
+# newc header fields (after the magic)
+CPIO_NEWC_FIELDS = ("ino", "mode", "uid", "gid", "nlink", "mtime",
+                    "filesize", "devmajor", "devminor", "rdevmajor",
+                    "rdevminor", "namesize", "check")
+COPY_BUF_SIZE = 1024 * 1024
+
+GEN_INIT_CPIO_TYPES = {
+        "dir": stat.S_IFDIR,
+        "nod": None,
+        "slink": stat.S_IFLNK,
+        "file": stat.S_IFREG,
+        "pipe": stat.S_IFIFO,
+        "sock": stat.S_IFSOCK,
+        }
+
+class CpioEntry(object):
+    def __init__(self, name, mode, uid=0, gid=0, mtime=0, rdev=(0, 0),
+                        source=None, data=None):
+        self.name = name
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.mtime = mtime
+        self.rdev = rdev
+        self.source = source
+        self.data = data
+
+class CpioWriter(object):
+    """Write a 'newc' cpio archive in a single pass through a compressor.
+
+    Entries come from gen_init_cpio rules (see `add_rule`) and from paths
+    on the filesystem (see `add_paths`). Nothing is written until `close`
+    is called, file contents are streamed from their sources then.
+
+    In the deterministic mode entries are sorted by name (the last entry
+    added under a name wins), modification times are clamped to `mtime`
+    and inode numbers depend only on the entry order, so the same input
+    always gives byte-identical output.
+
+    Hard links are stored as separate files."""
+    def __init__(self, out_f, compressor=None, deterministic=False,
+                                                            mtime=None):
+        self.out_f = out_f
+        if compressor is None:
+            compressor = pld_nr_compress.NullCompressor()
+        self.compressor = compressor
+        self.deterministic = deterministic
+        if mtime is None:
+            if deterministic:
+                mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+            else:
+                mtime = int(time.time())
+        self.mtime = mtime
+        self.entries = []
+        self.offset = 0
+        self.bytes_written = 0
+
+    def add_entry(self, entry):
+        entry.name = entry.name.lstrip("/")
+        if not entry.name:
+            entry.name = "."
+        self.entries.append(entry)
+
+    def add_rule(self, line):
+        """Add entry described by a gen_init_cpio list line."""
+        parts = line.split()
+        if not parts or parts[0].startswith("#"):
+            return
+        kind = parts[0]
+        if kind not in GEN_INIT_CPIO_TYPES:
+            raise ValueError("Unknown gen_init_cpio rule: {!r}".format(line))
+        try:
+            if kind == "file":
+                name, location = parts[1:3]
+                mode, uid, gid = parts[3:6]
+                location = os.path.expandvars(location)
+                path_stat = os.stat(location)
+                for link_name in [name] + parts[6:]:
+                    self.add_entry(CpioEntry(link_name,
+                                        stat.S_IFREG | int(mode, 8),
+                                        int(uid), int(gid),
+                                        int(path_stat.st_mtime),
+                                        source=location))
+            elif kind == "slink":
+                name, target, mode, uid, gid = parts[1:6]
+                self.add_entry(CpioEntry(name, stat.S_IFLNK | int(mode, 8),
+                                         int(uid), int(gid), self.mtime,
+                                         data=target.encode("utf-8")))
+            elif kind == "nod":
+                name, mode, uid, gid, dev_type, major, minor = parts[1:8]
+                if dev_type == "b":
+                    file_type = stat.S_IFBLK
+                elif dev_type == "c":
+                    file_type = stat.S_IFCHR
+                else:
+                    raise ValueError("Bad device type: {!r}".format(line))
+                self.add_entry(CpioEntry(name, file_type | int(mode, 8),
+                                         int(uid), int(gid), self.mtime,
+                                         rdev=(int(major), int(minor))))
+            else:
+                name, mode, uid, gid = parts[1:5]
+                self.add_entry(CpioEntry(name,
+                                    GEN_INIT_CPIO_TYPES[kind] | int(mode, 8),
+                                    int(uid), int(gid), self.mtime))
+        except (IndexError, ValueError) as err:
+            raise ValueError("Invalid gen_init_cpio line {!r}: {}"
+                                                        .format(line, err))
+
+    def add_rules_file(self, filename):
+        with open(filename, "rt") as rules_f:
+            for line in rules_f:
+                self.add_rule(line.strip())
+
+    def add_paths(self, paths, base_dir, owner=None):
+        """Add `paths` (relative to `base_dir`) from the filesystem.
+
+        `owner` may be used to override file (uid, gid)."""
+        for path in paths:
+            source = os.path.join(base_dir, path)
+            path_stat = os.lstat(source)
+            if owner:
+                uid, gid = owner
+            else:
+                uid, gid = path_stat.st_uid, path_stat.st_gid
+            entry = CpioEntry(path, path_stat.st_mode, uid, gid,
+                              int(path_stat.st_mtime),
+                              rdev=(os.major(path_stat.st_rdev),
+                                    os.minor(path_stat.st_rdev)))
+            if stat.S_ISLNK(path_stat.st_mode):
+                entry.data = os.readlink(source).encode("utf-8")
+            elif stat.S_ISREG(path_stat.st_mode):
+                entry.source = source
+            self.add_entry(entry)
+
+    def _write(self, data):
+        self.offset += len(data)
+        data = self.compressor.compress(data)
+        if data:
+            self.out_f.write(data)
+            self.bytes_written += len(data)
+
+    def _pad(self, alignment=4):
+        if self.offset % alignment:
+            self._write(b"\x00" * (alignment - self.offset % alignment))
+
+    def _write_header(self, name, ino, mode, uid, gid, nlink, mtime, size,
+                                                            rdev=(0, 0)):
+        name = name.encode("utf-8") + b"\x00"
+        fields = (ino, mode, uid, gid, nlink, mtime, size,
+                  0, 0, rdev[0], rdev[1], len(name), 0)
+        for field, value in zip(CPIO_NEWC_FIELDS, fields):
+            if not 0 <= value <= 0xFFFFFFFF:
+                raise ValueError("{!r}: {} {} does not fit in a cpio"
+                                 " header".format(name[:-1].decode("utf-8"),
+                                                  field, value))
+        header = ("{:08X}" * 13).format(*fields)
+        self._write(CPIO_NEWC_MAGIC + header.encode("us-ascii") + name)
+        self._pad()
+
+    def _write_entry(self, entry, ino):
+        mtime = entry.mtime
+        if self.deterministic:
+            mtime = min(mtime, self.mtime)
+        if stat.S_ISDIR(entry.mode):
+            nlink = 2
+        else:
+            nlink = 1
+        if entry.source:
+            with open(entry.source, "rb") as source_f:
+                size = os.fstat(source_f.fileno()).st_size
+                self._write_header(entry.name, ino, entry.mode, entry.uid,
+                                   entry.gid, nlink, mtime, size)
+                remaining = size
+                while remaining > 0:
+                    data = source_f.read(min(COPY_BUF_SIZE, remaining))
+                    if not data:
+                        raise IOError("{!r} truncated while reading"
+                                                    .format(entry.source))
+                    self._write(data)
+                    remaining -= len(data)
+        else:
+            data = entry.data or b""
+            self._write_header(entry.name, ino, entry.mode, entry.uid,
+                               entry.gid, nlink, mtime, len(data), entry.rdev)
+            self._write(data)
+        self._pad()
+
+    def close(self):
+        entries = self.entries
+        if self.deterministic:
+            entries = sorted({e.name: e for e in entries}.values(),
+                             key=lambda e: e.name)
+        for ino, entry in enumerate(entries, CPIO_FIRST_INO):
+            self._write_entry(entry, ino)
+        self._write_header(CPIO_TRAILER, 0, 0, 0, 0, 1, 0, 0)
+        self._pad(CPIO_BLOCK_SIZE)
+        data = self.compressor.flush()
+        if data:
+            self.out_f.write(data)
+            self.bytes_written += len(data)
+        logger.debug("{} cpio entries, {} bytes, {} bytes compressed"
+                        .format(len(entries), self.offset, self.bytes_written))
+        self.entries = []
+
+def pack_files(out_fn, paths, deterministic=False):
+    """Write uncompressed cpio archive with `paths` (relative to the current
+    directory)."""
+    logger.debug("packing {!r} into {!r}".format(paths, out_fn))
+    try:
+        with open(out_fn, "wb") as out_f:
+            writer = CpioWriter(out_f, deterministic=deterministic)
+            writer.add_paths(paths, os.getcwd())
+            writer.close()
+    except:
+        if os.path.exists(out_fn):
+            os.unlink(out_fn)
+        raise
+
+def initramfs_cache_key(config, name, gic_list_fn, paths, root_dir,
+                        skel_dir, deterministic):
+    """Compute cache key of an initramfs module from its resolved
+    contents."""
+    key = pld_nr_cache.CacheKey("initramfs-" + name)
+    key.add_values(config.initramfs_compression, deterministic)
+    if deterministic:
+        key.add_values(os.environ.get("SOURCE_DATE_EPOCH"))
+    with open(gic_list_fn, "rt") as gic_list_f:
+        for line in gic_list_f:
+            line = line.strip()
+            key.add_string(line)
+            split_line = line.split()
+            if split_line and split_line[0] == "file":
+                key.add_file(split_line[2])
     for path in paths:
-        cpio_p.stdin.write(path.encode("utf-8"))
-        cpio_p.stdin.write(b"\n")
-    cpio_p.stdin.close()
-    rc = cpio_p.wait()
-    if rc:
-        raise subprocess.CalledProcessError(rc, "cpio")
+        full_path = os.path.join(root_dir, path)
+        path_stat = os.lstat(full_path)
+        key.add_values(path, path_stat.st_mode, path_stat.st_uid,
+                       path_stat.st_gid, path_stat.st_rdev)
+        if stat.S_ISLNK(path_stat.st_mode):
+            key.add_string(os.readlink(full_path))
+        elif stat.S_ISREG(path_stat.st_mode):
+            key.add_file(full_path, path)
+    key.add_dir(skel_dir, config)
+    return key
 
 def main():
     log_parser = pld_nr_buildconf.get_logging_args_parser()
@@ -209,15 +489,46 @@ def main():
                               " of this initramfs module and write to OUTFILE"),
     parser.add_argument("--exclude", metavar="FILE",
                         help="Do not include any files listed in FILE")
-    parser.add_argument("name", metavar="NAME",
+    parser.add_argument("--deps", choices=("elf", "ld.so", "check"),
+                        default="elf",
+                        help="How to find shared libraries needed by"
+                            " executables: parse the ELF files (default),"
+                            " call ld.so in the chroot, or do both and"
+                            " report differences")
+    parser.add_argument("--deterministic", action="store_true",
+                        default=None,
+                        help="Write reproducible archive (sorted entries,"
+                            " mtimes clamped to $SOURCE_DATE_EPOCH)")
+    parser.add_argument("--pack", metavar="FILE", action="append",
+                        help="Only pack FILE into an uncompressed archive"
+                            " written to --output (may be used multiple"
+                            " times)")
+    parser.add_argument("-o", "--output", metavar="ARCHIVE",
+                        help="Archive to write in --pack mode")
+    parser.add_argument("name", metavar="NAME", nargs="?",
                         help="Name of the initramfs module."
                             " _NAME.cpi and _NAME.lst files will be written.")
     args = parser.parse_args()
-    args = parser.parse_args()
+    if args.pack:
+        if not args.output:
+            parser.error("--pack requires --output")
+        if args.name:
+            parser.error("NAME cannot be used with --pack")
+    elif args.output:
+        parser.error("--output can only be used with --pack")
+    elif not args.name:
+        parser.error("NAME is required")
     pld_nr_buildconf.setup_logging(args)
     
     config = pld_nr_buildconf.Config.get_config()
 
+    if args.deterministic is None:
+        args.deterministic = config.deterministic
+
+    if args.pack:
+        pack_files(args.output, args.pack, args.deterministic)
+        return
+
     skel_dir = os.path.abspath("../initramfs/{}.skel".format(args.name))
     root_dir = os.path.abspath("root")
     modules_dir = os.path.abspath("../modules")
@@ -226,6 +537,7 @@ def main():
     files_list_fn = os.path.abspath("../initramfs/{}.files".format(args.name))
     gic_list_fn = os.path.abspath("_{}.gen_init_cpio.list".format(args.name))
     out_lst_fn = os.path.abspath("_{0}.lst".format(args.name))
+    elf_cache_fn = os.path.abspath("elfdeps.cache")
     if args.substract_contents:
         base_full_lst_fn = os.path.abspath(args.substract_contents[0])
         base_lst_fn = os.path.abspath(args.substract_contents[1])
@@ -247,48 +559,86 @@ def main():
                                                 .format(module, module_init_fn))
 
     logger.debug("Completing file list")
-    files, globs = process_files_list(config, files_list_fn, gic_list_fn,
+    with pld_nr_buildconf.trace_phase("process_files_list"):
+        files, globs = process_files_list(config, files_list_fn, gic_list_fn,
                                                         root_dir, extra_files)
-    subprocess.check_call(["gen_init_cpio", gic_list_fn],
-                          stdout=open(out_cpio_fn, "wb"))
 
-    paths = expand_globs(config, globs)
+    with pld_nr_buildconf.trace_phase("expand_globs"):
+        paths = expand_globs(config, globs)
     files += paths
 
-    find_deps(config, paths, files, root_dir)
+    resolver = pld_nr_elfdeps.LibraryResolver(root_dir, config.bits,
+                                              elf_cache_fn)
+    with pld_nr_buildconf.trace_phase("find_deps", mode=args.deps):
+        find_deps(config, paths, files, root_dir, resolver, args.deps)
+    resolver.save_cache()
+    if deps_mismatches:
+        logger.error("ELF resolver and ld.so disagree on {} file(s)"
+                                        .format(len(deps_mismatches)))
+        sys.exit(1)
 
     paths.sort()
 
-    cpio_append(out_cpio_fn, paths)
+    cache = pld_nr_cache.get_cache(config)
+    if cache:
+        with pld_nr_buildconf.trace_phase("cache_key"):
+            key = initramfs_cache_key(config, args.name, gic_list_fn, paths,
+                                      root_dir, skel_dir, args.deterministic)
+        cached = cache.fetch(key, [out_cpio_fn, out_lst_fn])
+    else:
+        cached = False
 
-    if os.path.exists(built_skel_dir):
-        shutil.rmtree(built_skel_dir)
-    os.makedirs(built_skel_dir)
-    try:
-        config.copy_template_dir(skel_dir, built_skel_dir)
-        os.chdir(built_skel_dir)
-        built_paths = []
-        for dirpath, dirnames, filenames in os.walk("."):
-            dirpath = dirpath[2:] # strip "./"
-            for dirname in dirnames:
-                path = os.path.join(dirpath, dirname)
-                built_paths.append(path)
-            for filename in filenames:
-                path = os.path.join(dirpath, filename)
-                built_paths.append(path)
-        if os.path.exists("init"):
-            os.chmod("init", 0o755)
-        cpio_append(out_cpio_fn, built_paths)
-    finally:
-        os.chdir(root_dir)
-        shutil.rmtree(built_skel_dir)
-
-    with open(out_lst_fn, "wt") as init_lst:
-        for path in sorted(set(paths) | set(files) | set(built_paths)):
-            print(path, file=init_lst)
-
-    os.chdir(os.path.dirname(out_lst_fn))
-    cpio_append(out_cpio_fn, [os.path.basename(out_lst_fn)])
+    if not cached:
+        if os.path.exists(built_skel_dir):
+            shutil.rmtree(built_skel_dir)
+        os.makedirs(built_skel_dir)
+        try:
+            config.copy_template_dir(skel_dir, built_skel_dir)
+            built_paths = []
+            for dirpath, dirnames, filenames in os.walk(built_skel_dir):
+                dirpath = os.path.relpath(dirpath, built_skel_dir)
+                if dirpath == ".":
+                    dirpath = ""
+                for dirname in dirnames:
+                    path = os.path.join(dirpath, dirname)
+                    built_paths.append(path)
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    built_paths.append(path)
+            init_fn = os.path.join(built_skel_dir, "init")
+            if os.path.exists(init_fn):
+                os.chmod(init_fn, 0o755)
+
+            with open(out_lst_fn, "wt") as init_lst:
+                for path in sorted(set(paths) | set(files)
+                                                    | set(built_paths)):
+                    print(path, file=init_lst)
+
+            logger.debug("writing {0!r}".format(out_cpio_fn))
+            spec = config.get_compression("initramfs")
+            compressor = spec.get_compressor()
+            try:
+                with open(out_cpio_fn, "wb") as out_f, \
+                        pld_nr_buildconf.trace_phase("write_archive",
+                                compression=config.initramfs_compression):
+                    writer = CpioWriter(out_f, compressor,
+                                        args.deterministic)
+                    writer.add_rules_file(gic_list_fn)
+                    writer.add_paths(paths, root_dir)
+                    writer.add_paths(built_paths, built_skel_dir,
+                                     owner=(0, 0))
+                    writer.add_paths([os.path.basename(out_lst_fn)],
+                                     os.path.dirname(out_lst_fn), owner=(0, 0))
+                    writer.close()
+            except:
+                if os.path.exists(out_cpio_fn):
+                    os.unlink(out_cpio_fn)
+                raise
+        finally:
+            os.chdir(root_dir)
+            shutil.rmtree(built_skel_dir)
+        if cache:
+            cache.store(key, [out_cpio_fn, out_lst_fn])
 
     if args.substract_contents:
         base_all_paths = set(l.rstrip() for l in
@@ -299,16 +649,10 @@ def main():
             for path in base_paths:
                 print(path, file=base_lst)
 
-    logger.debug("compressing {0!r}".format(out_cpio_fn))
-    subprocess.check_call(config.compress_cmd + ["-f", out_cpio_fn])
-    compressed_fn = out_cpio_fn + config.compressed_ext
-    logger.debug("renaming {0!r} to {1!r}".format(compressed_fn, out_cpio_fn))
-    os.rename(compressed_fn, out_cpio_fn)
-
 if __name__ == "__main__":
     try:
         main()
-    except subprocess.CalledProcessError as err:
+    except (subprocess.CalledProcessError, ValueError) as err:
         logger.error(str(err))
         sys.exit(1)
 
@@ -14,17 +14,11 @@ from glob import glob
 from hashlib import md5
 
 import pld_nr_buildconf
+import pld_nr_iso
+import fix_gpt
 
 logger = logging.getLogger("make_iso_img")
 
-# Report layout: xt , Startlba ,   Blocks , Filesize , ISO image path
-HDBOOT_LBA_RE = re.compile(br"File data lba:"
-                            br"\s*(?P<xt>\d+)\s*,"
-                            br"\s*(?P<start_lba>\d+)\s*,"
-                            br"\s*(?P<blocks>\d+)\s*,"
-                            br"\s*(?P<filesize>\d+)\s*,"
-                            br"\s*'/boot/boot.img'\s*")
-
 # grub/i286/pc/boot.h
 GRUB_BOOT_MACHINE_DRIVE_CHECK = 0x66
 GRUB_BOOT_MACHINE_BPB_START = 0x3
@@ -37,21 +31,19 @@ GRUB_BOOT_MACHINE_LIST_SIZE = 12
 
 GRUB_BLOCK_LIST = 0x200 - GRUB_BOOT_MACHINE_LIST_SIZE
 
-def patch_image_mbr(config, image):
-    lba_report = subprocess.check_output(["xorriso",
-                                        "-dev", image,
-                                        "-find", "/boot/boot.img",
-                                            "-exec", "report_lba"])
-    match = HDBOOT_LBA_RE.search(lba_report)
-    if not match:
-        logger.error("Could not find /boot/boot.img LBA")
+def patch_image_mbr(iso, image):
+    """Make GRUB MBR of the `image` (mmap) load the core image
+    from /boot/boot.img."""
+    boot_img = iso.lookup("/boot/boot.img")
+    if not boot_img:
+        logger.error("Could not find /boot/boot.img in the image")
         sys.exit(1)
-    start_lba = int(match.group("start_lba"))
-    blocks = int(match.group("blocks"))
-    filesize = int(match.group("filesize"))
-    logger.info("/boot/boot.img start CD LBA: {} blocks: {} bytes: {}"
-                                        .format(start_lba, blocks, filesize))
-    start_sector = start_lba * 4
+    start_offset = boot_img.offset
+    filesize = boot_img.size
+    logger.info("/boot/boot.img start CD LBA: {} bytes: {}"
+                    .format(start_offset // pld_nr_iso.ISO_BLOCK_SIZE,
+                            filesize))
+    start_sector = start_offset // 512
     if filesize & 0x1ff:
         sectors = (filesize >> 9) + 1
     else:
@@ -59,64 +51,75 @@ def patch_image_mbr(config, image):
     logger.info("/boot/boot.img start HD LBA: {} sectors: {}"
                                         .format(start_sector, sectors))
 
-    with open(image, "r+b") as image_f:
-        image_f.seek(0)
-        buf = bytearray(512)
-        image_f.readinto(buf)
-
-        if b"GRUB" not in buf:
-            logger.error("GRUB not found in MBR")
-            sys.exit(1)
-        if not buf.endswith(b"\x55\xaa"):
-            logger.error("The first 512 bytes of the image do not look like"
-                                                                    " an MBR")
-            sys.exit(1)
-
-        cur_boot_drive = buf[GRUB_BOOT_MACHINE_BOOT_DRIVE]
-        logger.debug("Current BIOS boot drive: {:0x}".format(cur_boot_drive))
-        cur_kernel_sector = struct.unpack("q", 
-                                buf[GRUB_BOOT_MACHINE_KERNEL_SECTOR
-                                    :GRUB_BOOT_MACHINE_KERNEL_SECTOR+8])[0]
-        logger.debug("Current kernel sector: {:0x}".format(cur_kernel_sector))
-
-        logger.debug("Looking for GRUB core image start...")
-        for i in (1, 4, 8):
-            image_f.seek((start_sector + i) * 512)
-            data = image_f.read(2)
-            if data == b"RV":
-                logger.debug("  found at offset {} sectors".format(i))
-                core_offset = i
-                break
-        else:
-            logger.debug("  not found. Assumming 1 sector offser")
-            core_offset = 1
-
-        logger.info("Patching GRUBs MBR")
-
-        # set the address of the kernel
-        buf[GRUB_BOOT_MACHINE_KERNEL_SECTOR:GRUB_BOOT_MACHINE_KERNEL_SECTOR+8
-                ] = struct.pack("q", start_sector + core_offset)
-        image_f.seek(0)
-        image_f.write(buf)
-
-        # enable drive check logic
-        buf[GRUB_BOOT_MACHINE_DRIVE_CHECK:GRUB_BOOT_MACHINE_DRIVE_CHECK + 2
-                ] = b"\x90\x90"
-        
-        image_f.seek((start_sector + core_offset) * 512)
-        image_f.readinto(buf)
-
-        buf[GRUB_BLOCK_LIST:GRUB_BLOCK_LIST+10] = struct.pack("qh",
-                                                start_sector + core_offset + 1,
-                                                sectors - core_offset - 1)
-        image_f.seek((start_sector + core_offset) * 512)
-        image_f.write(buf)
+    buf = bytearray(image[0:512])
+
+    if b"GRUB" not in buf:
+        logger.error("GRUB not found in MBR")
+        sys.exit(1)
+    if not buf.endswith(b"\x55\xaa"):
+        logger.error("The first 512 bytes of the image do not look like"
+                                                                " an MBR")
+        sys.exit(1)
+
+    cur_boot_drive = buf[GRUB_BOOT_MACHINE_BOOT_DRIVE]
+    logger.debug("Current BIOS boot drive: {:0x}".format(cur_boot_drive))
+    cur_kernel_sector = struct.unpack("q", 
+                            buf[GRUB_BOOT_MACHINE_KERNEL_SECTOR
+                                :GRUB_BOOT_MACHINE_KERNEL_SECTOR+8])[0]
+    logger.debug("Current kernel sector: {:0x}".format(cur_kernel_sector))
+
+    logger.debug("Looking for GRUB core image start...")
+    for i in (1, 4, 8):
+        offset = (start_sector + i) * 512
+        if image[offset:offset + 2] == b"RV":
+            logger.debug("  found at offset {} sectors".format(i))
+            core_offset = i
+            break
+    else:
+        logger.debug("  not found. Assumming 1 sector offser")
+        core_offset = 1
+
+    logger.info("Patching GRUBs MBR")
+
+    # set the address of the kernel
+    buf[GRUB_BOOT_MACHINE_KERNEL_SECTOR:GRUB_BOOT_MACHINE_KERNEL_SECTOR+8
+            ] = struct.pack("q", start_sector + core_offset)
+    image[0:512] = buf
+
+    core_start = (start_sector + core_offset) * 512
+    buf = bytearray(image[core_start:core_start + 512])
+    buf[GRUB_BLOCK_LIST:GRUB_BLOCK_LIST+10] = struct.pack("qh",
+                                            start_sector + core_offset + 1,
+                                            sectors - core_offset - 1)
+    image[core_start:core_start + 512] = buf
+
+def postprocess_image(config, image_fn):
+    """Patch MBR, write the module manifest and fix GPT of the image,
+    all on a single memory mapping."""
+    pld_nr_prefix = "pld-nr-{}".format(config.bits)
+    with open(image_fn, "r+b") as image_f:
+        image_size = fix_gpt.get_image_size(image_f, image_fn)
+        image = fix_gpt.map_image(image_f, image_size, write=True)
+        try:
+            iso = pld_nr_iso.ISO9660(image)
+            if config.bios and "i386-pc" in config.grub_platforms:
+                patch_image_mbr(iso, image)
+            pld_nr_iso.write_manifest(iso, pld_nr_prefix)
+            try:
+                fix_gpt.fix_gpt(image, image_size)
+            except fix_gpt.GPTError as err:
+                if config.efi:
+                    raise
+                logger.debug("No GPT to fix: {}".format(err))
+            image.flush()
+        finally:
+            image.close()
 
 def write_netenv_file(netenv_fn, net_files):
-    subprocess.check_call(["grub-editenv", netenv_fn, "create"])
-    subprocess.check_call(["grub-editenv", netenv_fn,
+    pld_nr_buildconf.traced_check_call(["grub-editenv", netenv_fn, "create"])
+    pld_nr_buildconf.traced_check_call(["grub-editenv", netenv_fn,
                                         "set", "pldnr_prefix=/pld-nr"])
-    subprocess.check_call(["grub-editenv", netenv_fn,
+    pld_nr_buildconf.traced_check_call(["grub-editenv", netenv_fn,
                                     "set", "pldnr_net_files=:{}:"
                                                 .format(":".join(net_files))])
 
@@ -136,6 +139,7 @@ def main():
     tmp_img_dir = os.path.abspath("tmp_img")
     templ_dir = os.path.abspath("../iso_templ")
     netenv_fn = os.path.abspath("pld-nr-net.env")
+    manifest_fn = os.path.abspath(pld_nr_iso.MANIFEST_NAME)
     net_files = []
     vmlinuz_fn = os.path.join(root_dir, "boot/vmlinuz")
     while os.path.islink(vmlinuz_fn):
@@ -152,7 +156,8 @@ def main():
     os.makedirs(tmp_img_dir)
     try:
         logger.debug("Copying ISO contents template")
-        config.copy_template_dir(templ_dir, tmp_img_dir)
+        with pld_nr_buildconf.trace_phase("copy_template_dir"):
+            config.copy_template_dir(templ_dir, tmp_img_dir)
 
         logger.debug("Creating the ISO image")
         command = ["xorriso",
@@ -206,6 +211,14 @@ def main():
         for mod in config.modules:
             command.append("/{0}/{1}.cpi={1}.cpi".format(pld_nr_prefix, mod))
             net_files.append("{}/{}.cpi".format(pld_nr_prefix, mod))
+        # filled in with the checksums after the image is written
+        with open(manifest_fn, "wb") as manifest_f:
+            manifest_f.write(pld_nr_iso.manifest_placeholder(
+                                            config.initramfs_files
+                                            + config.module_files))
+        command.append("/{0}/{1}={2}".format(pld_nr_prefix,
+                                             pld_nr_iso.MANIFEST_NAME,
+                                             manifest_fn))
         command.append("/{}/vmlinuz={}".format(pld_nr_prefix, vmlinuz_fn))
         net_files.append("{}/vmlinuz".format(pld_nr_prefix))
         if config.efi:
@@ -224,17 +237,23 @@ def main():
             command.append("/boot/pld-nr-net.env={}".format(netenv_fn))
         command.append("--")
 
-        subprocess.check_call(command)
-        
-        if config.bios and "i386-pc" in config.grub_platforms:
-            patch_image_mbr(config, args.destination)
+        pld_nr_buildconf.traced_check_call(command)
+
+        postprocess_image(config, args.destination)
+    except:
+        if os.path.exists(args.destination):
+            os.unlink(args.destination)
+        raise
     finally:
         shutil.rmtree(tmp_img_dir)
+        if os.path.exists(manifest_fn):
+            os.unlink(manifest_fn)
 
 if __name__ == "__main__":
     try:
         main()
-    except subprocess.CalledProcessError as err:
+    except (subprocess.CalledProcessError, pld_nr_iso.ISOError,
+            fix_gpt.GPTError) as err:
         logger.error(str(err))
         sys.exit(1)
 
@@ -8,73 +8,250 @@ import shutil
 import re
 import stat
 import uuid
+import time
 import logging
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import pld_nr_buildconf
+import pld_nr_cache
 
 logger = logging.getLogger("make_module")
 
+class ModuleBuild(object):
+    """Single module squashfs build."""
+    def __init__(self, name, farm_dir):
+        self.name = name
+        self.lst_fn = "{0}.lst".format(name)
+        self.squashfs_fn = "{0}.sqf".format(name)
+        self.farm_dir = os.path.join(farm_dir, name)
+        self.paths = []
+        self.bytes = 0
+        self.processors = 1
+        self.wall_time = None
+        self.squashfs_size = None
+        self.cached = False
+
+    def load_paths(self, tree):
+        """Select paths of this module present in the `tree`
+        (path -> (type, size, metadata) mapping)."""
+        module_files = set(l.rstrip() for l in open(self.lst_fn, "rt"))
+        module_dirs = set()
+        for path in module_files:
+            while "/" in path:
+                path = path.rsplit("/", 1)[0]
+                module_dirs.add(path)
+        paths = set()
+        for path in module_files | module_dirs:
+            info = tree.get(path)
+            if info is None:
+                continue
+            paths.add(path)
+            if info[0] == "f":
+                self.bytes += info[1]
+        # parent directories must go first
+        self.paths = sorted(paths)
+
+    @property
+    def ratio(self):
+        if not self.bytes or self.squashfs_size is None:
+            return None
+        return self.squashfs_size / self.bytes
+
+def scan_tree(config, root_dir):
+    """Return path -> (type, size, metadata) mapping of all files
+    in `root_dir`.
+
+    Metadata is a string with size, mode, ownership and symlink target
+    (everything but mtime), suitable for a cache key."""
+    logger.debug("Getting list of all files in {!r}".format(root_dir))
+    output = pld_nr_buildconf.traced_check_output(config.c_sudo + [
+                                        "find", root_dir,
+                                        "-mindepth", "1",
+                                        "-printf",
+                                        r"%y %s %m %U %G\0%P\0%l\0"])
+    result = {}
+    items = output.split(b"\000")
+    for i in range(0, len(items) - 2, 3):
+        info, path, link = (x.decode("utf-8") for x in items[i:i+3])
+        path_type, size = info.split(" ", 2)[:2]
+        result[path] = (path_type, int(size), info + " " + link)
+    return result
+
+def module_cache_key(config, root_dir, module, tree):
+    """Compute cache key of a module squashfs from file metadata
+    and contents."""
+    key = pld_nr_cache.CacheKey("squashfs")
+    spec = config.get_compression("squashfs")
+    # the number of threads does not change the image
+    key.add_values(spec.name, spec.level, spec.dict, spec.block)
+    key.add_tool(["mksquashfs", "-version"])
+    files = []
+    for path in module.paths:
+        key.add_values(path, tree[path][2])
+        if tree[path][0] == "f":
+            files.append(path)
+    logger.debug("Computing checksums of {} files of {}"
+                                        .format(len(files), module.name))
+    output = pld_nr_buildconf.traced_check_output(config.c_sudo + [
+                                        "xargs", "-0", "-r",
+                                        "sha256sum", "--"],
+                            "".join(p + "\0" for p in files).encode("utf-8"),
+                            cwd=root_dir)
+    key.add_bytes(output)
+    return key
+
+def split_processors(modules, total):
+    """Share `total` CPUs between concurrent mksquashfs runs
+    proportionally to the module sizes.
+
+    Every module gets at least one CPU, the rest is split with the largest
+    remainder method, so the sum is exactly `total` (unless there are
+    more modules than CPUs)."""
+    for module in modules:
+        module.processors = 1
+    spare = total - len(modules)
+    if spare <= 0:
+        return
+    total_bytes = sum(m.bytes for m in modules)
+    if not total_bytes:
+        shares = [(spare / len(modules), m) for m in modules]
+    else:
+        shares = [(spare * m.bytes / total_bytes, m) for m in modules]
+    for share, module in shares:
+        module.processors += int(share)
+    spare -= sum(int(share) for share, module in shares)
+    shares.sort(key=lambda s: s[0] - int(s[0]), reverse=True)
+    for share, module in shares[:spare]:
+        module.processors += 1
+
+def make_link_farm(config, root_dir, module):
+    """Hard-link module files into a directory of its own, preserving
+    modes, ownership and mtimes."""
+    pld_nr_buildconf.traced_check_call(config.c_sudo + ["sh", "-c",
+                    'mkdir -p "$2" && chown --reference="$1" "$2"'
+                    ' && chmod --reference="$1" "$2"',
+                    "sh", root_dir, module.farm_dir])
+    pld_nr_buildconf.traced_check_call(config.c_sudo + [
+                                    "cpio", "--quiet", "-pdml",
+                                    module.farm_dir],
+                        "".join(p + "\n" for p in module.paths)
+                                                        .encode("utf-8"),
+                        cwd=root_dir)
+    pld_nr_buildconf.traced_check_call(config.c_sudo + [
+                                    "touch", "--reference", root_dir,
+                                    module.farm_dir])
+
+def build_module(config, root_dir, module, cache=None, key=None):
+    start = time.time()
+    if os.path.exists(module.squashfs_fn):
+        os.unlink(module.squashfs_fn)
+    if cache and cache.fetch(key, [module.squashfs_fn]):
+        module.cached = True
+        module.wall_time = time.time() - start
+        module.squashfs_size = os.stat(module.squashfs_fn).st_size
+        return module
+    try:
+        with pld_nr_buildconf.trace_phase("link_farm", module=module.name):
+            make_link_farm(config, root_dir, module)
+        logger.debug("Calling mksquashfs for {} ({} processors)"
+                                    .format(module.name, module.processors))
+        pld_nr_buildconf.traced_check_call(config.c_sudo + [
+                                "mksquashfs", module.farm_dir + "/",
+                                module.squashfs_fn,
+                                "-processors", str(module.processors),
+                                "-no-progress"]
+                                + config.get_compression("squashfs")
+                                                        .squashfs_args())
+        if os.getuid() != 0:
+            pld_nr_buildconf.traced_check_call(config.c_sudo + [
+                                "chown", "{}:{}".format(os.getuid(),
+                                                        os.getgid()),
+                                                module.squashfs_fn])
+    except:
+        if os.path.exists(module.squashfs_fn):
+            os.unlink(module.squashfs_fn)
+        raise
+    finally:
+        pld_nr_buildconf.traced_call(config.c_sudo + ["rm", "-rf",
+                                                      "--one-file-system",
+                                                      module.farm_dir])
+    module.wall_time = time.time() - start
+    module.squashfs_size = os.stat(module.squashfs_fn).st_size
+    if cache:
+        cache.store(key, [module.squashfs_fn])
+    return module
+
 def main():
     log_parser = pld_nr_buildconf.get_logging_args_parser()
-    parser = argparse.ArgumentParser(description="Make PLD NR module",
+    parser = argparse.ArgumentParser(description="Make PLD NR modules",
                                      parents=[log_parser])
-    parser.add_argument("module", action="store",
+    parser.add_argument("--processors", type=int,
+                        help="Total number of CPUs to use for compression"
+                            " (default: 'threads' of squashfs_compression"
+                            " or all CPUs)")
+    parser.add_argument("module", action="store", nargs="+",
                         help="Module name")
     args = parser.parse_args()
     pld_nr_buildconf.setup_logging(args)
-    
+
     config = pld_nr_buildconf.Config.get_config()
 
-    lst_fn = "{0}.lst".format(args.module)
-    exclude_fn = "{0}.exclude".format(args.module)
-    squashfs_fn = "{0}.sqf".format(args.module)
-
-    if os.path.exists(squashfs_fn):
-        os.unlink(squashfs_fn)
-
-    logger.debug("Getting list of all files in 'root'")
-    find_p = subprocess.Popen(config.c_sudo + ["find", "root"],
-                                stdout=subprocess.PIPE)
-    all_files = [l.strip(b"root/").decode("utf-8").rstrip()
-                                        for l in find_p.stdout.readlines()]
-    find_p.stdout.close()
-    rc = find_p.wait()
-    if rc:
-        raise CalledProcessError(rc, ["find", "root"])
-
-    all_files = set(f for f in all_files if f)
-
-    module_files = set(l.rstrip() for l in open(lst_fn, "rt").readlines())
-    module_dirs = set()
-    for path in module_files:
-        while "/" in path:
-            path = path.rsplit("/", 1)[0]
-            module_dirs.add(path)
-    
-    logger.debug("Building the exclude file")
-    excludes = all_files - module_files - module_dirs
-    excludes = sorted(excludes)
-    while excludes and not excludes[0]:
-        # squashfs hates empty paths
-        excludes = excludes[1:]
-    with open(exclude_fn, "wt") as exclude_f:
-        exclude_f.writelines(e + "\n" for e in sorted(excludes))
+    root_dir = os.path.abspath("root")
+    # separate for each run, in case more are started in parallel
+    farm_dir = os.path.abspath("module_farm.{}".format(os.getpid()))
 
-    try:
-        logger.debug("Calling mksquashfs")
-        subprocess.check_call(config.c_sudo + [
-                                "mksquashfs", "root/", squashfs_fn,
-                                "-comp", config.compression,
-                                "-ef", exclude_fn])
-        if os.getuid() != 0:
-            subprocess.check_call(config.c_sudo + [
-                                "chown", "{}:{}".format(os.getuid(),
-                                                        os.getgid()),
-                                                squashfs_fn])
-    except:
-        if os.path.exists(squashfs_fn):
-            os.unlink(squashfs_fn)
+    with pld_nr_buildconf.trace_phase("scan_tree"):
+        tree = scan_tree(config, root_dir)
+
+    modules = [ModuleBuild(name, farm_dir) for name in args.module]
+    for module in modules:
+        module.load_paths(tree)
+
+    cache = pld_nr_cache.get_cache(config)
+    keys = {}
+    if cache:
+        for module in modules:
+            with pld_nr_buildconf.trace_phase("cache_key",
+                                              module=module.name):
+                keys[module.name] = module_cache_key(config, root_dir,
+                                                     module, tree)
+    del tree
+
+    if args.processors is None:
+        spec = config.get_compression("squashfs")
+        if spec.threads is None:
+            args.processors = os.cpu_count()
+        else:
+            args.processors = spec.get_threads()
+    split_processors(modules, max(1, args.processors or 1))
+
+    with ThreadPoolExecutor(max_workers=len(modules)) as executor:
+        futures = [executor.submit(build_module, config, root_dir, module,
+                                   cache, keys.get(module.name))
+                                                    for module in modules]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except subprocess.CalledProcessError as err:
+                errors.append(err)
+    pld_nr_buildconf.traced_call(config.c_sudo + ["rm", "-rf",
+                                                  "--one-file-system",
+                                                  farm_dir])
+    if errors:
+        raise errors[0]
+
+    for module in modules:
+        logger.info("{}: {} files, {:.1f} MiB -> {:.1f} MiB ({:.1%}),"
+                    " {} processors, {:.1f}s{}"
+                    .format(module.name, len(module.paths),
+                            module.bytes / 1048576,
+                            module.squashfs_size / 1048576,
+                            module.ratio or 0,
+                            module.processors,
+                            module.wall_time,
+                            " (cached)" if module.cached else ""))
 
 if __name__ == "__main__":
     try:
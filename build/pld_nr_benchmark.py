@@ -0,0 +1,494 @@
+#!/usr/bin/python3
+
+"""Benchmarks of the build hot paths on a synthetic root tree.
+
+Generates a fake chroot (ELF executables and libraries with real dynamic
+sections, kernel modules with modules.dep, lots of plain files), module
+file lists and a template directory, then times the code which processes
+them: find_deps, process_files_list, expand_globs, the make_module file
+selection, config loading and Config.copy_dir substitution. No PLD
+chroot, root privileges or package tools are needed.
+
+Results may be saved with --output and compared against a previous run
+with --baseline, to catch performance regressions.
+"""
+
+import os
+import sys
+import struct
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import json
+import logging
+import argparse
+
+import pld_nr_buildconf
+import pld_nr_elfdeps
+import make_initramfs
+import make_module
+
+logger = logging.getLogger("pld_nr_benchmark")
+
+KERNEL_VER = "9.9.9-1"
+
+EM_386 = 3
+EM_X86_64 = 62
+
+ET_DYN = 3
+
+TEMPLATE = """# synthetic template {num}
+arch=@arch@
+bits=@bits@
+hostname=@hostname@
+version=@version@
+modules=@modules@
+locales=@locales@
+unknown=@not_a_config_variable@
+"""
+
+BUILD_CONF = """[config]
+arch={arch}
+modules=base,basic,rescue
+locales=en_US,pl_PL
+hostname=benchmark
+cache_dir=
+"""
+
+def make_fake_elf(bits, interp=None, needed=(), rpath=None, padding=0):
+    """Return contents of a minimal ELF shared object with program
+    headers and a dynamic section (no code)."""
+    if bits == 64:
+        ehdr_fmt = "<HHIQQQIHHHHHH"
+        phdr_fmt = "<IIQQQQQQ"
+        dyn_fmt = "<qQ"
+        elf_class = pld_nr_elfdeps.ELFCLASS64
+        machine = EM_X86_64
+    else:
+        ehdr_fmt = "<HHIIIIIHHHHHH"
+        phdr_fmt = "<IIIIIIII"
+        dyn_fmt = "<iI"
+        elf_class = pld_nr_elfdeps.ELFCLASS32
+        machine = EM_386
+    ehdr_size = 16 + struct.calcsize(ehdr_fmt)
+    phdr_size = struct.calcsize(phdr_fmt)
+
+    strtab = b"\x00"
+    dynamic = []
+    for name in needed:
+        dynamic.append((pld_nr_elfdeps.DT_NEEDED, len(strtab)))
+        strtab += name.encode("utf-8") + b"\x00"
+    if rpath:
+        dynamic.append((pld_nr_elfdeps.DT_RUNPATH, len(strtab)))
+        strtab += rpath.encode("utf-8") + b"\x00"
+    interp_data = interp.encode("utf-8") + b"\x00" if interp else b""
+
+    phnum = 2 + (1 if interp else 0)
+    interp_offset = ehdr_size + phnum * phdr_size
+    strtab_offset = interp_offset + len(interp_data)
+    dynamic_offset = strtab_offset + len(strtab)
+    dynamic_offset += -dynamic_offset % 8
+    dynamic += [(pld_nr_elfdeps.DT_STRTAB, strtab_offset),
+                (pld_nr_elfdeps.DT_STRSZ, len(strtab)),
+                (pld_nr_elfdeps.DT_NULL, 0)]
+    dynamic_data = b"".join(struct.pack(dyn_fmt, tag, val)
+                                                for tag, val in dynamic)
+    total_size = dynamic_offset + len(dynamic_data) + padding
+
+    def phdr(p_type, offset, size):
+        if bits == 64:
+            return struct.pack(phdr_fmt, p_type, 4, offset, offset, offset,
+                               size, size, 8)
+        else:
+            return struct.pack(phdr_fmt, p_type, offset, offset, offset,
+                               size, size, 4, 4)
+
+    data = b"\x7fELF" + bytes([elf_class, pld_nr_elfdeps.ELFDATA2LSB, 1])
+    data += b"\x00" * 9
+    data += struct.pack(ehdr_fmt, ET_DYN, machine, 1, 0, ehdr_size, 0, 0,
+                        ehdr_size, phdr_size, phnum, 0, 0, 0)
+    data += phdr(pld_nr_elfdeps.PT_LOAD, 0, total_size)
+    if interp:
+        data += phdr(pld_nr_elfdeps.PT_INTERP, interp_offset,
+                                                        len(interp_data))
+    data += phdr(pld_nr_elfdeps.PT_DYNAMIC, dynamic_offset,
+                                                        len(dynamic_data))
+    data += interp_data + strtab
+    data += b"\x00" * (dynamic_offset - len(data))
+    data += dynamic_data + b"\x00" * padding
+    return data
+
+class SyntheticTree(object):
+    """Generated root tree with everything the benchmarks need."""
+    def __init__(self, work_dir, num_files, bits=64, seed=0):
+        self.work_dir = work_dir
+        self.root_dir = os.path.join(work_dir, "root")
+        self.num_files = num_files
+        self.bits = bits
+        self.random = random.Random(seed)
+        if bits == 64:
+            self.lib = "lib64"
+            self.interp = "/lib64/ld-linux-x86-64.so.2"
+        else:
+            self.lib = "lib"
+            self.interp = "/lib/ld-linux.so.2"
+        self.files_list_fn = os.path.join(work_dir, "init.files")
+        self.templ_dir = os.path.join(work_dir, "templ")
+        self.modules = ["base", "basic", "rescue"]
+        self.count = 0
+
+    def _write(self, path, data=b"", mode=0o644):
+        full_path = os.path.join(self.root_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as out_f:
+            out_f.write(data)
+        os.chmod(full_path, mode)
+        self.count += 1
+
+    def _symlink(self, target, path):
+        full_path = os.path.join(self.root_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.symlink(target, full_path)
+        self.count += 1
+
+    def generate(self):
+        rnd = self.random
+        lib = self.lib
+        num_libs = max(50, self.num_files // 200)
+        num_bins = max(100, self.num_files // 20)
+        num_kmods = max(100, self.num_files // 10)
+
+        self._write(self.interp.lstrip("/"),
+                    make_fake_elf(self.bits, padding=4096), 0o755)
+        ld_name = os.path.basename(self.interp)
+        self._write(lib + "/libc-2.99.so",
+                    make_fake_elf(self.bits, self.interp, [ld_name],
+                                  padding=16384), 0o755)
+        self._symlink("libc-2.99.so", lib + "/libc.so.6")
+        self._write("etc/ld.so.conf", b"include ld.so.conf.d/*.conf\n")
+        self._write("etc/ld.so.conf.d/fake.conf",
+                    "/usr/{}/fake\n".format(lib).encode("utf-8"))
+
+        lib_names = []
+        for num in range(num_libs):
+            soname = "libfake{}.so.1".format(num)
+            if num % 2:
+                lib_dir = lib
+            else:
+                lib_dir = "usr/{}/fake".format(lib)
+            needed = ["libc.so.6"]
+            if lib_names:
+                needed += rnd.sample(lib_names, min(3, len(lib_names)))
+            self._write("{}/{}.0".format(lib_dir, soname),
+                        make_fake_elf(self.bits, None, needed,
+                                      padding=rnd.randrange(1024, 65536)),
+                        0o755)
+            self._symlink(soname + ".0", "{}/{}".format(lib_dir, soname))
+            lib_names.append(soname)
+
+        self._write("bin/sh", make_fake_elf(self.bits, self.interp,
+                                            ["libc.so.6"]), 0o755)
+        for num in range(num_bins):
+            bin_dir = "usr/sbin" if num % 5 == 0 else "usr/bin"
+            path = "{}/fakebin{}".format(bin_dir, num)
+            if num % 10 == 9:
+                self._write(path, b"#!/bin/sh\nexit 0\n", 0o755)
+                continue
+            needed = ["libc.so.6"] + rnd.sample(lib_names,
+                                                rnd.randrange(1, 7))
+            rpath = "$ORIGIN/../{}/fake".format(lib) if num % 7 == 0 else None
+            self._write(path, make_fake_elf(self.bits, self.interp, needed,
+                                            rpath,
+                                            padding=rnd.randrange(4096)),
+                        0o755)
+
+        mod_dir = "lib/modules/{}".format(KERNEL_VER)
+        kmods = []
+        deps_lines = []
+        for num in range(num_kmods):
+            path = "kernel/drivers/d{}/m{}.ko.xz".format(num % 50, num)
+            deps = rnd.sample(kmods, min(len(kmods), rnd.randrange(4)))
+            self._write(mod_dir + "/" + path, b"\xfd7zXZ\x00" + b"\x00" * 64)
+            deps_lines.append("{}: {}\n".format(path, " ".join(deps)))
+            kmods.append(path)
+        self._write(mod_dir + "/modules.dep",
+                    "".join(deps_lines).encode("utf-8"))
+
+        num = 0
+        while self.count < self.num_files:
+            self._write("usr/share/fake/d{}/f{}.txt".format(num // 100, num),
+                        b"x" * rnd.randrange(32, 4096))
+            num += 1
+
+        self._write_files_list(num_bins)
+        self._write_module_lists()
+        self._write_templates()
+
+    def _write_files_list(self, num_bins):
+        lines = ["dir /dev 0755 0 0",
+                 "nod /dev/console 0600 0 0 c 5 1",
+                 "slink /init /bin/sh 0777 0 0",
+                 "file /etc/ld.so.conf @root@/etc/ld.so.conf 0644 0 0",
+                 "* bin/sh",
+                 "* usr/sbin",
+                 "* usr/bin/fakebin1*",
+                 ]
+        for num in range(0, 50, 2):
+            lines.append("* lib/modules/{}/kernel/drivers/d{}"
+                                                .format(KERNEL_VER, num))
+        for num in range(0, num_bins, 3):
+            lines.append("file /usr/bin/fakebin{0} @root@/usr/bin/fakebin{0}"
+                         " 0755 0 0".format(num))
+        with open(self.files_list_fn, "wt") as files_f:
+            files_f.write("".join(l + "\n" for l in lines))
+
+    def _write_module_lists(self):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root_dir):
+            rel_dir = os.path.relpath(dirpath, self.root_dir)
+            for filename in filenames + [d for d in dirnames
+                    if os.path.islink(os.path.join(dirpath, d))]:
+                paths.append(os.path.normpath(os.path.join(rel_dir,
+                                                           filename)))
+        paths.sort()
+        for num, module in enumerate(self.modules):
+            lst_fn = os.path.join(self.work_dir, module + ".lst")
+            with open(lst_fn, "wt") as lst_f:
+                for path in paths[num::len(self.modules)]:
+                    print(path, file=lst_f)
+            # stale entries, missing in the tree
+            with open(lst_fn, "at") as lst_f:
+                for path in paths[num:1000:len(self.modules)]:
+                    print(path + ".missing", file=lst_f)
+
+    def _write_templates(self):
+        for num in range(max(100, self.num_files // 50)):
+            path = os.path.join(self.templ_dir, "d{}".format(num // 20))
+            os.makedirs(path, exist_ok=True)
+            if num % 2:
+                with open(os.path.join(path, "t{}.conf.pldnrt".format(num)),
+                                                            "wt") as templ_f:
+                    templ_f.write(TEMPLATE.format(num=num) * 20)
+            else:
+                with open(os.path.join(path, "f{}".format(num)),
+                                                            "wb") as plain_f:
+                    plain_f.write(b"plain file\n" * 100)
+
+class Benchmark(object):
+    """Repeatedly timed piece of code."""
+    def __init__(self, name, func, setup=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.wall_times = []
+        self.cpu_times = []
+
+    def run(self, repeat):
+        for dummy in range(repeat):
+            arg = self.setup() if self.setup else None
+            with pld_nr_buildconf.trace_phase(self.name,
+                                              category="benchmark"):
+                start = time.perf_counter()
+                start_cpu = time.process_time()
+                self.func(arg)
+                self.cpu_times.append(time.process_time() - start_cpu)
+                self.wall_times.append(time.perf_counter() - start)
+
+    def result(self):
+        wall_times = sorted(self.wall_times)
+        return {
+                "wall_min": wall_times[0],
+                "wall_median": wall_times[len(wall_times) // 2],
+                "cpu_min": min(self.cpu_times),
+                }
+
+def get_benchmarks(config, tree, work_dir):
+    root_dir = tree.root_dir
+    gic_list_fn = os.path.join(work_dir, "init.gen_init_cpio.list")
+    elf_cache_fn = os.path.join(work_dir, "elfdeps.cache")
+    farm_dir = os.path.join(work_dir, "module_farm")
+    subst_dir = os.path.join(work_dir, "subst")
+
+    os.chdir(root_dir)
+    files, globs = make_initramfs.process_files_list(config,
+                                        tree.files_list_fn, gic_list_fn,
+                                        root_dir, [])
+    paths = make_initramfs.expand_globs(config, globs)
+    warm_resolver = pld_nr_elfdeps.LibraryResolver(root_dir, config.bits,
+                                                   elf_cache_fn)
+    make_initramfs.find_deps(config, list(paths), files + paths, root_dir,
+                             warm_resolver)
+    warm_resolver.save_cache()
+    logger.info("Initramfs selection: {} globs, {} paths"
+                                            .format(len(globs), len(paths)))
+
+    def process_files_list(arg):
+        make_initramfs.process_files_list(config, tree.files_list_fn,
+                                          gic_list_fn, root_dir, [])
+
+    def expand_globs(arg):
+        make_initramfs.expand_globs(config, globs)
+
+    def find_deps_setup():
+        make_initramfs.modules_dep.clear()
+        return list(paths), files + paths
+
+    def find_deps_cold(arg):
+        resolver = pld_nr_elfdeps.LibraryResolver(root_dir, config.bits)
+        make_initramfs.find_deps(config, arg[0], arg[1], root_dir, resolver)
+
+    def find_deps_warm(arg):
+        resolver = pld_nr_elfdeps.LibraryResolver(root_dir, config.bits,
+                                                  elf_cache_fn)
+        make_initramfs.find_deps(config, arg[0], arg[1], root_dir, resolver)
+
+    def module_selection(arg):
+        tree_info = make_module.scan_tree(config, root_dir)
+        old_pwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            modules = [make_module.ModuleBuild(name, farm_dir)
+                                                for name in tree.modules]
+            for module in modules:
+                module.load_paths(tree_info)
+            make_module.split_processors(modules, 8)
+        finally:
+            os.chdir(old_pwd)
+
+    config.save_snapshot()
+
+    def config_parse(arg):
+        pld_nr_buildconf.Config(config.config_file, config.build_dir)
+
+    def config_snapshot(arg):
+        if not pld_nr_buildconf.Config.load_snapshot(config.config_file,
+                                                     config.build_dir):
+            raise RuntimeError("Config snapshot not loaded")
+
+    def copy_dir_setup():
+        if os.path.exists(subst_dir):
+            shutil.rmtree(subst_dir)
+        os.makedirs(subst_dir)
+
+    def copy_dir(arg):
+        config.copy_template_dir(tree.templ_dir, subst_dir)
+
+    return [
+            Benchmark("process_files_list", process_files_list),
+            Benchmark("expand_globs", expand_globs),
+            Benchmark("find_deps (cold)", find_deps_cold, find_deps_setup),
+            Benchmark("find_deps (ELF cache)", find_deps_warm,
+                                                        find_deps_setup),
+            Benchmark("module selection", module_selection),
+            Benchmark("config parse", config_parse),
+            Benchmark("config snapshot load", config_snapshot),
+            Benchmark("copy_dir substitution", copy_dir, copy_dir_setup),
+            ]
+
+def compare_results(results, baseline, tolerance):
+    """Report benchmarks slower than `baseline` by more than `tolerance`.
+
+    Return number of regressions."""
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["wall_min"]
+        new = result["wall_min"]
+        if old > 0 and new > old * (1 + tolerance):
+            logger.error("{}: {:.3f}s -> {:.3f}s ({:+.0%})"
+                                .format(name, old, new, new / old - 1))
+            regressions += 1
+    return regressions
+
+def main():
+    log_parser = pld_nr_buildconf.get_logging_args_parser()
+    parser = argparse.ArgumentParser(
+                        description="Benchmark build hot paths on a"
+                                    " synthetic root tree",
+                        parents=[log_parser])
+    parser.add_argument("--files", type=int, default=40000,
+                        help="Number of files in the tree (default: 40000)")
+    parser.add_argument("--bits", type=int, choices=(32, 64), default=64,
+                        help="Architecture of the fake ELF files")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each benchmark")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the tree generator")
+    parser.add_argument("--work-dir", metavar="DIR",
+                        help="Where to generate the tree"
+                                " (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true",
+                        help="Do not remove the generated tree")
+    parser.add_argument("--output", metavar="FILE",
+                        help="Save results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="Compare results with a previous --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline"
+                                                        " (default: 0.2)")
+    args = parser.parse_args()
+    pld_nr_buildconf.setup_logging(args)
+
+    if args.work_dir:
+        work_dir = os.path.abspath(args.work_dir)
+        os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="pld-nr-benchmark-")
+    old_pwd = os.getcwd()
+    try:
+        conf_fn = os.path.join(work_dir, "build.conf")
+        with open(conf_fn, "wt") as conf_f:
+            arch = "x86_64" if args.bits == 64 else "i686"
+            conf_f.write(BUILD_CONF.format(arch=arch))
+        os.chdir(work_dir)
+        config = pld_nr_buildconf.Config(conf_fn, work_dir)
+        # the synthetic tree is ours
+        config.c_sudo = []
+
+        logger.info("Generating {} files in {!r}".format(args.files,
+                                                         work_dir))
+        start = time.time()
+        tree = SyntheticTree(work_dir, args.files, args.bits, args.seed)
+        with pld_nr_buildconf.trace_phase("generate tree"):
+            tree.generate()
+        logger.info("Tree generated in {:.1f}s".format(time.time() - start))
+
+        results = {}
+        for benchmark in get_benchmarks(config, tree, work_dir):
+            benchmark.run(args.repeat)
+            results[benchmark.name] = benchmark.result()
+            logger.info("{:24} min {:8.3f}s  median {:8.3f}s  cpu {:8.3f}s"
+                        .format(benchmark.name,
+                                results[benchmark.name]["wall_min"],
+                                results[benchmark.name]["wall_median"],
+                                results[benchmark.name]["cpu_min"]))
+    finally:
+        os.chdir(old_pwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "wt") as out_f:
+            json.dump({"files": args.files, "bits": args.bits,
+                       "results": results}, out_f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, "rt") as base_f:
+            baseline = json.load(base_f)
+        if baseline.get("files") != args.files:
+            logger.warning("Baseline was run with {} files"
+                                            .format(baseline.get("files")))
+        if compare_results(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (subprocess.CalledProcessError,
+            pld_nr_buildconf.ConfigError) as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+# vi: sts=4 sw=4 et
@@ -2,21 +2,24 @@
 
 import os
 import sys
-import configparser
 import subprocess
 import logging
 import re
 import argparse
 import shutil
 import locale
-import crypt
 import uuid
-import tempfile
 import shlex
+import json
+import time
+import atexit
+import resource
+import threading
 
-from hashlib import md5
+from hashlib import md5, sha256
 from datetime import datetime
 from collections import OrderedDict
+from contextlib import contextmanager
 
 logger = logging.getLogger("pld_nr_buildconf")
 
@@ -29,6 +32,9 @@ LOCALE_RE = re.compile("^[a-z]+_[A-Z]+$")
 GRUB_VERSION_RE = re.compile(r"\(GRUB\)\s+2\.\d+")
 RPM_VERSION_RE = re.compile(r"\(RPM\)\s+5.\d+(.\d+)*")
 
+SIZE_RE = re.compile(r"^\s*(\d+)\s*([kKmMgGtT]?)[iI]?[bB]?\s*$")
+SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
 ARCH_EFI_TO_GRUB = { "ia32": "i386", "x64": "x86_64" }
 
 NET_IMAGES = {
@@ -37,6 +43,12 @@ NET_IMAGES = {
         "x86_64-efi": "net_x64.efi",
         }
 
+SUBST_VAR_RE = re.compile(br"@(\w+)@")
+
+# bump when the snapshot contents or key computation change
+SNAPSHOT_VERSION = 3
+SNAPSHOT_FILENAME = "config.snapshot"
+
 def _get_default_arch():
     result = os.environ.get("ARCH")
     if result:
@@ -44,7 +56,7 @@ def _get_default_arch():
     try:
         result = subprocess.check_output(["rpm", "--eval", "%{_arch}"])
         result = result.decode("us-ascii").strip()
-    except CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         return "i686"
     if X86_RE.match(result):
         result = "i686" # make the image compatible with old hardware
@@ -53,6 +65,13 @@ def _get_default_arch():
 class ConfigError(Exception):
     pass
 
+def parse_size(value):
+    """Parse size like '20G' or '512M' to bytes."""
+    match = SIZE_RE.match(value)
+    if not match:
+        raise ValueError("Invalid size: {!r}".format(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
 def _check_tool(tool, description=None, args=["--version"],
                 get_output=False, ignore_error=False, quiet=False,
                 package=None):
@@ -91,9 +110,134 @@ def _check_tool_version(command, regexp, package=None):
         raise ConfigError("Usupported {0!r} version: {1!r}"
                                                 .format(command, ver))
 
+def _check_squashfs_compressor(name):
+    """Check if mksquashfs supports the `name` compressor."""
+    try:
+        # the compressor list goes to stderr, with non-zero exit status
+        # in some versions
+        output = subprocess.run(["mksquashfs", "-help"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT).stdout
+    except OSError as err:
+        raise ConfigError("'mksquashfs' (from the 'squashfs' package)"
+                                        " cannot be executed: {}".format(err))
+    output = output.decode("utf-8", "replace")
+    if "Compressors available" not in output:
+        logger.warning("Cannot check mksquashfs compressors")
+        return
+    compressors = output.split("Compressors available", 1)[1]
+    if not re.search(r"^\s+{}(\s+\(default\))?\s*$".format(re.escape(name)),
+                     compressors, re.MULTILINE):
+        raise ConfigError("mksquashfs does not support {!r} compression"
+                                                                .format(name))
+
+def _stat_key(path):
+    """Return [mtime, size] of `path` or None if it does not exist."""
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return None
+    return [path_stat.st_mtime_ns, path_stat.st_size]
+
+def _file_digest(path):
+    try:
+        with open(path, "rb") as data_f:
+            return sha256(data_f.read()).hexdigest()
+    except IOError:
+        return None
+
+def _git_state(git_dir):
+    """Return HEAD, the commit it points to, the tags, the index state and
+    the working tree changes (what 'git describe --dirty' depends on)."""
+    try:
+        with open(os.path.join(git_dir, "HEAD"), "rt") as head_f:
+            head = head_f.read().strip()
+    except IOError:
+        return None
+    result = [head]
+    if head.startswith("ref:"):
+        ref = head[4:].strip()
+        result.append(_file_digest(os.path.join(git_dir, ref)))
+        result.append(_stat_key(os.path.join(git_dir, "packed-refs")))
+    # loose tags are added, moved (renamed into place) and deleted
+    # in this directory
+    result.append(_stat_key(os.path.join(git_dir, "refs", "tags")))
+    result.append(_stat_key(os.path.join(git_dir, "index")))
+    try:
+        # untracked files do not make the tree '-dirty'
+        status = subprocess.check_output(["git", "status", "--porcelain",
+                                          "--untracked-files=no"],
+                                         cwd=os.path.dirname(git_dir),
+                                         stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, OSError):
+        status = None
+    result.append(sha256(status).hexdigest() if status is not None
+                                                                else None)
+    return result
+
+def _dir_state(path):
+    """Return names and mtimes of `path` subdirectories (mtime of
+    a directory changes when files are added or removed)."""
+    try:
+        return [[entry.name, entry.stat().st_mtime_ns]
+                    for entry in sorted(os.scandir(path),
+                                        key=lambda e: e.name)]
+    except OSError:
+        return None
+
+def _get_snapshot_key(filename, build_dir):
+    """Return everything the resolved config depends on."""
+    git_dir = os.path.abspath("../.git")
+    key = OrderedDict()
+    key["version"] = SNAPSHOT_VERSION
+    key["python"] = sys.version
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    key["code"] = [_stat_key(os.path.join(code_dir, name))
+                   for name in ("pld_nr_buildconf.py", "pld_nr_compress.py")]
+    key["filename"] = filename
+    key["build.conf"] = _file_digest(filename)
+    key["uuids"] = _stat_key(os.path.join(build_dir, "uuids"))
+    key["git_dir"] = git_dir
+    key["git"] = _git_state(git_dir)
+    key["grub"] = _dir_state("/lib/grub")
+    key["ARCH"] = os.environ.get("ARCH", "")
+    key["uid"] = os.getuid()
+    # normalize to what comes back from JSON
+    return json.loads(json.dumps(key))
+
+class TemplateSubstitution(object):
+    """Precompiled substitution of @var@ strings.
+
+    Variable values are encoded once, so a single instance may be cheaply
+    applied to any number of templates."""
+    def __init__(self, config_vars):
+        self.values = {}
+        for key, value in config_vars.items():
+            if value is None:
+                continue
+            self.values[key.encode("utf-8")] = str(value).encode("utf-8")
+
+    def _repl(self, match):
+        return self.values.get(match.group(1), match.group(0))
+
+    def __call__(self, data):
+        if b"@" not in data:
+            return data
+        return SUBST_VAR_RE.sub(self._repl, data)
+
+    @staticmethod
+    def used_vars(data):
+        """Return names of the variables referenced in `data`."""
+        return set(m.decode("utf-8") for m in SUBST_VAR_RE.findall(data))
+
 class Config(object):
     _instance = None
     def __init__(self, filename, build_dir=None):
+        # not needed when the config is loaded from a snapshot
+        import configparser
+        import pld_nr_compress
+        self._substitution = None
+        self.config_file = filename
         self._parsed = configparser.ConfigParser()
         try:
             self._parsed.read(filename)
@@ -127,19 +271,48 @@ class Config(object):
         self.initramfs_files = ["_init.cpi"]
 
         self.compression = self._config.get("compression", fallback="xz")
-        self.compress_cmd = [self.compression]
-        if self.compression == "xz":
-            self.compress_cmd += ["--check=crc32"]
-
-        if self.compression == "gzip":
-            self.compressed_ext = ".gz"
-        else:
-            self.compressed_ext = ".{0}".format(self.compression)
         self.compression_level =  self._config.get("compression_level",
                                                    fallback=None)
         if self.compression_level:
             self.compression_level = int(self.compression_level)
-            self.compress_cmd.append("-{0}".format(self.compression_level))
+        else:
+            self.compression_level = None
+        default_spec = self.compression
+        if self.compression_level is not None:
+            default_spec += ":level={}".format(self.compression_level)
+        for target in ("initramfs", "squashfs"):
+            value = self._config.get(target + "_compression")
+            if not value:
+                # compression_level applied only to the initramfs
+                value = default_spec if target == "initramfs" \
+                                                    else self.compression
+            try:
+                spec = pld_nr_compress.CompressionSpec.parse(value, target)
+            except ValueError as err:
+                raise ConfigError("Bad {}_compression: {}".format(target,
+                                                                    err))
+            setattr(self, target + "_compression", str(spec))
+            if target == "initramfs":
+                self.compression = spec.name
+                self.compression_level = spec.level
+                self.compress_cmd = spec.compress_command()
+                self.compressed_ext = spec.ext
+
+        self.deterministic = self._config.getboolean("deterministic",
+                                                     fallback=False)
+
+        self.batch_install = self._config.getboolean("batch_install",
+                                                     fallback=False)
+
+        self.cache_dir = self._config.get("cache_dir",
+                                    fallback="~/.cache/pld-new-rescue")
+        if self.cache_dir:
+            self.cache_dir = os.path.expanduser(self.cache_dir)
+        cache_size = self._config.get("cache_size", fallback="20G")
+        try:
+            self.cache_size = parse_size(cache_size)
+        except ValueError as err:
+            raise ConfigError("Bad cache_size: {}".format(err))
 
         self.efi = self._config.getboolean("efi", fallback=False)
         self.bios = self._config.getboolean("bios", fallback=True)
@@ -211,6 +384,7 @@ class Config(object):
         if not self.hashed_root_password:
             root_password = self._config.get("root_password")
             if root_password:
+                import crypt
                 self.hashed_root_password = crypt.crypt(root_password,
                                                 crypt.mksalt(crypt.METHOD_MD5))
             else:
@@ -274,6 +448,8 @@ class Config(object):
             print(str(self.uuid), file=uuid_f)
             print(self.efi_vol_id, file=uuid_f)
             print(self.cd_vol_id, file=uuid_f)
+        self._substitution = None
+        self.save_snapshot()
 
     def _choose_grub_platforms(self):
         self.grub_platforms = []
@@ -304,15 +480,8 @@ class Config(object):
                 raise ConfigError("Invalid module: '{0}' - there is no '{1}'"
                                     " directory".format(m, module_dir))
 
-        if self.compression not in ("xz", "gzip"):
-            raise ConfigError("Unsupported compression: {0!r}"
-                                            .format(self.compression))
-        if self.compression_level and (
-                self.compression_level < 0 or self.compression_level > 9):
-            raise ConfigError("Unsupported compression level: {0!r}"
-                                            .format(self.compression_level))
-
-        _check_tool(self.compress_cmd, "compress command")
+        spec = self.get_compression("initramfs")
+        _check_tool(spec.codec.command, "compress command")
 
         if self.efi and self.efi_arch not in ("x64", "ia32"):
             raise ConfigError("EFI architecture not supported: {0!r}"
@@ -365,22 +534,14 @@ class Config(object):
 
         _check_tool("rpm")
         _check_tool("poldek")
-        _check_tool("du")
-        _check_tool("dd")
         _check_tool("mount")
         _check_tool("umount")
         _check_tool("losetup")
-        _check_tool("mkdosfs", ignore_error=True, quiet=True,
-                                                        package="dosfstools")
         _check_tool("sfdisk", package="util-linux")
         _check_tool("cpio")
-        _check_tool("gen_init_cpio", ignore_error=True, quiet=True,
-                                                        package="kernel-tools")
         _check_tool("mksquashfs", args=["-version"], package="squashfs")
+        _check_squashfs_compressor(self.get_compression("squashfs").name)
         _check_tool("xorriso")
-        
-        _check_tool("mcopy", package="mtools")
-        _check_tool("mmd", package="mtools")
 
     def get_config_vars(self):
         """Return current config as string->string mapping."""
@@ -391,6 +552,10 @@ class Config(object):
         result["compression"] = self.compression
         if self.compression_level is not None:
             result["compression_level"] = self.compression_level
+        result["initramfs_compression"] = self.initramfs_compression
+        result["squashfs_compression"] = self.squashfs_compression
+        result["deterministic"] = "yes" if self.deterministic else "no"
+        result["batch_install"] = "yes" if self.batch_install else "no"
         result["efi"] = "yes" if self.efi else "no"
         result["bios"] = "yes" if self.bios else "no"
         result["net_boot"] = "yes" if self.net_boot else "no"
@@ -419,20 +584,16 @@ class Config(object):
         result["grub_initrdefi"] = self.grub_initrdefi
         return result
 
+    def get_substitution(self):
+        """Return TemplateSubstitution for the current config."""
+        if self._substitution is None:
+            self._substitution = TemplateSubstitution(self.get_config_vars())
+        return self._substitution
+
     def substitute_bytes(self, data):
-        """Copy `source` file to `dest` substituting @var@ strings."""
-        config_vars = self.get_config_vars()
-        def repl(match):
-            key = match.group(1)
-            try:
-                key = key.decode("utf-8")
-                return config_vars[key].encode("utf-8")
-            except (KeyError, ValueError, UnicodeError):
-                return match.group(0)
-        SUB_RE = re.compile(b"@(\w+)@")
-        data = SUB_RE.sub(repl, data)
-        return data
-    
+        """Return `data` with @var@ strings substituted."""
+        return self.get_substitution()(data)
+
     def copy_substituting(self, source, dest):
         """Copy `source` file to `dest` substituting @var@ strings."""
         with open(source, "rb") as source_f:
@@ -474,23 +635,18 @@ class Config(object):
     def copy_template_dir(self, source, dest):
         return self.copy_dir(source, dest, True)
 
-    def mcopy_template_dir(self, source, dest, image=None):
-        if image:
-            img_opt = ["-i", image]
-        else:
-            img_opt = []
+    def copy_template_dir_to_fat(self, source, image, dest=""):
+        """Add contents of template directory `source` to
+        a pld_nr_fat.FATImage, substituting the '.pldnrt' files
+        in memory."""
         def copy(src, dst):
-            subprocess.check_call(["mcopy", "-D", "o"] + img_opt + [src, dst])
-        def mkdirs(src, dst):
-            subprocess.check_call(["mmd", "-D", "s"] + img_opt + [path])
+            image.add_file(dst, source=os.path.abspath(src))
         def copy_subst(src, dst):
-            with tempfile.NamedTemporaryFile() as tmp_f:
-                self.copy_substituting(src, tmp_f.name)
-                subprocess.check_call(["mcopy", "-D", "o"] + img_opt + [
-                                                    tmp_f.name, dst])
-
-        return self.copy_dir(source, dest, True,
-                            copy=copy, copy_subst=copy_subst, mkdirs=mkdirs )
+            with open(src, "rb") as source_f:
+                image.add_file(dst, data=self.substitute_bytes(
+                                                        source_f.read()))
+        return self.copy_dir(source, dest, True, copy=copy,
+                             copy_subst=copy_subst, mkdirs=image.add_dir)
 
     def run_script(self, script, sudo=False):
         env = {"pldnr_" + k.replace("+", "_plus"): v
@@ -505,14 +661,10 @@ class Config(object):
             commands += "export {}\n".format(" ".join(env.keys()))
             commands += "set -ex\n"
             commands += ". {}".format(shlex.quote(os.path.abspath(script)))
-            shell_p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-            shell_p.communicate(commands.encode("utf-8"))
-            rc = shell_p.wait()
-            if rc:
-                raise subprocess.CalledProcessError(rc, cmd)
+            traced_check_call(cmd, commands.encode("utf-8"))
         else:
             cmd = ["/bin/sh", "-ex", script]
-            subprocess.check_call(cmd, env=env, stdin=open("/dev/null", "rb"))
+            traced_check_call(cmd, env=env, stdin=subprocess.DEVNULL)
 
     def __str__(self):
         return "[config]\n{0}\n".format(
@@ -563,23 +715,340 @@ class Config(object):
     def build_make_deps(self):
         lines = []
         lines.append("")
-        for m in self.modules:
-            lines.append("{0}.cpi: {0}.sqf".format(m))
-            lines.append(".INTERMEDIATE: {0}.sqf".format(m))
-            lines.append("{0}.sqf: root/bin/rpm\n".format(m))
         lines.append(".SECONDARY: base.full-lst")
         return "\n".join(lines)
 
+    def save_snapshot(self):
+        """Store the resolved config for cheap loading by the next
+        build script."""
+        path = os.path.join(self.build_dir, SNAPSHOT_FILENAME)
+        state = {k: v for k, v in vars(self).items() if not k.startswith("_")}
+        state["uuid"] = str(self.uuid)
+        snapshot = {
+                "key": _get_snapshot_key(self.config_file, self.build_dir),
+                "state": state,
+                }
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "wt") as snap_f:
+                json.dump(snapshot, snap_f, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            logger.debug("Cannot save config snapshot: {}".format(err))
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def get_compression(self, target):
+        """Return CompressionSpec for 'initramfs' or 'squashfs'."""
+        import pld_nr_compress
+        return pld_nr_compress.CompressionSpec.parse(
+                                getattr(self, target + "_compression"), target)
+
+    @classmethod
+    def load_snapshot(cls, filename, build_dir):
+        """Return config saved by save_snapshot() or None if there
+        is none or it is out of date."""
+        path = os.path.join(build_dir, SNAPSHOT_FILENAME)
+        try:
+            with open(path, "rt") as snap_f:
+                snapshot = json.load(snap_f)
+        except (IOError, ValueError) as err:
+            logger.debug("Cannot load config snapshot: {}".format(err))
+            return None
+        if snapshot.get("key") != _get_snapshot_key(filename, build_dir):
+            logger.debug("Config snapshot out of date")
+            return None
+        config = cls.__new__(cls)
+        config.__dict__.update(snapshot["state"])
+        config._substitution = None
+        config._parsed = None
+        config._config = None
+        config.uuid = uuid.UUID(config.uuid)
+        config.update_path()
+        return config
+
+    @classmethod
+    def load(cls, filename, build_dir):
+        """Load config from the snapshot or `filename`."""
+        config = cls.load_snapshot(filename, build_dir)
+        if config is None:
+            config = cls(filename, build_dir)
+            config.save_snapshot()
+        return config
+
     @classmethod
     def get_config(cls):
         if cls._instance:
-            return _instance
+            return cls._instance
         build_dir = os.path.dirname(__file__)
         filename = os.path.join(build_dir, "../build.conf")
-        cls._instance = cls(os.path.abspath(filename),
-                            os.path.abspath(build_dir))
+        cls._instance = cls.load(os.path.abspath(filename),
+                                 os.path.abspath(build_dir))
         return cls._instance
 
+def _get_thread_id():
+    if hasattr(threading, "get_native_id"):
+        return threading.get_native_id()
+    return threading.get_ident()
+
+def _get_io_written():
+    """Return number of bytes written by this process so far."""
+    try:
+        with open("/proc/self/io", "rt") as io_f:
+            for line in io_f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _get_command_name(args):
+    if isinstance(args, (str, bytes)):
+        args = args.split()
+    args = [a.decode("utf-8", "replace") if isinstance(a, bytes) else str(a)
+                                                            for a in args]
+    while args and os.path.basename(args[0]) == "sudo":
+        args = args[1:]
+    if len(args) > 2 and os.path.basename(args[0]) == "chroot":
+        args = args[2:]
+    if not args:
+        return "?"
+    return os.path.basename(args[0])
+
+class BuildTrace(object):
+    """Build timing recorder.
+
+    Events are appended to `filename` in the Chrome trace (Trace Event
+    Format) JSON array format, usable with chrome://tracing or Perfetto.
+    All the build scripts append to the same file, so it covers the whole
+    build. The array is never closed, which the format allows."""
+    def __init__(self, filename, name):
+        self.filename = os.path.abspath(filename)
+        self.name = name
+        self.pid = os.getpid()
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if not os.path.exists(self.filename):
+            # create the file with the array opening atomically
+            tmp_fn = "{}.{}.tmp".format(self.filename, self.pid)
+            with open(tmp_fn, "wt") as tmp_f:
+                tmp_f.write("[\n")
+            try:
+                os.link(tmp_fn, self.filename)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp_fn)
+        self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+        self._write({"name": "process_name", "ph": "M",
+                     "pid": self.pid, "tid": _get_thread_id(),
+                     "args": {"name": "{} [{}]".format(self.name, self.pid)}})
+
+    def _write(self, event):
+        data = (json.dumps(event, sort_keys=True) + ",\n").encode("utf-8")
+        os.write(self._fd, data)
+
+    def add_event(self, event):
+        event.setdefault("pid", self.pid)
+        event.setdefault("tid", _get_thread_id())
+        with self._lock:
+            if self._fd is None:
+                self._open()
+            self._write(event)
+
+    def add_complete(self, name, category, start, end, args):
+        self.add_event({"name": name, "cat": category, "ph": "X",
+                        "ts": int(start * 1000000),
+                        "dur": int((end - start) * 1000000),
+                        "args": args})
+
+    @contextmanager
+    def phase(self, name, category="phase", **args):
+        """Record wall and CPU time and bytes written in the enclosed
+        block, and the peak RSS of the whole script so far."""
+        start = time.time()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        written = _get_io_written()
+        try:
+            yield
+        finally:
+            end = time.time()
+            end_usage = resource.getrusage(resource.RUSAGE_SELF)
+            end_child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            end_written = _get_io_written()
+            args.update({
+                "cpu_user": round(end_usage.ru_utime - usage.ru_utime, 6),
+                "cpu_sys": round(end_usage.ru_stime - usage.ru_stime, 6),
+                "children_cpu_user": round(end_child_usage.ru_utime
+                                            - child_usage.ru_utime, 6),
+                "children_cpu_sys": round(end_child_usage.ru_stime
+                                            - child_usage.ru_stime, 6),
+                "process_max_rss_kb": end_usage.ru_maxrss,
+                })
+            if written is not None and end_written is not None:
+                args["bytes_written"] = end_written - written
+            self.add_complete(name, category, start, end, args)
+
+    def add_process(self, command, start, end, returncode, rusage=None,
+                    written=None):
+        """Record a finished subprocess with its resource usage
+        (as returned by os.wait4()) and bytes written."""
+        args = {"command": " ".join(str(a) for a in command)
+                        if isinstance(command, (list, tuple)) else command,
+                "returncode": returncode}
+        if rusage is not None:
+            args["cpu_user"] = round(rusage.ru_utime, 6)
+            args["cpu_sys"] = round(rusage.ru_stime, 6)
+            args["max_rss_kb"] = rusage.ru_maxrss
+        if written is not None:
+            args["bytes_written"] = written
+        self.add_complete(_get_command_name(command), "subprocess",
+                          start, end, args)
+
+_trace = None
+
+def _get_process_written(pid):
+    """Return number of bytes an exited, not yet reaped, child and its
+    waited-for children caused to be written to storage
+    (from /proc/PID/io)."""
+    try:
+        with open("/proc/{}/io".format(pid), "rt") as io_f:
+            for line in io_f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def wait_traced(process, start=None):
+    """Wait for a subprocess.Popen `process` and record it in the build
+    trace (if enabled). `start` is the process start time.
+
+    Return the process exit status."""
+    if _trace is None:
+        return process.wait()
+    written = None
+    rusage = None
+    try:
+        # wait for the exit, but leave the zombie for /proc inspection
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        written = _get_process_written(process.pid)
+        status, rusage = os.wait4(process.pid, 0)[1:]
+    except ChildProcessError:
+        # already reaped
+        returncode = process.wait()
+    else:
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        process.returncode = returncode
+    _trace.add_process(process.args, start or time.time(), time.time(),
+                       returncode, rusage, written)
+    return returncode
+
+def _traced_run(command, input=None, capture=False, **kwargs):
+    """Run `command` to completion, recording it in the build trace.
+
+    Return (exit status, output)."""
+    start = time.time()
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    if capture:
+        kwargs["stdout"] = subprocess.PIPE
+    process = subprocess.Popen(command, **kwargs)
+    output = None
+    try:
+        writer = None
+        if input is not None:
+            def write_input():
+                try:
+                    process.stdin.write(input)
+                except BrokenPipeError:
+                    pass
+                finally:
+                    process.stdin.close()
+            if capture:
+                writer = threading.Thread(target=write_input, daemon=True)
+                writer.start()
+            else:
+                write_input()
+        if capture:
+            output = process.stdout.read()
+            process.stdout.close()
+        if writer is not None:
+            writer.join()
+    except:
+        process.kill()
+        process.wait()
+        raise
+    return wait_traced(process, start), output
+
+def traced_call(command, **kwargs):
+    """subprocess.call() recorded in the build trace."""
+    return _traced_run(command, **kwargs)[0]
+
+def traced_check_call(command, input=None, **kwargs):
+    """subprocess.check_call() recorded in the build trace, optionally
+    feeding `input` to the command."""
+    returncode = _traced_run(command, input, **kwargs)[0]
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+def traced_check_output(command, input=None, ok_codes=(0,), **kwargs):
+    """subprocess.check_output() recorded in the build trace.
+
+    Exit codes in `ok_codes` are not considered errors."""
+    returncode, output = _traced_run(command, input, capture=True, **kwargs)
+    if returncode not in ok_codes:
+        raise subprocess.CalledProcessError(returncode, command, output)
+    return output
+
+def setup_tracing(filename, name=None):
+    """Start recording the build trace to `filename`.
+
+    Every subprocess started through the traced_* functions is recorded
+    from now on, as is the whole script run."""
+    global _trace
+    if not filename:
+        return None
+    if name is None:
+        name = os.path.basename(sys.argv[0])
+    _trace = BuildTrace(filename, name)
+    start = time.time()
+    def finish():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        written = _get_io_written()
+        args = {
+            "command": " ".join(sys.argv),
+            "cpu_user": usage.ru_utime,
+            "cpu_sys": usage.ru_stime,
+            "children_cpu_user": child_usage.ru_utime,
+            "children_cpu_sys": child_usage.ru_stime,
+            "max_rss_kb": usage.ru_maxrss,
+            "children_max_rss_kb": child_usage.ru_maxrss,
+            }
+        if written is not None:
+            args["bytes_written"] = written
+        _trace.add_complete(name, "script", start, time.time(), args)
+    atexit.register(finish)
+    return _trace
+
+def trace_phase(name, **args):
+    """Context manager recording a build phase in the build trace
+    (if enabled)."""
+    if _trace is None:
+        return _null_phase()
+    return _trace.phase(name, **args)
+
+@contextmanager
+def _null_phase():
+    yield
+
 def get_logging_args_parser():
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("--debug",
@@ -588,10 +1057,16 @@ def get_logging_args_parser():
                         const=logging.DEBUG,
                         default=logging.INFO,
                         help="Enable extra logging")
+    parser.add_argument("--trace",
+                        metavar="FILE",
+                        default=os.environ.get("PLDNR_TRACE"),
+                        help="Append timing and resource usage to Chrome"
+                            " trace FILE (default: $PLDNR_TRACE)")
     return parser
 
 def setup_logging(args):
     logging.basicConfig(level=args.log_level)
+    setup_tracing(args.trace)
     
 def main():
     log_parser = get_logging_args_parser()
@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+
+"""Content-addressed cache of build artifacts.
+
+Artifacts (.sqf, .cpi, GRUB and EFI images) are stored under a hash of
+everything they are built from, so they can be reused by other build
+trees, for other architectures and after a fresh checkout, whatever the
+file modification times say.
+"""
+
+import os
+import sys
+import stat
+import fcntl
+import shutil
+import hashlib
+import logging
+import argparse
+import subprocess
+import tempfile
+
+import pld_nr_buildconf
+
+logger = logging.getLogger("pld_nr_cache")
+
+# bump when the key computation changes
+KEY_VERSION = 1
+
+READ_BUF_SIZE = 1024 * 1024
+
+# ioctl(2) sharing the data of two files, from <linux/fs.h>
+FICLONE = 0x40049409
+
+_tool_versions = {}
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as data_f:
+        while True:
+            data = data_f.read(READ_BUF_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def get_tool_version(command):
+    """Return version string of a tool (first line of its output)."""
+    if isinstance(command, str):
+        command = [command, "--version"]
+    command = tuple(command)
+    if command in _tool_versions:
+        return _tool_versions[command]
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as err:
+        # some tools (mkdosfs, mksquashfs) exit with non-zero status here
+        output = err.output
+    except OSError:
+        output = b"missing"
+    version = output.decode("utf-8", "replace").strip().split("\n")[0]
+    _tool_versions[command] = version
+    return version
+
+def _reflink(src_f, dst_f):
+    """Try to share the data blocks of the files (btrfs, XFS)."""
+    try:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+    except OSError:
+        return False
+    return True
+
+def copy_file(src, dst):
+    """Atomically replace `dst` with a copy (reflink if possible)
+    of `src`."""
+    tmp_fn = "{}.{}.tmp".format(dst, os.getpid())
+    try:
+        with open(src, "rb") as src_f, open(tmp_fn, "wb") as dst_f:
+            if not _reflink(src_f, dst_f):
+                shutil.copyfileobj(src_f, dst_f, READ_BUF_SIZE)
+        os.replace(tmp_fn, dst)
+    except:
+        if os.path.exists(tmp_fn):
+            os.unlink(tmp_fn)
+        raise
+
+class CacheKey(object):
+    """Accumulates build inputs into a cache key."""
+    def __init__(self, kind):
+        self.kind = kind
+        self._hash = hashlib.sha256()
+        self.add_string("{}:{}".format(KEY_VERSION, kind))
+
+    def add_string(self, value):
+        value = value.encode("utf-8")
+        self._hash.update("{}:".format(len(value)).encode("us-ascii"))
+        self._hash.update(value)
+
+    def add_bytes(self, value):
+        self._hash.update("{}:".format(len(value)).encode("us-ascii"))
+        self._hash.update(value)
+
+    def add_values(self, *values):
+        for value in values:
+            self.add_string(str(value))
+
+    def add_digest(self, name, digest):
+        self.add_string(name)
+        self.add_string(digest)
+
+    def add_file(self, path, name=None):
+        """Add contents of a file (`name` defaults to `path`)."""
+        self.add_digest(name or path, file_digest(path))
+
+    def add_config(self, config, keys=None):
+        """Add config variables (all or only `keys`)."""
+        config_vars = config.get_config_vars()
+        if keys is None:
+            keys = list(config_vars)
+        for key in sorted(keys):
+            self.add_values(key, config_vars.get(key))
+
+    def add_dir(self, path, config=None):
+        """Add names, types, modes and contents of files under `path`.
+
+        With `config` given, values of the config variables used in
+        '.pldnrt' templates are added too."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, path)
+            for filename in sorted(filenames):
+                if filename.endswith("~"):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                name = os.path.join(rel_dir, filename)
+                path_stat = os.lstat(full_path)
+                self.add_values(name, stat.S_IFMT(path_stat.st_mode),
+                                    stat.S_IMODE(path_stat.st_mode) & 0o111)
+                if stat.S_ISLNK(path_stat.st_mode):
+                    self.add_string(os.readlink(full_path))
+                    continue
+                self.add_file(full_path, name)
+                if config and filename.endswith(".pldnrt"):
+                    with open(full_path, "rb") as templ_f:
+                        used = pld_nr_buildconf.TemplateSubstitution \
+                                            .used_vars(templ_f.read())
+                    self.add_config(config, used)
+
+    def add_tool(self, command):
+        """Add version of a tool used in the build."""
+        self.add_string(get_tool_version(command))
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+class ArtifactCache(object):
+    """Directory of cached artifacts with size-limited LRU eviction.
+
+    Each entry is a directory named after the key holding the artifact
+    files. Entry mtime is updated on every hit."""
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key.hexdigest()[:2],
+                            key.hexdigest())
+
+    def fetch(self, key, filenames):
+        """Put cached versions of `filenames` in place.
+
+        Return True on cache hit."""
+        entry_dir = self._entry_dir(key)
+        if not all(os.path.exists(os.path.join(entry_dir,
+                                                os.path.basename(fn)))
+                                                        for fn in filenames):
+            logger.debug("cache miss for {} ({})"
+                                    .format(key.kind, key.hexdigest()))
+            return False
+        for filename in filenames:
+            cached_fn = os.path.join(entry_dir, os.path.basename(filename))
+            # a copy (with a new mtime, so make sees it as new), as the build
+            # scripts overwrite their outputs in place
+            copy_file(cached_fn, filename)
+        os.utime(entry_dir)
+        logger.info("Using cached {} ({})".format(" ".join(filenames),
+                                                  key.hexdigest()[:12]))
+        return True
+
+    def store(self, key, filenames):
+        """Store `filenames` as an artifact built for `key`."""
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        parent_dir = os.path.dirname(entry_dir)
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp-")
+        try:
+            for filename in filenames:
+                shutil.copyfile(filename, os.path.join(tmp_dir,
+                                                os.path.basename(filename)))
+            os.rename(tmp_dir, entry_dir)
+        except OSError as err:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir):
+                logger.warning("Could not store {!r} in cache: {}"
+                                                    .format(filenames, err))
+                return
+        logger.debug("stored {} in cache as {}".format(filenames,
+                                                       key.hexdigest()))
+        self.evict()
+
+    def list_entries(self):
+        """Return list of (mtime, size, path) for all cache entries."""
+        result = []
+        try:
+            subdirs = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return result
+        for subdir in subdirs:
+            subdir_path = os.path.join(self.cache_dir, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for entry in os.listdir(subdir_path):
+                if entry.startswith("."):
+                    continue
+                entry_path = os.path.join(subdir_path, entry)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_path, f))
+                                            for f in os.listdir(entry_path))
+                    mtime = os.stat(entry_path).st_mtime
+                except OSError:
+                    continue
+                result.append((mtime, size, entry_path))
+        return result
+
+    def evict(self, max_size=None):
+        """Remove least recently used entries until the cache fits
+        in `max_size` bytes."""
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self.list_entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, entry_path in entries:
+            if total <= max_size:
+                break
+            logger.debug("evicting {!r} ({} bytes)".format(entry_path, size))
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total -= size
+        return total
+
+def get_cache(config):
+    """Return ArtifactCache configured in build.conf or None if disabled."""
+    if not config.cache_dir:
+        return None
+    return ArtifactCache(config.cache_dir, config.cache_size)
+
+def main():
+    log_parser = pld_nr_buildconf.get_logging_args_parser()
+    parser = argparse.ArgumentParser(description="Manage the artifact cache",
+                                     parents=[log_parser])
+    parser.add_argument("--evict", metavar="SIZE",
+                        help="Shrink the cache to SIZE")
+    parser.add_argument("--clear", action="store_true",
+                        help="Remove everything from the cache")
+    args = parser.parse_args()
+    pld_nr_buildconf.setup_logging(args)
+
+    config = pld_nr_buildconf.Config.get_config()
+    cache = get_cache(config)
+    if not cache:
+        logger.info("Artifact cache disabled")
+        return
+    if args.clear:
+        cache.evict(0)
+    elif args.evict:
+        cache.evict(pld_nr_buildconf.parse_size(args.evict))
+    entries = cache.list_entries()
+    print("{}: {} entries, {:.1f} MiB (limit: {:.1f} MiB)".format(
+                cache.cache_dir, len(entries),
+                sum(e[1] for e in entries) / 1048576,
+                cache.max_size / 1048576))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (ValueError, pld_nr_buildconf.ConfigError) as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+# vi: sts=4 sw=4 et
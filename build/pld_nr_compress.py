@@ -0,0 +1,633 @@
+#!/usr/bin/python3
+
+"""Compression backends for the initramfs and the squashfs modules.
+
+Compression is described by a spec string: 'CODEC[:OPTION=VALUE,...]',
+e.g. 'xz:level=9,threads=0' or 'zstd:level=19,block=1M'. Supported codecs
+are gzip, xz, zstd and lz4, options are:
+
+    level=N       compression level (the range depends on the codec)
+    threads=N     compressor threads, 0 for all CPUs (xz and zstd for
+                  the initramfs, total mksquashfs processors for modules)
+    dict=SIZE     dictionary (window) size (xz, zstd for the initramfs)
+    block=SIZE    block size (squashfs, xz in multithreaded mode)
+
+Run as a script it compresses the modules of the current build with
+a number of candidate specs and reports the build time, image size and
+single-core decompression throughput of each.
+"""
+
+import os
+import sys
+import abc
+import json
+import time
+import lzma
+import zlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import pld_nr_buildconf
+
+logger = logging.getLogger("pld_nr_compress")
+
+INITRAMFS = "initramfs"
+SQUASHFS = "squashfs"
+
+READ_BUF_SIZE = 1024 * 1024
+
+# limit of the kernel and the default zstd decompressor memory limit
+ZSTD_MAX_WINDOW = 128 << 20
+
+INITRAMFS_CANDIDATES = [
+        "gzip:level=9",
+        "xz:level=6,threads=0",
+        "xz:level=9,threads=0",
+        "zstd:level=15,threads=0",
+        "zstd:level=19,threads=0",
+        "zstd:level=19,threads=0,dict=64M",
+        "lz4:level=9",
+        ]
+
+SQUASHFS_CANDIDATES = [
+        "gzip",
+        "xz",
+        "xz:block=1M,dict=1M",
+        "zstd:level=15",
+        "zstd:level=19,block=1M",
+        "lz4",
+        "lz4:level=9",
+        ]
+
+def _format_size(value):
+    for suffix, unit in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if value % unit == 0:
+            return "{}{}".format(value // unit, suffix)
+    return str(value)
+
+def _is_power_of_2(value):
+    return value > 0 and not value & (value - 1)
+
+class NullCompressor(object):
+    def compress(self, data):
+        return data
+    def flush(self):
+        return b""
+
+class PipeCompressor(object):
+    """Compressor object running an external command.
+
+    The data is compressed by another process (possibly multithreaded)
+    while the caller produces more of it."""
+    def __init__(self, command):
+        self.command = command
+        self._start = time.time()
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self._chunks = []
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        fd = self._process.stdout.fileno()
+        while True:
+            data = os.read(fd, READ_BUF_SIZE)
+            if not data:
+                break
+            with self._lock:
+                self._chunks.append(data)
+
+    def _take(self):
+        with self._lock:
+            data = b"".join(self._chunks)
+            self._chunks = []
+        return data
+
+    def compress(self, data):
+        self._process.stdin.write(data)
+        return self._take()
+
+    def flush(self):
+        self._process.stdin.close()
+        self._reader.join()
+        self._process.stdout.close()
+        returncode = pld_nr_buildconf.wait_traced(self._process, self._start)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, self.command)
+        return self._take()
+
+class Codec(abc.ABC):
+    """Compression method usable for the initramfs and squashfs."""
+    name = None
+    ext = None
+    command = None
+    # (min, max) or None when the level cannot be set
+    levels = {INITRAMFS: None, SQUASHFS: None}
+    options = {INITRAMFS: (), SQUASHFS: ()}
+
+    def check(self, spec):
+        """Raise ValueError if `spec` options are not valid for this
+        codec."""
+        for option in ("level", "threads", "dict", "block"):
+            if getattr(spec, option) is None:
+                continue
+            if option not in self.options[spec.target]:
+                raise ValueError("{!r} option not supported by {} for {}"
+                                    .format(option, self.name, spec.target))
+        if spec.level is not None:
+            min_level, max_level = self.levels[spec.target]
+            if not min_level <= spec.level <= max_level:
+                raise ValueError("{} {} compression level must be"
+                                 " {}-{}, not {}".format(self.name,
+                                        spec.target, min_level, max_level,
+                                        spec.level))
+        if spec.threads is not None and spec.threads < 0:
+            raise ValueError("Bad number of threads: {}".format(spec.threads))
+        if spec.target == SQUASHFS and spec.block is not None:
+            if not _is_power_of_2(spec.block) or not (
+                                    4096 <= spec.block <= 1048576):
+                raise ValueError("squashfs block size must be a power of 2"
+                                 " between 4K and 1M, not {}"
+                                 .format(_format_size(spec.block)))
+
+    def get_compressor(self, spec):
+        return PipeCompressor(self.compress_command(spec))
+
+    @abc.abstractmethod
+    def compress_command(self, spec):
+        """Return stdin to stdout compression command."""
+
+    def decompress_command(self):
+        """Return single-threaded stdin to stdout decompression
+        command."""
+        return [self.command, "-d", "-c"]
+
+    def squashfs_args(self, spec):
+        args = ["-comp", self.name]
+        if spec.block is not None:
+            args += ["-b", str(spec.block)]
+        return args
+
+class GzipCodec(Codec):
+    name = "gzip"
+    ext = ".gz"
+    command = "gzip"
+    levels = {INITRAMFS: (0, 9), SQUASHFS: (1, 9)}
+    options = {INITRAMFS: ("level",),
+               SQUASHFS: ("level", "threads", "block")}
+
+    def get_compressor(self, spec):
+        level = 6 if spec.level is None else spec.level
+        # wbits=31 means gzip format (with zero mtime in the header)
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress_command(self, spec):
+        command = ["gzip", "-n", "-c"]
+        if spec.level is not None:
+            command.append("-{}".format(spec.level))
+        return command
+
+    def squashfs_args(self, spec):
+        args = super().squashfs_args(spec)
+        if spec.level is not None:
+            args += ["-Xcompression-level", str(spec.level)]
+        return args
+
+class XzCodec(Codec):
+    name = "xz"
+    ext = ".xz"
+    command = "xz"
+    # mksquashfs has no xz level option
+    levels = {INITRAMFS: (0, 9), SQUASHFS: None}
+    options = {INITRAMFS: ("level", "threads", "dict", "block"),
+               SQUASHFS: ("threads", "dict", "block")}
+
+    def check(self, spec):
+        super().check(spec)
+        if spec.dict is None:
+            return
+        if spec.target == SQUASHFS:
+            block = 131072 if spec.block is None else spec.block
+            if not 8192 <= spec.dict <= block:
+                raise ValueError("xz squashfs dictionary size must be"
+                                 " between 8K and the block size ({})"
+                                 .format(_format_size(block)))
+        elif not 4096 <= spec.dict <= 1536 << 20:
+            raise ValueError("xz dictionary size must be between 4K"
+                             " and 1536M")
+
+    def get_compressor(self, spec):
+        if spec.get_threads() != 1 or spec.block is not None:
+            return super().get_compressor(spec)
+        level = 6 if spec.level is None else spec.level
+        lzma2 = {"id": lzma.FILTER_LZMA2, "preset": level}
+        if spec.dict is not None:
+            lzma2["dict_size"] = spec.dict
+        # the kernel xz decompressor does not support CRC64
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ,
+                                   check=lzma.CHECK_CRC32,
+                                   filters=[lzma2])
+
+    def compress_command(self, spec):
+        level = 6 if spec.level is None else spec.level
+        command = ["xz", "--check=crc32", "-c",
+                   "--threads={}".format(spec.get_threads())]
+        if spec.dict is not None:
+            command.append("--lzma2=preset={},dict={}"
+                                            .format(level, spec.dict))
+        else:
+            command.append("-{}".format(level))
+        if spec.block is not None:
+            command.append("--block-size={}".format(spec.block))
+        return command
+
+    def decompress_command(self):
+        return ["xz", "-d", "-c", "--threads=1"]
+
+    def squashfs_args(self, spec):
+        args = super().squashfs_args(spec)
+        if spec.dict is not None:
+            args += ["-Xdict-size", str(spec.dict)]
+        return args
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    ext = ".zst"
+    command = "zstd"
+    levels = {INITRAMFS: (1, 22), SQUASHFS: (1, 22)}
+    options = {INITRAMFS: ("level", "threads", "dict"),
+               SQUASHFS: ("level", "threads", "block")}
+
+    def check(self, spec):
+        super().check(spec)
+        if spec.dict is not None and (not _is_power_of_2(spec.dict)
+                    or not 1024 <= spec.dict <= ZSTD_MAX_WINDOW):
+            raise ValueError("zstd window size must be a power of 2"
+                             " between 1K and {}"
+                             .format(_format_size(ZSTD_MAX_WINDOW)))
+
+    def compress_command(self, spec):
+        command = ["zstd", "-q", "-c", "-T{}".format(spec.get_threads())]
+        if spec.level is not None:
+            if spec.level > 19:
+                command.append("--ultra")
+            command.append("-{}".format(spec.level))
+        if spec.dict is not None:
+            command.append("--zstd=wlog={}".format(
+                                                spec.dict.bit_length() - 1))
+        return command
+
+    def decompress_command(self):
+        return ["zstd", "-d", "-q", "-c"]
+
+    def squashfs_args(self, spec):
+        args = super().squashfs_args(spec)
+        if spec.level is not None:
+            args += ["-Xcompression-level", str(spec.level)]
+        return args
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    ext = ".lz4"
+    command = "lz4"
+    levels = {INITRAMFS: (1, 12), SQUASHFS: (1, 12)}
+    options = {INITRAMFS: ("level",),
+               SQUASHFS: ("level", "threads", "block")}
+
+    def compress_command(self, spec):
+        # the kernel understands only the legacy lz4 format
+        command = ["lz4", "-l", "-q", "-c"]
+        if spec.level is not None:
+            command.append("-{}".format(spec.level))
+        return command
+
+    def decompress_command(self):
+        return ["lz4", "-d", "-q", "-c"]
+
+    def squashfs_args(self, spec):
+        args = super().squashfs_args(spec)
+        # levels 3 and up select LZ4 HC
+        if spec.level is not None and spec.level >= 3:
+            args.append("-Xhc")
+        return args
+
+CODECS = {codec.name: codec for codec in (GzipCodec(), XzCodec(),
+                                          ZstdCodec(), Lz4Codec())}
+
+class CompressionSpec(object):
+    """Compression method and its parameters for a single target
+    ('initramfs' or 'squashfs')."""
+    def __init__(self, codec, target, level=None, threads=None, dict=None,
+                                                                block=None):
+        if codec not in CODECS:
+            raise ValueError("Unsupported compression: {!r}".format(codec))
+        if target not in (INITRAMFS, SQUASHFS):
+            raise ValueError("Unknown compression target: {!r}"
+                                                            .format(target))
+        self.codec = CODECS[codec]
+        self.target = target
+        self.level = level
+        self.threads = threads
+        self.dict = dict
+        self.block = block
+        self.codec.check(self)
+
+    @classmethod
+    def parse(cls, value, target):
+        """Parse 'CODEC[:OPTION=VALUE,...]' string."""
+        if ":" in value:
+            codec, options = value.split(":", 1)
+        else:
+            codec, options = value, ""
+        kwargs = {}
+        for option in options.split(","):
+            option = option.strip()
+            if not option:
+                continue
+            if "=" not in option:
+                raise ValueError("Bad compression option: {!r}"
+                                                            .format(option))
+            key, option_value = (s.strip() for s in option.split("=", 1))
+            if key in ("level", "threads"):
+                try:
+                    kwargs[key] = int(option_value)
+                except ValueError:
+                    raise ValueError("Bad {} value: {!r}"
+                                                .format(key, option_value))
+            elif key in ("dict", "block"):
+                kwargs[key] = pld_nr_buildconf.parse_size(option_value)
+            else:
+                raise ValueError("Unknown compression option: {!r}"
+                                                                .format(key))
+        return cls(codec.strip(), target, **kwargs)
+
+    def __str__(self):
+        options = []
+        for option in ("level", "threads", "dict", "block"):
+            value = getattr(self, option)
+            if value is None:
+                continue
+            if option in ("dict", "block"):
+                value = _format_size(value)
+            options.append("{}={}".format(option, value))
+        if options:
+            return "{}:{}".format(self.codec.name, ",".join(options))
+        return self.codec.name
+
+    @property
+    def name(self):
+        return self.codec.name
+
+    @property
+    def ext(self):
+        return self.codec.ext
+
+    def get_threads(self):
+        """Return number of threads to use (1 when not set)."""
+        if self.threads is None:
+            return 1
+        if self.threads == 0:
+            return os.cpu_count() or 1
+        return self.threads
+
+    def get_compressor(self):
+        """Return a compressor object (with `compress` and `flush`
+        methods) producing data the kernel can unpack."""
+        return self.codec.get_compressor(self)
+
+    def compress_command(self):
+        """Return stdin to stdout compression command."""
+        return self.codec.compress_command(self)
+
+    def decompress_command(self):
+        return self.codec.decompress_command()
+
+    def squashfs_args(self):
+        """Return mksquashfs compression arguments."""
+        return self.codec.squashfs_args(self)
+
+def get_compressor(spec):
+    """Return compressor object for a CompressionSpec, a spec string
+    (for the initramfs) or None (no compression)."""
+    if not spec:
+        return NullCompressor()
+    if isinstance(spec, str):
+        spec = CompressionSpec.parse(spec, INITRAMFS)
+    return spec.get_compressor()
+
+def _run_pinned(command, input=None, cpu=None):
+    """Run `command` on a single CPU, return its output and wall time."""
+    if cpu is None:
+        cpu = min(os.sched_getaffinity(0))
+    start = time.perf_counter()
+    output = pld_nr_buildconf.traced_check_output(command, input,
+                        preexec_fn=lambda: os.sched_setaffinity(0, {cpu}))
+    return output, time.perf_counter() - start
+
+class BenchmarkResult(object):
+    def __init__(self, target, spec):
+        self.target = target
+        self.spec = spec
+        self.input_size = 0
+        self.size = 0
+        self.build_time = 0.0
+        self.decompress_time = 0.0
+
+    def add(self, input_size, size, build_time, decompress_time):
+        self.input_size += input_size
+        self.size += size
+        self.build_time += build_time
+        self.decompress_time += decompress_time
+
+    @property
+    def throughput(self):
+        if not self.decompress_time:
+            return None
+        return self.input_size / self.decompress_time
+
+    def as_dict(self):
+        return {"target": self.target, "spec": str(self.spec),
+                "input_size": self.input_size, "size": self.size,
+                "build_time": self.build_time,
+                "decompress_time": self.decompress_time,
+                "throughput": self.throughput}
+
+def benchmark_initramfs(config, build_dir, candidates):
+    """Recompress the built initramfs archives with each candidate."""
+    current = config.get_compression(INITRAMFS)
+    archives = []
+    for filename in config.initramfs_files:
+        path = os.path.join(build_dir, filename)
+        with open(path, "rb") as cpio_f:
+            data = cpio_f.read()
+        data = _run_pinned(current.decompress_command(), data)[0]
+        archives.append((filename, data))
+    results = []
+    for spec in candidates:
+        result = BenchmarkResult(INITRAMFS, spec)
+        for filename, data in archives:
+            with pld_nr_buildconf.trace_phase("compress", category="benchmark",
+                                              spec=str(spec), file=filename):
+                start = time.perf_counter()
+                compressor = spec.get_compressor()
+                chunks = []
+                for offset in range(0, len(data), READ_BUF_SIZE):
+                    chunks.append(compressor.compress(
+                                    data[offset:offset + READ_BUF_SIZE]))
+                chunks.append(compressor.flush())
+                build_time = time.perf_counter() - start
+            compressed = b"".join(chunks)
+            output, decompress_time = _run_pinned(spec.decompress_command(),
+                                                  compressed)
+            if output != data:
+                raise RuntimeError("{}: {} round trip failed"
+                                                .format(filename, spec))
+            logger.debug("{} {}: {} -> {} bytes, {:.2f}s, {:.2f}s"
+                         .format(filename, spec, len(data), len(compressed),
+                                 build_time, decompress_time))
+            result.add(len(data), len(compressed), build_time,
+                       decompress_time)
+        results.append(result)
+    return results
+
+def benchmark_squashfs(config, build_dir, candidates, work_dir):
+    """Build squashfs images of the modules with each candidate."""
+    import make_module
+
+    root_dir = os.path.join(build_dir, "root")
+    farm_dir = os.path.join(work_dir, "farm")
+    with pld_nr_buildconf.trace_phase("scan_tree", category="benchmark"):
+        tree = make_module.scan_tree(config, root_dir)
+    modules = []
+    old_pwd = os.getcwd()
+    os.chdir(build_dir)
+    try:
+        for name in config.modules:
+            module = make_module.ModuleBuild(name, farm_dir)
+            module.load_paths(tree)
+            modules.append(module)
+    finally:
+        os.chdir(old_pwd)
+    del tree
+
+    image_fn = os.path.join(work_dir, "module.sqf")
+    extract_dir = os.path.join(work_dir, "extract")
+    results = [BenchmarkResult(SQUASHFS, spec) for spec in candidates]
+    for module in modules:
+        make_module.make_link_farm(config, root_dir, module)
+        try:
+            for spec, result in zip(candidates, results):
+                with pld_nr_buildconf.trace_phase("mksquashfs",
+                                                  category="benchmark",
+                                                  spec=str(spec),
+                                                  module=module.name):
+                    start = time.perf_counter()
+                    pld_nr_buildconf.traced_check_call(config.c_sudo + [
+                                    "mksquashfs", module.farm_dir + "/",
+                                    image_fn, "-noappend", "-no-progress",
+                                    "-processors", str(spec.get_threads())]
+                                    + spec.squashfs_args(),
+                                    stdout=subprocess.DEVNULL)
+                    build_time = time.perf_counter() - start
+                size = os.stat(image_fn).st_size
+                # unsquashfs writes the files too, so this is the lower
+                # bound of the decompression throughput
+                decompress_time = _run_pinned(config.c_sudo + [
+                                    "unsquashfs", "-processors", "1",
+                                    "-no-progress", "-d", extract_dir,
+                                    image_fn])[1]
+                pld_nr_buildconf.traced_check_call(config.c_sudo + [
+                                        "rm", "-rf",
+                                        "--one-file-system", extract_dir,
+                                        image_fn])
+                logger.debug("{} {}: {} -> {} bytes, {:.2f}s, {:.2f}s"
+                             .format(module.name, spec, module.bytes, size,
+                                     build_time, decompress_time))
+                result.add(module.bytes, size, build_time, decompress_time)
+        finally:
+            pld_nr_buildconf.traced_call(config.c_sudo + ["rm", "-rf",
+                                    "--one-file-system", module.farm_dir])
+    return results
+
+def print_results(results):
+    print("{:9} {:36} {:>9} {:>7} {:>9} {:>10}".format("target", "spec",
+                        "size MiB", "ratio", "build s", "unpack MB/s"))
+    for result in results:
+        ratio = result.size / result.input_size if result.input_size else 0
+        throughput = result.throughput
+        print("{:9} {:36} {:9.1f} {:7.1%} {:9.2f} {:>10}".format(
+                    result.target, str(result.spec), result.size / 1048576,
+                    ratio, result.build_time,
+                    "{:.1f}".format(throughput / 1000000)
+                                    if throughput is not None else "-"))
+
+def main():
+    log_parser = pld_nr_buildconf.get_logging_args_parser()
+    parser = argparse.ArgumentParser(
+                        description="Compare compression methods on the"
+                                    " built initramfs and modules",
+                        parents=[log_parser])
+    parser.add_argument("--initramfs", metavar="SPEC", nargs="*",
+                        help="initramfs compression candidates"
+                                " (default: a built-in list)")
+    parser.add_argument("--squashfs", metavar="SPEC", nargs="*",
+                        help="squashfs module compression candidates"
+                                " (default: a built-in list)")
+    parser.add_argument("--output", metavar="FILE",
+                        help="Save results as JSON to FILE")
+    args = parser.parse_args()
+    pld_nr_buildconf.setup_logging(args)
+
+    config = pld_nr_buildconf.Config.get_config()
+    build_dir = config.build_dir
+
+    if args.initramfs is None:
+        args.initramfs = INITRAMFS_CANDIDATES + [config.initramfs_compression]
+    if args.squashfs is None:
+        args.squashfs = SQUASHFS_CANDIDATES + [config.squashfs_compression]
+    initramfs_specs = []
+    for value in args.initramfs:
+        spec = CompressionSpec.parse(value, INITRAMFS)
+        if str(spec) not in [str(s) for s in initramfs_specs]:
+            initramfs_specs.append(spec)
+    squashfs_specs = []
+    for value in args.squashfs:
+        spec = CompressionSpec.parse(value, SQUASHFS)
+        if str(spec) not in [str(s) for s in squashfs_specs]:
+            squashfs_specs.append(spec)
+
+    results = []
+    if initramfs_specs:
+        logger.info("Benchmarking {} initramfs compression methods"
+                                            .format(len(initramfs_specs)))
+        results += benchmark_initramfs(config, build_dir, initramfs_specs)
+    if squashfs_specs:
+        logger.info("Benchmarking {} squashfs compression methods"
+                                            .format(len(squashfs_specs)))
+        work_dir = tempfile.mkdtemp(prefix="compress_bench.", dir=build_dir)
+        try:
+            results += benchmark_squashfs(config, build_dir, squashfs_specs,
+                                          work_dir)
+        finally:
+            pld_nr_buildconf.traced_call(config.c_sudo + ["rm", "-rf",
+                                            "--one-file-system", work_dir])
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "wt") as out_f:
+            json.dump([r.as_dict() for r in results], out_f, indent=2,
+                      sort_keys=True)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (ValueError, RuntimeError, subprocess.CalledProcessError,
+            pld_nr_buildconf.ConfigError) as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+# vi: sts=4 sw=4 et
@@ -0,0 +1,484 @@
+#!/usr/bin/python3
+
+"""In-process ELF shared library dependency resolver.
+
+Reads PT_INTERP, DT_NEEDED, DT_RPATH and DT_RUNPATH directly from the ELF
+files of a chroot tree and resolves library dependencies the way the dynamic
+loader would, without spawning `ld-linux --list` for every executable.
+"""
+
+import os
+import sys
+import struct
+import errno
+import json
+import logging
+import argparse
+
+from glob import glob
+
+import pld_nr_buildconf
+
+logger = logging.getLogger("pld_nr_elfdeps")
+
+ELF_MAGIC = b"\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+CACHE_VERSION = 1
+
+IGNORE_DEPS = ["linux-gate.so.1", "linux-vdso.so.1", "linux-vdso64.so.1"]
+
+class ELFError(Exception):
+    pass
+
+class ELFInfo(object):
+    """Dynamic linking information of a single ELF file."""
+    def __init__(self, elf_class, machine, interp=None, needed=None,
+                        rpath=None, runpath=None, dynamic=False):
+        self.elf_class = elf_class
+        self.machine = machine
+        self.interp = interp
+        self.needed = needed or []
+        self.rpath = rpath or []
+        self.runpath = runpath or []
+        self.dynamic = dynamic
+    def __repr__(self):
+        return "ELFInfo({!r},{!r},{!r},{!r},{!r},{!r},{!r})".format(
+                self.elf_class, self.machine, self.interp, self.needed,
+                self.rpath, self.runpath, self.dynamic)
+    def as_dict(self):
+        return {
+                "class": self.elf_class,
+                "machine": self.machine,
+                "interp": self.interp,
+                "needed": self.needed,
+                "rpath": self.rpath,
+                "runpath": self.runpath,
+                "dynamic": self.dynamic,
+                }
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["class"], data["machine"], data["interp"],
+                   data["needed"], data["rpath"], data["runpath"],
+                   data["dynamic"])
+
+def _split_path_list(value):
+    return [p for p in value.split(":") if p]
+
+def read_elf_info(elf_f):
+    """Parse dynamic linking information from an open ELF file.
+
+    Return `None` if the file is not an ELF file at all."""
+    ident = elf_f.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        return None
+    elf_class = ident[4]
+    if ident[5] == ELFDATA2LSB:
+        endian = "<"
+    elif ident[5] == ELFDATA2MSB:
+        endian = ">"
+    else:
+        raise ELFError("Unknown ELF data encoding: {}".format(ident[5]))
+    if elf_class == ELFCLASS32:
+        ehdr_fmt = endian + "HHIIIIIHHHHHH"
+        phdr_fmt = endian + "IIIIIIII"
+        dyn_fmt = endian + "iI"
+    elif elf_class == ELFCLASS64:
+        ehdr_fmt = endian + "HHIQQQIHHHHHH"
+        phdr_fmt = endian + "IIQQQQQQ"
+        dyn_fmt = endian + "qQ"
+    else:
+        raise ELFError("Unknown ELF class: {}".format(elf_class))
+    ehdr_size = struct.calcsize(ehdr_fmt)
+    ehdr = elf_f.read(ehdr_size)
+    if len(ehdr) < ehdr_size:
+        raise ELFError("Short ELF header")
+    (_e_type, e_machine, _e_version, _e_entry, e_phoff, _e_shoff, _e_flags,
+        _e_ehsize, e_phentsize, e_phnum, _e_shentsize, _e_shnum,
+        _e_shstrndx) = struct.unpack(ehdr_fmt, ehdr)
+
+    info = ELFInfo(elf_class, e_machine)
+    if not e_phnum:
+        return info
+
+    phdr_size = struct.calcsize(phdr_fmt)
+    if e_phentsize < phdr_size:
+        raise ELFError("Program header entry too small: {}"
+                                                .format(e_phentsize))
+    elf_f.seek(e_phoff)
+    phdrs_data = elf_f.read(e_phentsize * e_phnum)
+    if len(phdrs_data) < e_phentsize * e_phnum:
+        raise ELFError("Short read of program headers")
+    loads = []
+    dynamic = None
+    for num in range(e_phnum):
+        data = phdrs_data[num * e_phentsize:num * e_phentsize + phdr_size]
+        if elf_class == ELFCLASS32:
+            (p_type, p_offset, p_vaddr, _p_paddr, p_filesz, _p_memsz,
+                _p_flags, _p_align) = struct.unpack(phdr_fmt, data)
+        else:
+            (p_type, _p_flags, p_offset, p_vaddr, _p_paddr, p_filesz,
+                _p_memsz, _p_align) = struct.unpack(phdr_fmt, data)
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+        elif p_type == PT_INTERP:
+            elf_f.seek(p_offset)
+            interp = elf_f.read(p_filesz)
+            info.interp = interp.split(b"\x00", 1)[0].decode("utf-8")
+
+    if not dynamic:
+        return info
+    info.dynamic = True
+
+    elf_f.seek(dynamic[0])
+    dyn_data = elf_f.read(dynamic[1])
+    dyn_size = struct.calcsize(dyn_fmt)
+    needed = []
+    rpath = []
+    runpath = []
+    strtab = None
+    strsz = None
+    for offset in range(0, len(dyn_data) - dyn_size + 1, dyn_size):
+        d_tag, d_val = struct.unpack(dyn_fmt, dyn_data[offset:offset+dyn_size])
+        if d_tag == DT_NULL:
+            break
+        elif d_tag == DT_NEEDED:
+            needed.append(d_val)
+        elif d_tag == DT_RPATH:
+            rpath.append(d_val)
+        elif d_tag == DT_RUNPATH:
+            runpath.append(d_val)
+        elif d_tag == DT_STRTAB:
+            strtab = d_val
+        elif d_tag == DT_STRSZ:
+            strsz = d_val
+
+    if not (needed or rpath or runpath):
+        return info
+    if strtab is None or strsz is None:
+        raise ELFError("No string table in the dynamic section")
+
+    for p_vaddr, p_offset, p_filesz in loads:
+        if p_vaddr <= strtab < p_vaddr + p_filesz:
+            strtab_offset = strtab - p_vaddr + p_offset
+            break
+    else:
+        raise ELFError("String table address 0x{:x} not in any loaded"
+                                                " segment".format(strtab))
+    elf_f.seek(strtab_offset)
+    strings = elf_f.read(strsz)
+
+    def get_string(offset):
+        end = strings.find(b"\x00", offset)
+        if end < 0:
+            end = len(strings)
+        return strings[offset:end].decode("utf-8")
+
+    info.needed = [get_string(o) for o in needed]
+    for o in rpath:
+        info.rpath += _split_path_list(get_string(o))
+    for o in runpath:
+        info.runpath += _split_path_list(get_string(o))
+    return info
+
+class LibraryResolver(object):
+    """Resolve shared library dependencies of ELF files in a chroot tree.
+
+    Paths passed to and returned from the public methods are relative
+    to `root_dir`, just like the paths handled by make_initramfs.
+    Parsed ELF headers are cached by (path, inode, mtime) and, when
+    `cache_fn` is given, persisted across runs."""
+    def __init__(self, root_dir, bits, cache_fn=None):
+        self.root_dir = os.path.abspath(root_dir)
+        self.bits = bits
+        if bits == 64:
+            self.lib = "lib64"
+        else:
+            self.lib = "lib"
+        self.cache_fn = cache_fn
+        self._cache = {}
+        self._cache_dirty = False
+        self._realpaths = {}
+        self._closures = {}
+        self._search_dirs = None
+        self.hits = 0
+        self.misses = 0
+        if cache_fn:
+            self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_fn, "rt") as cache_f:
+                data = json.load(cache_f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            logger.warning("Cannot load ELF cache {!r}: {}"
+                                                .format(self.cache_fn, err))
+            return
+        if data.get("version") != CACHE_VERSION:
+            logger.debug("ELF cache version mismatch, ignoring it")
+            return
+        self._cache = data.get("entries", {})
+        logger.debug("Loaded {} ELF cache entries from {!r}"
+                                    .format(len(self._cache), self.cache_fn))
+
+    def save_cache(self):
+        if not self.cache_fn or not self._cache_dirty:
+            return
+        # parallel initramfs builds may save the cache at the same time
+        tmp_fn = "{}.{}.tmp".format(self.cache_fn, os.getpid())
+        try:
+            with open(tmp_fn, "wt") as cache_f:
+                json.dump({"version": CACHE_VERSION,
+                           "entries": self._cache}, cache_f)
+            os.replace(tmp_fn, self.cache_fn)
+        except:
+            if os.path.exists(tmp_fn):
+                os.unlink(tmp_fn)
+            raise
+        self._cache_dirty = False
+        logger.debug("ELF cache saved ({} hits, {} misses)"
+                                            .format(self.hits, self.misses))
+
+    def realpath(self, path):
+        """Resolve symlinks in `path` as if chrooted in `root_dir`."""
+        path = path.lstrip("/")
+        try:
+            return self._realpaths[path]
+        except KeyError:
+            pass
+        parts = [p for p in path.split("/") if p]
+        resolved = []
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            if part == ".":
+                continue
+            elif part == "..":
+                if resolved:
+                    resolved.pop()
+                continue
+            full_path = os.path.join(self.root_dir, *(resolved + [part]))
+            if os.path.islink(full_path):
+                links += 1
+                if links > 40:
+                    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP),
+                                                                    path)
+                target = os.readlink(full_path)
+                if target.startswith("/"):
+                    resolved = []
+                parts = [p for p in target.split("/") if p] + parts
+            else:
+                resolved.append(part)
+        result = "/".join(resolved)
+        self._realpaths[path] = result
+        return result
+
+    def _link_path(self, path):
+        """Return host path of `path` with only its directory resolved."""
+        return os.path.join(self.root_dir,
+                            self.realpath(os.path.dirname(path)),
+                            os.path.basename(path))
+
+    def get_info(self, path):
+        """Return ELFInfo for `path` or `None` for non-ELF files."""
+        real_path = self.realpath(path)
+        full_path = os.path.join(self.root_dir, real_path)
+        path_stat = os.stat(full_path)
+        key = [path_stat.st_ino, path_stat.st_mtime_ns]
+        entry = self._cache.get(real_path)
+        if entry is not None and entry[:2] == key:
+            self.hits += 1
+            if entry[2] is None:
+                return None
+            return ELFInfo.from_dict(entry[2])
+        self.misses += 1
+        with open(full_path, "rb") as elf_f:
+            try:
+                info = read_elf_info(elf_f)
+            except (ELFError, struct.error, UnicodeError) as err:
+                raise ELFError("{}: {}".format(path, err))
+        self._cache[real_path] = key + [info.as_dict() if info else None]
+        self._cache_dirty = True
+        return info
+
+    def _ld_so_conf_dirs(self, conf_fn, seen):
+        real_fn = self.realpath(conf_fn)
+        if real_fn in seen:
+            return []
+        seen.add(real_fn)
+        result = []
+        try:
+            conf_f = open(os.path.join(self.root_dir, real_fn), "rt")
+        except OSError as err:
+            logger.debug("Cannot read {!r}: {}".format(conf_fn, err))
+            return result
+        with conf_f:
+            for line in conf_f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                if line.startswith("include"):
+                    for pattern in line.split()[1:]:
+                        if not pattern.startswith("/"):
+                            pattern = os.path.join(
+                                    "/" + os.path.dirname(conf_fn), pattern)
+                        matches = glob(os.path.join(self.root_dir,
+                                                    pattern.lstrip("/")))
+                        for match in sorted(matches):
+                            rel_path = os.path.relpath(match, self.root_dir)
+                            result += self._ld_so_conf_dirs(rel_path, seen)
+                elif line.startswith("hwcap"):
+                    continue
+                else:
+                    result += [d.strip("/") for d in line.replace(",", " ")
+                                                            .split()]
+        return result
+
+    def get_search_dirs(self):
+        """Return ld.so.conf directories followed by the default ones."""
+        if self._search_dirs is not None:
+            return self._search_dirs
+        dirs = self._ld_so_conf_dirs("etc/ld.so.conf", set())
+        for default in (self.lib, "usr/" + self.lib):
+            if default not in dirs:
+                dirs.append(default)
+        self._search_dirs = dirs
+        logger.debug("Library search path: {!r}".format(dirs))
+        return dirs
+
+    def _expand_dst(self, path, origin):
+        path = path.replace("${ORIGIN}", "/" + origin)
+        path = path.replace("$ORIGIN", "/" + origin)
+        path = path.replace("${LIB}", self.lib).replace("$LIB", self.lib)
+        return path.strip("/")
+
+    def _is_compatible(self, path, main_info):
+        try:
+            info = self.get_info(path)
+        except (OSError, ELFError) as err:
+            logger.debug("Skipping {!r}: {}".format(path, err))
+            return False
+        return (info is not None and info.elf_class == main_info.elf_class
+                                    and info.machine == main_info.machine)
+
+    def find_library(self, name, obj_path, obj_info, main_path, main_info):
+        """Find library `name` needed by `obj_path`, return its path."""
+        if "/" in name:
+            path = name.lstrip("/")
+            if self._is_compatible(path, main_info):
+                return path
+            return None
+        dirs = []
+        if not obj_info.runpath:
+            origin = os.path.dirname(obj_path)
+            dirs += [self._expand_dst(d, origin) for d in obj_info.rpath]
+            if main_path != obj_path and not main_info.runpath:
+                origin = os.path.dirname(main_path)
+                dirs += [self._expand_dst(d, origin)
+                                                for d in main_info.rpath]
+        else:
+            origin = os.path.dirname(obj_path)
+            dirs += [self._expand_dst(d, origin) for d in obj_info.runpath]
+        dirs += self.get_search_dirs()
+        for lib_dir in dirs:
+            path = os.path.join(lib_dir, name)
+            if not os.path.lexists(self._link_path(path)):
+                continue
+            if self._is_compatible(path, main_info):
+                return path
+        return None
+
+    def _with_symlink_target(self, path):
+        result = [path]
+        link_path = self._link_path(path)
+        if os.path.islink(link_path):
+            target = os.readlink(link_path)
+            target = os.path.join("/" + os.path.dirname(path), target)
+            result.append(os.path.abspath(target).lstrip("/"))
+        return result
+
+    def get_deps(self, path):
+        """Return the dynamic loader and all libraries needed by `path`.
+
+        The result is the same closure `ld-linux --list` would give,
+        including targets of the library symlinks."""
+        path = path.lstrip("/")
+        real_path = self.realpath(path)
+        if real_path in self._closures:
+            return list(self._closures[real_path])
+        main_info = self.get_info(path)
+        if main_info is None or not main_info.dynamic:
+            self._closures[real_path] = []
+            return []
+        result = []
+        if main_info.interp:
+            result += self._with_symlink_target(main_info.interp.lstrip("/"))
+        found = {}
+        queue = [(path, main_info)]
+        while queue:
+            obj_path, obj_info = queue.pop(0)
+            for name in obj_info.needed:
+                if name in found or name in IGNORE_DEPS:
+                    continue
+                lib_path = self.find_library(name, obj_path, obj_info,
+                                             path, main_info)
+                found[name] = lib_path
+                if lib_path is None:
+                    logger.warning("{!r} needed by {!r} not found"
+                                                    .format(name, obj_path))
+                    continue
+                for dep in self._with_symlink_target(lib_path):
+                    if dep not in result:
+                        result.append(dep)
+                queue.append((lib_path, self.get_info(lib_path)))
+        self._closures[real_path] = result
+        return list(result)
+
+def main():
+    log_parser = pld_nr_buildconf.get_logging_args_parser()
+    parser = argparse.ArgumentParser(
+                        description="List shared libraries needed by"
+                                    " executables in a chroot tree",
+                        parents=[log_parser])
+    parser.add_argument("--root", default="root",
+                        help="Root directory of the tree")
+    parser.add_argument("--bits", type=int, choices=(32, 64), default=64,
+                        help="Target word size")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="Paths (relative to the root) to resolve")
+    args = parser.parse_args()
+    pld_nr_buildconf.setup_logging(args)
+    resolver = LibraryResolver(args.root, args.bits)
+    for path in args.paths:
+        print("{}:".format(path))
+        for dep in resolver.get_deps(path):
+            print("    {}".format(dep))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (OSError, ELFError) as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+# vi: sts=4 sw=4 et
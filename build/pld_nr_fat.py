@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+
+"""Minimal FAT12/FAT16 image writer.
+
+Builds a read-only style FAT file system (like the EFI system partition)
+in a single pass: the image size is computed exactly from the
+cluster-rounded file sizes and directory entries, the image is created
+sparse and all the files are written from memory or copied from their
+source files. No mkdosfs, mtools or loop mounts needed.
+"""
+
+import os
+import sys
+import struct
+import time
+import logging
+import argparse
+
+import pld_nr_buildconf
+
+logger = logging.getLogger("pld_nr_fat")
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 1
+NUM_FATS = 2
+MEDIA_DESCRIPTOR = 0xf8
+SECTORS_PER_TRACK = 32
+NUM_HEADS = 64
+DIR_ENTRY_SIZE = 32
+
+# FAT type is determined by the cluster count only,
+# keep away from the boundaries some implementations get wrong
+FAT12_MAX_CLUSTERS = 4084
+FAT16_MAX_CLUSTERS = 65524
+CLUSTER_COUNT_MARGIN = 16
+
+ATTR_READ_ONLY = 0x01
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0f
+
+LFN_CHARS_PER_ENTRY = 13
+
+SHORT_NAME_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+                             "!#$%&'()-@^_`{}~")
+
+COPY_BUF_SIZE = 1024 * 1024
+
+class FATError(Exception):
+    pass
+
+def _ceil_div(value, divisor):
+    return (value + divisor - 1) // divisor
+
+def _fat_date_time(timestamp):
+    tm = time.gmtime(max(timestamp, 315532800)) # 1980-01-01
+    date = ((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    ftime = (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2)
+    return date, ftime
+
+def is_short_name(name):
+    """Check if `name` can be stored as a plain 8.3 name."""
+    if name in (".", "..") or name.startswith("."):
+        return False
+    if "." in name:
+        base, ext = name.rsplit(".", 1)
+    else:
+        base, ext = name, ""
+    return (0 < len(base) <= 8 and len(ext) <= 3
+            and all(c in SHORT_NAME_CHARS for c in base + ext))
+
+def _pack_short_name(base, ext):
+    return base.ljust(8).encode("ascii") + ext.ljust(3).encode("ascii")
+
+def lfn_checksum(short_name):
+    result = 0
+    for byte in short_name:
+        result = (((result & 1) << 7) + (result >> 1) + byte) & 0xff
+    return result
+
+class FATNode(object):
+    """File or directory of the image."""
+    def __init__(self, name, parent=None, data=None, source=None,
+                 is_dir=False):
+        self.name = name
+        self.parent = parent
+        self.data = data
+        self.source = source
+        self.is_dir = is_dir
+        self.children = []
+        self.short_name = None
+        self.lfn = False
+        self.first_cluster = 0
+        self.num_clusters = 0
+        if is_dir:
+            self.size = 0
+        elif data is not None:
+            self.size = len(data)
+        else:
+            self.size = os.path.getsize(source)
+
+    def num_entries(self):
+        """Number of directory entries needed for this node in its
+        parent directory."""
+        if self.lfn:
+            return 1 + _ceil_div(len(self.name.encode("utf-16-le")) // 2,
+                                 LFN_CHARS_PER_ENTRY)
+        return 1
+
+    def dir_size(self):
+        """Size of this directory contents (entries) in bytes."""
+        entries = sum(c.num_entries() for c in self.children)
+        if self.parent:
+            entries += 2 # "." and ".."
+        return entries * DIR_ENTRY_SIZE
+
+class FATImage(object):
+    """FAT12/16 file system image under construction.
+
+    Paths are '/'-separated and case-preserving; lookups are case
+    insensitive, like on FAT."""
+    def __init__(self, volume_id=0, label=None, timestamp=None):
+        self.volume_id = volume_id
+        self.label = label
+        if timestamp is None:
+            timestamp = time.time()
+        self.date, self.time = _fat_date_time(timestamp)
+        self.root = FATNode("", is_dir=True)
+        self.fat_bits = None
+        self.sectors_per_cluster = None
+        self.cluster_count = None
+        self.fat_sectors = None
+        self.root_entries = None
+        self.root_sectors = None
+        self.total_sectors = None
+        self.data_start = None
+
+    def _lookup(self, path, create_dirs=False):
+        node = self.root
+        for part in [p for p in path.split("/") if p]:
+            for child in node.children:
+                if child.name.upper() == part.upper():
+                    node = child
+                    break
+            else:
+                if not create_dirs:
+                    return None
+                child = FATNode(part, node, is_dir=True)
+                node.children.append(child)
+                node = child
+            if not node.is_dir:
+                raise FATError("{!r} is not a directory".format(path))
+        return node
+
+    def add_dir(self, path):
+        """Create directory `path` (with parents)."""
+        return self._lookup(path, create_dirs=True)
+
+    def add_file(self, path, data=None, source=None):
+        """Add file `path` with contents `data` (bytes) or copied
+        from `source` file. An existing file is replaced."""
+        if (data is None) == (source is None):
+            raise ValueError("Exactly one of data and source needed")
+        path = path.strip("/")
+        if "/" in path:
+            dir_path, name = path.rsplit("/", 1)
+        else:
+            dir_path, name = "", path
+        parent = self.add_dir(dir_path)
+        for child in list(parent.children):
+            if child.name.upper() == name.upper():
+                if child.is_dir:
+                    raise FATError("{!r} is a directory".format(path))
+                parent.children.remove(child)
+        node = FATNode(name, parent, data=data, source=source)
+        parent.children.append(node)
+        return node
+
+    def _walk(self, node=None):
+        if node is None:
+            node = self.root
+        for child in node.children:
+            yield child
+            if child.is_dir:
+                for descendant in self._walk(child):
+                    yield descendant
+
+    def _assign_short_names(self, directory):
+        used = set()
+        for child in directory.children:
+            if is_short_name(child.name):
+                base, _, ext = child.name.partition(".")
+                child.short_name = _pack_short_name(base, ext)
+                child.lfn = False
+                used.add(child.short_name)
+        for child in directory.children:
+            if child.short_name is not None:
+                continue
+            child.lfn = True
+            name = child.name.upper().lstrip(".")
+            if "." in name:
+                base, ext = name.rsplit(".", 1)
+            else:
+                base, ext = name, ""
+            base = "".join(c if c in SHORT_NAME_CHARS else "_"
+                                for c in base if c not in ". ") or "_"
+            ext = "".join(c if c in SHORT_NAME_CHARS else "_"
+                                for c in ext if c != " ")[:3]
+            for num in range(1, 1000000):
+                suffix = "~{}".format(num)
+                short_name = _pack_short_name(base[:8 - len(suffix)] + suffix,
+                                              ext)
+                if short_name not in used:
+                    break
+            child.short_name = short_name
+            used.add(short_name)
+        for child in directory.children:
+            if child.is_dir:
+                self._assign_short_names(child)
+
+    def _root_entries(self):
+        entries = sum(c.num_entries() for c in self.root.children)
+        if self.label:
+            entries += 1
+        # whole sectors
+        per_sector = SECTOR_SIZE // DIR_ENTRY_SIZE
+        return max(per_sector, _ceil_div(entries, per_sector) * per_sector)
+
+    def _compute_layout(self):
+        """Choose FAT type, cluster size and image size."""
+        self._assign_short_names(self.root)
+        nodes = list(self._walk())
+        root_entries = self._root_entries()
+        root_sectors = root_entries * DIR_ENTRY_SIZE // SECTOR_SIZE
+        for spc in (1, 2, 4, 8, 16, 32, 64):
+            cluster_size = spc * SECTOR_SIZE
+            needed = 0
+            for node in nodes:
+                if node.is_dir:
+                    size = max(node.dir_size(), 1)
+                else:
+                    size = node.size
+                needed += _ceil_div(size, cluster_size)
+            count = max(needed, 1)
+            while True:
+                if count <= FAT12_MAX_CLUSTERS - CLUSTER_COUNT_MARGIN:
+                    fat_bits = 12
+                elif count <= FAT12_MAX_CLUSTERS + CLUSTER_COUNT_MARGIN:
+                    count = FAT12_MAX_CLUSTERS + CLUSTER_COUNT_MARGIN + 1
+                    fat_bits = 16
+                else:
+                    fat_bits = 16
+                fat_sectors = _ceil_div(_ceil_div((count + 2) * fat_bits, 8),
+                                        SECTOR_SIZE)
+                total = (RESERVED_SECTORS + NUM_FATS * fat_sectors
+                                            + root_sectors + count * spc)
+                # whole tracks, so mtools does not complain
+                extra = (-total % SECTORS_PER_TRACK) // spc
+                if not extra:
+                    total += -total % SECTORS_PER_TRACK
+                    break
+                count += extra
+            if count > FAT16_MAX_CLUSTERS - CLUSTER_COUNT_MARGIN:
+                continue
+            break
+        else:
+            raise FATError("Too much data for FAT16")
+        self.fat_bits = fat_bits
+        self.sectors_per_cluster = spc
+        self.cluster_count = count
+        self.fat_sectors = fat_sectors
+        self.root_entries = root_entries
+        self.root_sectors = root_sectors
+        self.total_sectors = total
+        self.data_start = (RESERVED_SECTORS + NUM_FATS * fat_sectors
+                                                    + root_sectors)
+        logger.debug("FAT{} image: {} clusters of {} bytes, {} sectors"
+                        .format(fat_bits, count, spc * SECTOR_SIZE, total))
+
+    def _allocate_clusters(self):
+        cluster_size = self.sectors_per_cluster * SECTOR_SIZE
+        next_cluster = 2
+        for node in self._walk():
+            if node.is_dir:
+                size = max(node.dir_size(), 1)
+            else:
+                size = node.size
+            node.num_clusters = _ceil_div(size, cluster_size)
+            if node.num_clusters:
+                node.first_cluster = next_cluster
+                next_cluster += node.num_clusters
+            else:
+                node.first_cluster = 0
+
+    def _boot_sector(self):
+        if self.total_sectors < 0x10000:
+            total16, total32 = self.total_sectors, 0
+        else:
+            total16, total32 = 0, self.total_sectors
+        label = (self.label or "NO NAME").upper()[:11].ljust(11)
+        fs_type = "FAT{}".format(self.fat_bits).ljust(8)
+        data = b"\xeb\x3c\x90" + b"PLDNR   "
+        data += struct.pack("<HBHBHHBHHHII", SECTOR_SIZE,
+                            self.sectors_per_cluster, RESERVED_SECTORS,
+                            NUM_FATS, self.root_entries, total16,
+                            MEDIA_DESCRIPTOR, self.fat_sectors,
+                            SECTORS_PER_TRACK, NUM_HEADS, 0, total32)
+        data += struct.pack("<BBBI", 0x80, 0, 0x29, self.volume_id)
+        data += label.encode("ascii") + fs_type.encode("ascii")
+        # boot code: 'int 0x18' (no bootable OS)
+        data += b"\xcd\x18"
+        data += b"\x00" * (SECTOR_SIZE - 2 - len(data)) + b"\x55\xaa"
+        return data
+
+    def _fat_table(self):
+        entries = [0] * (self.cluster_count + 2)
+        if self.fat_bits == 12:
+            entries[0] = 0xf00 | MEDIA_DESCRIPTOR
+            entries[1] = 0xfff
+        else:
+            entries[0] = 0xff00 | MEDIA_DESCRIPTOR
+            entries[1] = 0xffff
+        eoc = (1 << self.fat_bits) - 1
+        for node in self._walk():
+            for num in range(node.num_clusters - 1):
+                entries[node.first_cluster + num] = node.first_cluster + num + 1
+            if node.num_clusters:
+                entries[node.first_cluster + node.num_clusters - 1] = eoc
+        if self.fat_bits == 16:
+            data = struct.pack("<{}H".format(len(entries)), *entries)
+        else:
+            if len(entries) % 2:
+                entries.append(0)
+            data = bytearray()
+            for num in range(0, len(entries), 2):
+                pair = entries[num] | (entries[num + 1] << 12)
+                data += pair.to_bytes(3, "little")
+            data = bytes(data)
+        return data.ljust(self.fat_sectors * SECTOR_SIZE, b"\x00")
+
+    def _short_entry(self, short_name, attr, cluster, size):
+        return struct.pack("<11sBBBHHHHHHHI", short_name, attr, 0, 0,
+                           self.time, self.date, self.date, 0,
+                           self.time, self.date, cluster, size)
+
+    def _node_entries(self, node):
+        result = b""
+        if node.lfn:
+            checksum = lfn_checksum(node.short_name)
+            name = node.name.encode("utf-16-le")
+            chars = [name[i:i+2] for i in range(0, len(name), 2)]
+            num_entries = _ceil_div(len(chars), LFN_CHARS_PER_ENTRY)
+            padded_len = num_entries * LFN_CHARS_PER_ENTRY
+            if len(chars) < padded_len:
+                chars.append(b"\x00\x00")
+            chars += [b"\xff\xff"] * (padded_len - len(chars))
+            for seq in range(num_entries, 0, -1):
+                part = chars[(seq - 1) * LFN_CHARS_PER_ENTRY:
+                                            seq * LFN_CHARS_PER_ENTRY]
+                order = seq | (0x40 if seq == num_entries else 0)
+                result += (bytes([order]) + b"".join(part[:5])
+                           + bytes([ATTR_LONG_NAME, 0, checksum])
+                           + b"".join(part[5:11]) + b"\x00\x00"
+                           + b"".join(part[11:13]))
+        if node.is_dir:
+            attr = ATTR_DIRECTORY
+        else:
+            attr = ATTR_ARCHIVE
+        result += self._short_entry(node.short_name, attr,
+                                    node.first_cluster, node.size)
+        return result
+
+    def _dir_data(self, directory):
+        data = b""
+        if directory is self.root:
+            if self.label:
+                label = self.label.upper()[:11].ljust(11).encode("ascii")
+                data += self._short_entry(label, ATTR_VOLUME_ID, 0, 0)
+        else:
+            parent = directory.parent
+            parent_cluster = 0 if parent is self.root else parent.first_cluster
+            data += self._short_entry(b".          ", ATTR_DIRECTORY,
+                                      directory.first_cluster, 0)
+            data += self._short_entry(b"..         ", ATTR_DIRECTORY,
+                                      parent_cluster, 0)
+        for child in directory.children:
+            data += self._node_entries(child)
+        return data
+
+    def _cluster_offset(self, cluster):
+        return (self.data_start + (cluster - 2) * self.sectors_per_cluster
+                                                        ) * SECTOR_SIZE
+
+    def write(self, filename):
+        """Write the image to `filename`."""
+        self._compute_layout()
+        self._allocate_clusters()
+        with open(filename, "wb") as image_f:
+            image_f.truncate(self.total_sectors * SECTOR_SIZE)
+            image_f.write(self._boot_sector())
+            fat = self._fat_table()
+            for dummy in range(NUM_FATS):
+                image_f.write(fat)
+            image_f.write(self._dir_data(self.root))
+            for node in self._walk():
+                if not node.num_clusters:
+                    continue
+                image_f.seek(self._cluster_offset(node.first_cluster))
+                if node.is_dir:
+                    image_f.write(self._dir_data(node))
+                elif node.data is not None:
+                    image_f.write(node.data)
+                else:
+                    with open(node.source, "rb") as source_f:
+                        written = 0
+                        while True:
+                            data = source_f.read(COPY_BUF_SIZE)
+                            if not data:
+                                break
+                            image_f.write(data)
+                            written += len(data)
+                    if written != node.size:
+                        raise FATError("{!r} changed size while copying"
+                                                    .format(node.source))
+        logger.debug("{} written: {} bytes".format(filename,
+                                    self.total_sectors * SECTOR_SIZE))
+
+def parse_volume_id(vol_id):
+    """Convert volume id in the 'XXXX-XXXX' form to an integer."""
+    return int(vol_id.replace("-", ""), 16)
+
+def main():
+    log_parser = pld_nr_buildconf.get_logging_args_parser()
+    parser = argparse.ArgumentParser(
+                        description="Make FAT image of a directory tree",
+                        parents=[log_parser])
+    parser.add_argument("--volume-id", default="0000-0000",
+                        help="Volume id (XXXX-XXXX)")
+    parser.add_argument("--label",
+                        help="Volume label")
+    parser.add_argument("source",
+                        help="Source directory")
+    parser.add_argument("destination",
+                        help="Destination image file name")
+    args = parser.parse_args()
+    pld_nr_buildconf.setup_logging(args)
+
+    image = FATImage(parse_volume_id(args.volume_id), args.label)
+    for dirpath, dirnames, filenames in os.walk(args.source):
+        rel_dir = os.path.relpath(dirpath, args.source)
+        if rel_dir == ".":
+            rel_dir = ""
+        for dirname in sorted(dirnames):
+            image.add_dir(os.path.join(rel_dir, dirname))
+        for filename in sorted(filenames):
+            image.add_file(os.path.join(rel_dir, filename),
+                           source=os.path.join(dirpath, filename))
+    image.write(args.destination)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (FATError, OSError) as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+# vi: sts=4 sw=4 et
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+
+"""ISO 9660 image reader and module manifest.
+
+Parses the directory tree (with Rock Ridge names) of a finished image
+directly from memory (usually a mmap of the image file or block device)
+to locate files, without calling xorriso.
+
+The manifest is a 'sha256sum' compatible list of the PLD NR module
+archives (`pld-nr-<bits>/*.cpi`). make_iso_img puts a placeholder of the
+right size in the image and fills it in afterwards with the digests of
+the file extents as actually stored in the image.
+"""
+
+import os
+import sys
+import struct
+import hashlib
+import logging
+import argparse
+import mmap
+
+import pld_nr_buildconf
+
+logger = logging.getLogger("pld_nr_iso")
+
+ISO_BLOCK_SIZE = 2048
+ISO_FIRST_DESCRIPTOR = 16
+ISO_DESCRIPTOR_PRIMARY = 1
+ISO_DESCRIPTOR_TERMINATOR = 255
+ISO_ROOT_RECORD_OFFSET = 156
+
+ISO_FLAG_DIRECTORY = 0x02
+ISO_FLAG_MULTI_EXTENT = 0x80
+
+RR_NM_CONTINUE = 0x01
+RR_NM_CURRENT = 0x02
+RR_NM_PARENT = 0x04
+
+MANIFEST_NAME = "modules.sha256"
+MANIFEST_PLACEHOLDER_DIGEST = "0" * 64
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+class ISOError(Exception):
+    pass
+
+class ISOEntry(object):
+    """File or directory in the ISO image."""
+    def __init__(self, name, is_dir, extents):
+        self.name = name
+        self.is_dir = is_dir
+        # list of (byte offset, size)
+        self.extents = extents
+    def __repr__(self):
+        return "ISOEntry({!r},{!r},{!r})".format(self.name, self.is_dir,
+                                                 self.extents)
+    @property
+    def size(self):
+        return sum(e[1] for e in self.extents)
+    @property
+    def offset(self):
+        return self.extents[0][0] if self.extents else 0
+
+class ISO9660(object):
+    """Directory tree of an ISO 9660 image in a buffer."""
+    def __init__(self, image):
+        self.image = image
+        self._susp_skip = 0
+        self._dirs = {}
+        for num in range(ISO_FIRST_DESCRIPTOR, ISO_FIRST_DESCRIPTOR + 64):
+            descriptor = self._read(num * ISO_BLOCK_SIZE, ISO_BLOCK_SIZE)
+            if descriptor[1:6] != b"CD001":
+                raise ISOError("No ISO 9660 volume descriptor at block {}"
+                                                                .format(num))
+            if descriptor[0] == ISO_DESCRIPTOR_PRIMARY:
+                break
+            if descriptor[0] == ISO_DESCRIPTOR_TERMINATOR:
+                raise ISOError("No primary volume descriptor")
+        else:
+            raise ISOError("No primary volume descriptor")
+        self.block_size = struct.unpack_from("<H", descriptor, 128)[0]
+        root_record = descriptor[ISO_ROOT_RECORD_OFFSET:
+                                 ISO_ROOT_RECORD_OFFSET + 34]
+        extent, size = struct.unpack_from("<I4xI", root_record, 2)
+        self.root = ISOEntry("", True, [(extent * self.block_size, size)])
+        self._check_susp()
+
+    def _read(self, offset, size):
+        data = self.image[offset:offset + size]
+        if len(data) != size:
+            raise ISOError("Short read at offset {}".format(offset))
+        return bytes(data)
+
+    def _check_susp(self):
+        """Look for the SUSP 'SP' entry in the root '.' record."""
+        for record in self._records(self.root):
+            su_start = 33 + record[32] + (1 - record[32] % 2)
+            system_use = record[su_start:]
+            if system_use[:2] == b"SP" and system_use[4:6] == b"\xbe\xef":
+                self._susp_skip = system_use[6]
+                logger.debug("SUSP in use, skip: {}".format(self._susp_skip))
+            else:
+                self._susp_skip = None
+            return
+
+    def _records(self, directory):
+        for offset, size in directory.extents:
+            data = self._read(offset, size)
+            pos = 0
+            while pos < size:
+                length = data[pos]
+                if not length:
+                    # records do not cross block boundaries
+                    pos = (pos // self.block_size + 1) * self.block_size
+                    continue
+                yield data[pos:pos + length]
+                pos += length
+
+    def _susp_entries(self, system_use):
+        while system_use:
+            pos = 0
+            continuation = None
+            while pos + 4 <= len(system_use):
+                signature = system_use[pos:pos + 2]
+                length = system_use[pos + 2]
+                if length < 4:
+                    break
+                entry = system_use[pos:pos + length]
+                if signature == b"ST":
+                    break
+                elif signature == b"CE":
+                    block, offset, ce_len = struct.unpack_from("<I4xI4xI",
+                                                               entry, 4)
+                    continuation = (block * self.block_size + offset, ce_len)
+                else:
+                    yield signature, entry
+                pos += length
+            if continuation:
+                system_use = self._read(*continuation)
+            else:
+                system_use = None
+
+    def _record_name(self, record):
+        name_len = record[32]
+        iso_name = record[33:33 + name_len]
+        if self._susp_skip is not None:
+            su_start = 33 + name_len + (1 - name_len % 2) + self._susp_skip
+            rr_name = b""
+            found = False
+            for signature, entry in self._susp_entries(record[su_start:]):
+                if signature != b"NM":
+                    continue
+                flags = entry[4]
+                if flags & (RR_NM_CURRENT | RR_NM_PARENT):
+                    break
+                rr_name += entry[5:]
+                found = True
+                if not flags & RR_NM_CONTINUE:
+                    break
+            if found:
+                return rr_name.decode("utf-8", "replace")
+        name = iso_name.decode("ascii", "replace").split(";")[0]
+        if name.endswith("."):
+            name = name[:-1]
+        return name
+
+    def listdir(self, directory):
+        """Return list of ISOEntry in `directory` (an ISOEntry)."""
+        key = directory.offset
+        if key in self._dirs:
+            return self._dirs[key]
+        result = []
+        multi_extent = None
+        for record in self._records(directory):
+            name_len = record[32]
+            if name_len == 1 and record[33] in (0, 1):
+                continue
+            extent, size = struct.unpack_from("<I4xI", record, 2)
+            flags = record[25]
+            extent = (extent * self.block_size, size)
+            if multi_extent:
+                multi_extent.extents.append(extent)
+            else:
+                entry = ISOEntry(self._record_name(record),
+                                 bool(flags & ISO_FLAG_DIRECTORY), [extent])
+                result.append(entry)
+            if flags & ISO_FLAG_MULTI_EXTENT:
+                multi_extent = multi_extent or entry
+            else:
+                multi_extent = None
+        self._dirs[key] = result
+        return result
+
+    def lookup(self, path):
+        """Return ISOEntry for '/'-separated `path` or None."""
+        entry = self.root
+        for part in [p for p in path.split("/") if p]:
+            if not entry.is_dir:
+                return None
+            for child in self.listdir(entry):
+                if child.name == part:
+                    entry = child
+                    break
+            else:
+                return None
+        return entry
+
+    def iter_data(self, entry):
+        """Yield contents of a file in chunks (memoryviews into
+        the image if possible)."""
+        with memoryview(self.image) as view:
+            for offset, size in entry.extents:
+                end = offset + size
+                if end > len(view):
+                    raise ISOError("{!r} extent beyond the end of the image"
+                                                        .format(entry.name))
+                for pos in range(offset, end, HASH_CHUNK_SIZE):
+                    chunk = view[pos:min(end, pos + HASH_CHUNK_SIZE)]
+                    try:
+                        yield chunk
+                    finally:
+                        chunk.release()
+
+    def file_digest(self, entry):
+        digest = hashlib.sha256()
+        for chunk in self.iter_data(entry):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+def format_manifest(digests):
+    """Return manifest contents for name -> digest mapping."""
+    return "".join("{}  {}\n".format(digests[name], name)
+                            for name in sorted(digests)).encode("utf-8")
+
+def manifest_placeholder(names):
+    """Return manifest of the right size to be filled in later."""
+    return format_manifest({n: MANIFEST_PLACEHOLDER_DIGEST for n in names})
+
+def get_module_entries(iso, prefix):
+    """Return name -> ISOEntry of the module archives in `prefix`."""
+    directory = iso.lookup(prefix)
+    if not directory or not directory.is_dir:
+        raise ISOError("No {!r} directory in the image".format(prefix))
+    return {e.name: e for e in iso.listdir(directory)
+                            if not e.is_dir and e.name.endswith(".cpi")}
+
+def write_manifest(iso, prefix):
+    """Compute digests of the module archives in the image and store
+    them in the manifest placeholder, in place."""
+    manifest = iso.lookup("{}/{}".format(prefix, MANIFEST_NAME))
+    if not manifest:
+        raise ISOError("No {} placeholder in the image"
+                                                .format(MANIFEST_NAME))
+    entries = get_module_entries(iso, prefix)
+    digests = {}
+    for name, entry in sorted(entries.items(), key=lambda i: i[1].offset):
+        digests[name] = iso.file_digest(entry)
+        logger.debug("{}: {}".format(name, digests[name]))
+    data = format_manifest(digests)
+    if len(data) != manifest.size or len(manifest.extents) != 1:
+        raise ISOError("Manifest placeholder does not match the modules"
+                                                        " in the image")
+    offset = manifest.offset
+    iso.image[offset:offset + len(data)] = data
+    logger.info("Manifest of {} modules written".format(len(digests)))
+
+def verify_manifest(iso, prefix):
+    """Check module archives in the image against the manifest.
+
+    Return list of problems found."""
+    manifest = iso.lookup("{}/{}".format(prefix, MANIFEST_NAME))
+    if not manifest:
+        return ["no {} in the image".format(MANIFEST_NAME)]
+    expected = {}
+    errors = []
+    data = b"".join(bytes(c) for c in iso.iter_data(manifest))
+    lines = data.decode("utf-8", "replace").splitlines()
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            digest, name = line.split(None, 1)
+        except ValueError:
+            errors.append("{}:{}: malformed line".format(MANIFEST_NAME,
+                                                         lineno))
+            continue
+        expected[name.lstrip("*")] = digest
+    if set(expected.values()) == {MANIFEST_PLACEHOLDER_DIGEST}:
+        return ["manifest placeholder was never filled in"]
+    entries = get_module_entries(iso, prefix)
+    for name in sorted(set(expected) - set(entries)):
+        errors.append("{}: missing".format(name))
+    for name in sorted(set(entries) - set(expected)):
+        errors.append("{}: not in the manifest".format(name))
+    for name, entry in sorted(entries.items(), key=lambda i: i[1].offset):
+        if name not in expected:
+            continue
+        digest = iso.file_digest(entry)
+        if digest != expected[name]:
+            errors.append("{}: checksum mismatch".format(name))
+        else:
+            logger.info("{}: OK".format(name))
+    return errors
+
+def main():
+    log_parser = pld_nr_buildconf.get_logging_args_parser()
+    parser = argparse.ArgumentParser(
+                        description="List files of an ISO 9660 image",
+                        parents=[log_parser])
+    parser.add_argument("image",
+                        help="Image file")
+    parser.add_argument("path", nargs="?", default="/",
+                        help="Directory to list")
+    args = parser.parse_args()
+    pld_nr_buildconf.setup_logging(args)
+
+    with open(args.image, "rb") as image_f:
+        image = mmap.mmap(image_f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            iso = ISO9660(image)
+            directory = iso.lookup(args.path)
+            if not directory:
+                raise ISOError("{!r} not found".format(args.path))
+            entries = iso.listdir(directory) if directory.is_dir \
+                                                        else [directory]
+            for entry in entries:
+                print("{:>12} {:>12} {}{}".format(
+                                    entry.offset // ISO_BLOCK_SIZE,
+                                    entry.size, entry.name,
+                                    "/" if entry.is_dir else ""))
+        finally:
+            image.close()
+
+if __name__ == "__main__":
+    try:
+        main()
+    except ISOError as err:
+        logger.error(str(err))
+        sys.exit(1)
+
+# vi: sts=4 sw=4 et